@@ -13,6 +13,8 @@ import xml.etree.cElementTree as ET
 from collections import defaultdict
 import re
 import pprint
+from lru import LRUCache, TrackedDict
+from compressed import opened_osm
 
 #OSMFILE = "../example.osm"
 OSMFILE = "../example_sf.osm"
@@ -25,45 +27,45 @@ not_dog_re = re.compile(r'(hot[\w]?dog)|(dogwood)|(pup(a|u))|(doge)|(popup)|(dog
 expected = ["Street", "Avenue", "Boulevard", "Drive", "Court", "Place", "Square", "Lane", "Road", 
             "Trail", "Parkway", "Commons", "Crescent", "Center", "Highway", "Plaza", "Square", "Way"]
 
-mapping = { "ave" : "Avenue",
-            "Ave" : "Avenue",
-            "Ave.": "Avenue",
-            "Blvd"      : "Boulevard",
-            "Blvd,"     : "Boulevard",
-            "Blvd."     : "Boulevard",
-            "Boulavard" : "Boulevard",
-            "Boulvard"  : "Boulevard",
-            "Ctr" : "Center",
-            "Cntr" : "Center",
-            "Ct" : "Court",
-            "Ct." : "Court",
-            "Cres": "Crescent",
-            "Dr" : "Drive",
-            "Dr.": "Drive",
-            "Ln" : "Lane",
-            "Ln.": "Lane",
-            "Hwy" : "Highway",
-            "Pkwy" : "Parkway",
-            "Pl" : "Place",
-            "Plz" : "Plaza",
-            "Rd" : "Road",
-            "Rd.": "Road",
-            "St"    : "Street",
-            "St."   : "Street",
-            "Steet" : "Street"
-           }
+mapping = TrackedDict({ "ave" : "Avenue",
+                        "Ave" : "Avenue",
+                        "Ave.": "Avenue",
+                        "Blvd"      : "Boulevard",
+                        "Blvd,"     : "Boulevard",
+                        "Blvd."     : "Boulevard",
+                        "Boulavard" : "Boulevard",
+                        "Boulvard"  : "Boulevard",
+                        "Ctr" : "Center",
+                        "Cntr" : "Center",
+                        "Ct" : "Court",
+                        "Ct." : "Court",
+                        "Cres": "Crescent",
+                        "Dr" : "Drive",
+                        "Dr.": "Drive",
+                        "Ln" : "Lane",
+                        "Ln.": "Lane",
+                        "Hwy" : "Highway",
+                        "Pkwy" : "Parkway",
+                        "Pl" : "Place",
+                        "Plz" : "Plaza",
+                        "Rd" : "Road",
+                        "Rd.": "Road",
+                        "St"    : "Street",
+                        "St."   : "Street",
+                        "Steet" : "Street"
+                       })
 
 default_city = "San Francisco"
-city_mapping = { "San Francicsco" : "San Francisco",
-                 "San Francisco, Ca": "San Francisco",
-                 "San Francisco, Ca 94102": "San Francisco",
-                 "San Francscio": "San Francisco",
-                 "Okaland": "Oakland",
-                 "Oakland Ca": "Oakland",
-                 "Oakland, Ca": "Oakland",
-                 "East Palo Alto": "Palo Alto",
-                 "Berkeley, Ca" : "Berkeley"
-               }
+city_mapping = TrackedDict({ "San Francicsco" : "San Francisco",
+                             "San Francisco, Ca": "San Francisco",
+                             "San Francisco, Ca 94102": "San Francisco",
+                             "San Francscio": "San Francisco",
+                             "Okaland": "Oakland",
+                             "Oakland Ca": "Oakland",
+                             "Oakland, Ca": "Oakland",
+                             "East Palo Alto": "Palo Alto",
+                             "Berkeley, Ca" : "Berkeley"
+                           })
 
 dog_srch_keys = {"name","name_1","alt_name","old_name","tiger:name_base",\
                  "park:type","amenity","barrier","animal","designation",\
@@ -165,28 +167,39 @@ def normalize_capitalization(val):
     capitalizes 1st letter of each word (numbers unchanged)"""
     return ' '.join(word[0].upper() + word[1:] for word in val.strip().lower().split())
 
+def audit_element(elem, street_types, city_names, dog_dict):
+    """Audits the street, city and dog related tags of a single node/way
+    element, adding what it finds to the passed in dictionaries"""
+    if elem.tag == "node" or elem.tag == "way":
+        found_dog = False
+        for tag in elem.iter("tag"):
+            if tag == 'name':
+                tag.attrib['v'] = normalize_capitalization(tag.attrib['v'])
+            if is_dog_related(tag):
+                found_dog = True
+            if is_addr_prefix(tag):
+                tag.attrib['v'] = normalize_capitalization(tag.attrib['v'])
+                if is_street_name(tag):
+                    audit_street_type(street_types, tag.attrib['v'])
+                elif is_city(tag):
+                    audit_city_name(city_names, tag.attrib['v'])
+        if found_dog == True:
+            audit_dog(dog_dict, elem)
+
+
 def audit(osmfile):
-    osm_file = open(osmfile, "r")
     street_types = defaultdict(set)
     city_names = defaultdict(set)
     dog_dict = defaultdict(dict)
-    for event, elem in ET.iterparse(osm_file, events=("start",)):
-
-        if elem.tag == "node" or elem.tag == "way":
-            found_dog = False
-            for tag in elem.iter("tag"):
-                if tag == 'name':
-                    tag.attrib['v'] = normalize_capitalization(tag.attrib['v'])
-                if is_dog_related(tag):
-                    found_dog = True
-                if is_addr_prefix(tag):
-                    tag.attrib['v'] = normalize_capitalization(tag.attrib['v'])
-                    if is_street_name(tag):
-                        audit_street_type(street_types, tag.attrib['v'])
-                    elif is_city(tag):
-                        audit_city_name(city_names, tag.attrib['v'])
-            if found_dog == True:
-                audit_dog(dog_dict, elem)
+    with opened_osm(osmfile) as osm_file:
+        context = iter(ET.iterparse(osm_file, events=("start", "end")))
+        event, root = context.next() # get the root element
+        for event, elem in context:
+            if event == "end":
+                audit_element(elem, street_types, city_names, dog_dict)
+                if elem.tag in ("node", "way", "relation"):
+                    elem.clear()
+                    root.clear()
 
     return street_types, city_names, dog_dict
 
@@ -213,6 +226,42 @@ def update_city(name, mapping):
         name = mapping[name]
     return name
 
+# Street/city names repeat heavily across the file, so the results of the
+# cleaning functions are cached (emptied whenever mapping or city_mapping change)
+CLEAN_CACHE_SIZE = 10000
+name_cache = LRUCache(CLEAN_CACHE_SIZE)
+city_cache = LRUCache(CLEAN_CACHE_SIZE)
+capitalization_cache = LRUCache(CLEAN_CACHE_SIZE)
+
+def cached_update_name(name, mapping):
+    """Same as update_name, cached if the mapping is a TrackedDict
+    (like mapping above) so changes to it can be detected"""
+    if not isinstance(mapping, TrackedDict):
+        return update_name(name, mapping)
+    name_cache.validate(mapping)
+    return name_cache.lookup(name, update_name, name, mapping)
+
+def cached_update_city(name, mapping):
+    """Same as update_city, cached if the mapping is a TrackedDict"""
+    if not isinstance(mapping, TrackedDict):
+        return update_city(name, mapping)
+    city_cache.validate(mapping)
+    return city_cache.lookup(name, update_city, name, mapping)
+
+def cached_normalize_capitalization(val):
+    return capitalization_cache.lookup(val, normalize_capitalization, val)
+
+def set_clean_cache_size(maxsize):
+    """Changes the maximum number of entries in each cleaning cache (0 disables caching)"""
+    for cache in (name_cache, city_cache, capitalization_cache):
+        cache.resize(maxsize)
+
+def clean_cache_stats():
+    """Hit/miss/eviction counts for each of the cleaning caches"""
+    return { "update_name" : name_cache.stats(),
+             "update_city" : city_cache.stats(),
+             "normalize_capitalization" : capitalization_cache.stats() }
+
 def test():
     st_types, cty_names, dog_tags = audit(OSMFILE)
     
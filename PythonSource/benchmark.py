@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+Benchmarks the parsing/auditing/shaping functions on synthetic .osm files
+(see synthetic.py) of increasing size, and saves the results as json so
+runs can be compared to catch performance regressions.
+
+Times (best of repeat runs):
+    mapparser.count_tags, users.process_map, tags.process_map, audit.audit
+    data.parse          parsing the elements only (parsers.iter_elements)
+    data.iter_shaped    parsing and shaping every element
+    data.shape_element  shape_element alone (iter_shaped minus parse)
+For each, the elements (nodes/ways/relations) per second and MB per second.
+
+Run from the command line with the number of nodes of each file, i.e.:
+    python benchmark.py 10000 100000 --out benchmark_results.json
+or within the Python shell:
+>>> import benchmark
+>>> results = benchmark.run_benchmarks([10000, 100000])
+"""
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from cStringIO import StringIO
+import mapparser
+import users
+import tags
+import audit
+import synthetic
+import data
+from parsers import iter_elements
+
+DEFAULT_SIZES = [10000, 100000]
+DEFAULT_REPEAT = 3
+RESULTS_FILE = "benchmark_results.json"
+
+
+def count_parse(file_in):
+    count = 0
+    for elem in iter_elements(file_in):
+        count += 1
+    return count
+
+
+def count_shaped(file_in):
+    count = 0
+    for el in data.iter_shaped(file_in):
+        count += 1
+    return count
+
+
+BENCHMARKS = [ ("mapparser.count_tags", mapparser.count_tags),
+               ("users.process_map", users.process_map),
+               ("tags.process_map", tags.process_map),
+               ("audit.audit", audit.audit),
+               ("data.parse", count_parse),
+               ("data.iter_shaped", count_shaped) ]
+
+
+def time_call(func, arg, repeat):
+    """Best time of repeat calls of func(arg), with anything it prints hidden"""
+    best = None
+    stdout = sys.stdout
+    try:
+        for _ in range(repeat):
+            sys.stdout = StringIO()
+            start = time.time()
+            func(arg)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        sys.stdout = stdout
+    return best
+
+
+def rates(seconds, elements, nbytes):
+    return { "seconds" : seconds,
+             "elements_per_sec" : elements / max(seconds, 1e-9),
+             "mb_per_sec" : nbytes / 1048576.0 / max(seconds, 1e-9) }
+
+
+def benchmark_file(file_in, repeat=DEFAULT_REPEAT, benchmarks=BENCHMARKS):
+    """Times each benchmark on the file, returns the dictionary of results"""
+    counts = mapparser.count_tags(file_in)
+    elements = sum(counts.get(t, 0) for t in ("node", "way", "relation"))
+    nbytes = os.path.getsize(file_in)
+    results = {}
+    for name, func in benchmarks:
+        results[name] = rates(time_call(func, file_in, repeat), elements, nbytes)
+        print "  %-22s %8.3f sec %10.0f elements/sec %6.1f MB/sec"%(name, results[name]['seconds'],\
+            results[name]['elements_per_sec'], results[name]['mb_per_sec'])
+    if "data.parse" in results and "data.iter_shaped" in results:
+        shaped = sum(counts.get(t, 0) for t in ("node", "way"))
+        seconds = max(results["data.iter_shaped"]["seconds"] - results["data.parse"]["seconds"], 1e-9)
+        results["data.shape_element"] = { "seconds" : seconds,
+                                          "elements_per_sec" : shaped / seconds }
+        print "  %-22s %8.3f sec %10.0f elements/sec"%("data.shape_element", seconds, shaped / seconds)
+    return { "file_bytes" : nbytes, "elements" : elements, "counts" : counts, "benchmarks" : results }
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, repeat=DEFAULT_REPEAT, seed=0, file_out=RESULTS_FILE, keep_files=False):
+    """Generates a synthetic file of each size (number of nodes) and benchmarks it.
+    Writes the results to file_out (json) if given, and returns them."""
+    tmp_dir = tempfile.mkdtemp()
+    runs = []
+    try:
+        for num_nodes in sizes:
+            path = os.path.join(tmp_dir, "synthetic_%d.osm"%(num_nodes))
+            synthetic.generate_osm(path, num_nodes, seed)
+            print "%d nodes (%.1f MB):"%(num_nodes, os.path.getsize(path) / 1048576.0)
+            run = benchmark_file(path, repeat)
+            run["num_nodes"] = num_nodes
+            runs.append(run)
+            if not keep_files:
+                os.remove(path)
+    finally:
+        if not keep_files:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    results = { "timestamp" : time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "python" : platform.python_version(),
+                "platform" : platform.platform(),
+                "seed" : seed,
+                "repeat" : repeat,
+                "runs" : runs }
+    if file_out is not None:
+        with open(file_out, "w") as fo:
+            json.dump(results, fo, indent=2, sort_keys=True)
+        print "Results saved to %s"%(file_out)
+    return results
+
+
+def test():
+    results = run_benchmarks([2000], repeat=1, file_out=None)
+    run = results["runs"][0]
+    assert set(run["benchmarks"]) == set(name for name, _ in BENCHMARKS) | set(["data.shape_element"])
+    assert run["counts"]["node"] == 2000
+    json.dumps(results)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        args = sys.argv[1:]
+        file_out = RESULTS_FILE
+        if "--out" in args:
+            i = args.index("--out")
+            file_out = args[i + 1]
+            del args[i:i + 2]
+        run_benchmarks([int(a) for a in args] or DEFAULT_SIZES, file_out=file_out)
+    else:
+        test()
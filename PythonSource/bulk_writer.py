@@ -0,0 +1,281 @@
+"""
+Batched writes into MongoDB for data.mongo_process_map.
+
+Inserting one document at a time means a round trip to the server for every
+one of the ~3.2M elements in san-francisco.osm.  BulkWriter collects documents
+into batches (limited by number of documents and by BSON size) and writes each
+batch as an unordered bulk insert.  Encoding every document just to measure it
+would double the BSON encoding (pymongo encodes it again to send it), so only
+one in SIZE_SAMPLE_EVERY documents is encoded, and the batch size in bytes is
+estimated from their average (pymongo still splits the actual messages at the
+server's limits, batch_bytes only bounds the memory held in batches).  The writes are done on background threads,
+behind a bounded queue of batches, so parsing/shaping continues while the
+previous batch is being written (and parsing blocks if the writes fall too far behind).
+
+With writers > 1 that many batches are written concurrently (pymongo releases
+the GIL while waiting on the server), to keep a server with spare cores busy.
+At most queue_batches + writers batches are held in memory at once.
+
+Transient errors (AutoReconnect, i.e. a dropped connection or a replica set
+election) are retried up to retries times, waiting retry_delay seconds before
+the first retry and doubling each time.  A batch that failed partway through
+may have been partly written, so a retry only sends the documents whose _id
+(given to every document by pymongo before it's sent) isn't in the collection.
+
+>>> import mongo_audit as ma
+>>> writer = BulkWriter(ma.get_collection(), batch_size=1000, writers=4)
+>>> for doc in shaped_docs:
+...     writer.insert(doc)
+>>> writer.close()
+>>> writer.report()
+"""
+import threading
+import Queue
+import time
+from bson import BSON
+from pymongo.errors import AutoReconnect
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_BATCH_BYTES = 8 * 1024 * 1024
+DEFAULT_QUEUE_BATCHES = 4
+DEFAULT_WRITERS = 1
+DEFAULT_RETRIES = 5
+DEFAULT_RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 30.0
+SIZE_SAMPLE_EVERY = 16
+
+
+class BulkWriter(object):
+    """Writes documents to the collection in unordered bulk inserts from
+    writers background threads.  Keeps the (num docs, estimated num bytes, seconds)
+    of each written batch in batch_stats, and the number of retried writes in retried."""
+
+    def __init__(self, docs, batch_size=DEFAULT_BATCH_SIZE, batch_bytes=DEFAULT_BATCH_BYTES,
+                 queue_batches=DEFAULT_QUEUE_BATCHES, verbose=False, writers=DEFAULT_WRITERS,
+                 retries=DEFAULT_RETRIES, retry_delay=DEFAULT_RETRY_DELAY):
+        self.docs = docs
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.verbose = verbose
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.batch = []
+        self.batch_nbytes = 0
+        self.inserted = 0
+        self.sampled = 0
+        self.sampled_bytes = 0
+        self.batch_stats = []
+        self.retried = 0
+        self.error = None
+        self.start_time = time.time()
+        self.queue = Queue.Queue(maxsize=queue_batches)
+        self.threads = []
+        for i in range(max(writers, 1)):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def insert(self, doc):
+        """Adds the document to the current batch, which is queued
+        for writing once it reaches the size or byte limit"""
+        if self.error is not None:
+            raise self.error
+        nbytes = self.estimate_size(doc)
+        if self.batch and self.batch_nbytes + nbytes > self.batch_bytes:
+            self.flush()
+        self.batch.append(doc)
+        self.batch_nbytes += nbytes
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def estimate_size(self, doc):
+        """Average BSON size of the sampled documents (sampling this one if it's
+        the first or SIZE_SAMPLE_EVERY'th document since the last sample)"""
+        if self.inserted % SIZE_SAMPLE_EVERY == 0:
+            self.sampled += 1
+            self.sampled_bytes += len(BSON.encode(doc))
+        self.inserted += 1
+        return self.sampled_bytes // self.sampled
+
+    def flush(self):
+        """Queues the current batch (blocks while the queue is full)"""
+        if self.batch:
+            self.queue.put((self.batch, self.batch_nbytes))
+            self.batch = []
+            self.batch_nbytes = 0
+
+    def sync(self):
+        """Queues the current batch and waits until every queued batch has been
+        written (i.e. before recording a checkpoint).  Raises the error from the
+        writer threads if any of the writes failed."""
+        self.flush()
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """Writes any remaining documents and waits for the writer threads to finish.
+        Raises the error from the writer threads if any of the writes failed."""
+        if any(thread.is_alive() for thread in self.threads):
+            self.flush()
+            for thread in self.threads:
+                self.queue.put(None)
+            for thread in self.threads:
+                thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            if self.error is not None:
+                # Drain the queue so the parser isn't left blocked
+                self.queue.task_done()
+                continue
+            batch, nbytes = item
+            try:
+                start = time.time()
+                self.write_retrying(batch)
+                elapsed = time.time() - start
+            except Exception as e:
+                self.error = e
+                self.queue.task_done()
+                continue
+            self.batch_stats.append((len(batch), nbytes, elapsed))
+            if self.verbose:
+                print 'Batch %d: %d docs (%.1f KB) in %.3f sec, %.0f docs/sec'%(len(self.batch_stats),\
+                    len(batch), nbytes/1024.0, elapsed, len(batch)/max(elapsed, 1e-6))
+            self.queue.task_done()
+
+    def write_batch(self, batch):
+        bulk = self.docs.initialize_unordered_bulk_op()
+        for doc in batch:
+            bulk.insert(doc)
+        bulk.execute()
+
+    def write_retrying(self, batch):
+        """write_batch, retrying transient errors (see the module docstring)"""
+        delay = self.retry_delay
+        attempt = 0
+        while True:
+            try:
+                if attempt:
+                    batch = self.unwritten(batch)
+                if batch:
+                    self.write_batch(batch)
+                return
+            except AutoReconnect as e:
+                if attempt >= self.retries:
+                    raise
+                if self.verbose:
+                    print 'Retrying batch of %d docs in %.1f sec: %s'%(len(batch), delay, e)
+            attempt += 1
+            self.retried += 1
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+
+    def unwritten(self, batch):
+        """Documents of the batch that aren't in the collection yet"""
+        ids = [doc['_id'] for doc in batch if '_id' in doc]
+        written = set(doc['_id'] for doc in self.docs.find({ "_id" : { "$in" : ids } }, { "_id" : 1 }))
+        return [doc for doc in batch if doc.get('_id') not in written]
+
+    def num_written(self):
+        return sum(n for n, _, _ in self.batch_stats)
+
+    def report(self):
+        """Prints the batch latencies and overall throughput"""
+        if not self.batch_stats:
+            print 'No batches written'
+            return
+        total_docs = self.num_written()
+        total_bytes = sum(b for _, b, _ in self.batch_stats)
+        latencies = sorted(t for _, _, t in self.batch_stats)
+        write_time = sum(latencies)
+        wall_time = time.time() - self.start_time
+        print 'Wrote %d docs (%.1f MB) in %d batches'%(total_docs, total_bytes/1048576.0, len(latencies))
+        print 'Batch latency: mean %.3f sec, median %.3f sec, max %.3f sec'%(write_time/len(latencies),\
+            latencies[len(latencies)//2], latencies[-1])
+        print 'Throughput: %.0f docs/sec writing, %.0f docs/sec overall'%(total_docs/max(write_time, 1e-6),\
+            total_docs/max(wall_time, 1e-6))
+        if self.retried:
+            print 'Retried %d writes after transient errors'%(self.retried)
+
+
+
+class FlakyBulk(object):
+    """Bulk op that raises AutoReconnect for some writes, before or after
+    actually writing them (for testing the retries)"""
+
+    def __init__(self, collection, bulk):
+        self.collection = collection
+        self.bulk = bulk
+
+    def insert(self, doc):
+        self.bulk.insert(doc)
+
+    def execute(self):
+        self.collection.writes += 1
+        fail = self.collection.writes % 3
+        if fail == 1:
+            raise AutoReconnect("connection dropped before the write")
+        self.bulk.execute()
+        if fail == 2:
+            raise AutoReconnect("connection dropped after the write")
+
+
+class FlakyCollection(object):
+    def __init__(self, docs):
+        self.docs = docs
+        self.writes = 0
+
+    def initialize_unordered_bulk_op(self):
+        return FlakyBulk(self, self.docs.initialize_unordered_bulk_op())
+
+    def find(self, *args):
+        return self.docs.find(*args)
+
+
+def test():
+    from mongo_audit import get_collection, delete_collection
+    test_collection = 'BulkWriterTest'
+    delete_collection(test_collection)
+    docs = get_collection(test_collection)
+    with BulkWriter(FlakyCollection(docs), batch_size=10, queue_batches=2, writers=3,
+                    retry_delay=0.01) as writer:
+        for i in range(500):
+            writer.insert({ "type" : "node", "id" : str(i) })
+    assert writer.retried > 0 and writer.num_written() == 500
+    assert docs.find().count() == 500
+    writer.report()
+    # Batches are cut at the estimated byte size
+    delete_collection(test_collection)
+    size = len(BSON.encode({ "type" : "node", "id" : "0", "name" : "x" * 1000 }))
+    with BulkWriter(docs, batch_size=1000, batch_bytes=10 * size) as writer:
+        for i in range(100):
+            writer.insert({ "type" : "node", "id" : "0", "name" : "x" * 1000 })
+    assert max(n for n, _, _ in writer.batch_stats) <= 10 and writer.sampled == 7
+    assert docs.find().count() == 100
+    # Gives up after the retries
+    writer = BulkWriter(FlakyCollection(docs), batch_size=10, retries=0)
+    writer.insert({ "type" : "node", "id" : "500" })
+    try:
+        writer.close()
+        assert False, "expected AutoReconnect"
+    except AutoReconnect:
+        pass
+    delete_collection(test_collection)
+
+
+if __name__ == '__main__':
+    test()
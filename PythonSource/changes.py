@@ -0,0 +1,338 @@
+"""
+Applies an OpenStreetMap change file (.osc, osmChange format) to the MongoDB
+collection, rather than dropping the collection and reloading the whole extract.
+
+<osmChange version="0.6">
+  <create> <node id="1" version="1" .../> </create>
+  <modify> <way id="2" version="5" ...> ... </way> </modify>
+  <delete> <node id="3" version="2" .../> </delete>
+</osmChange>
+
+Created/modified elements are shaped with data.shape_element (same documents as
+a full load) and upserted by (type, id), deletes remove the (type, id) document.
+Each action is only applied if its version is newer than the version already in
+the collection (for deletes, at least as new), so re-applying a change file, or an
+older one, is skipped.  Actions are applied in batches: one query to get the existing
+versions of every element in the batch, then a single unordered bulk write.
+
+reload_file reloads a whole (newer) extract the same way, instead of dropping the
+collection and inserting everything again (which rebuilds every index, and leaves
+an empty collection while it runs): each element is upserted by (type, id) only if
+it isn't in the collection or its version is different, then a sweep deletes the
+documents whose (type, id) wasn't in the extract.  The collection stays queryable
+throughout, and reloading a mostly unchanged extract mostly just reads versions.
+For a collection loaded with way_geometry (see data.add_way_geometry), reload with
+way_geometry too, or the modified ways lose their geometry/bbox/centroid pos.
+Change files only have the changed elements, not the nodes of the ways, so
+apply_change_file writes ways without any geometry (reload the extract with
+way_geometry to add it back).
+
+>>> import changes
+>>> changes.apply_change_file("../daily-change.osc", docs)
+{'create': 10, 'modify': 213, 'delete': 12, 'skipped': 0}
+>>> changes.reload_file("../san-francisco.osm", docs)
+{'create': 1520, 'modify': 20431, 'delete': 310, 'unchanged': 3196627}
+"""
+import xml.etree.cElementTree as ET
+from collections import OrderedDict, defaultdict
+import pprint
+from data import shape_element, iter_shaped, iter_shaped_with_geometry
+from compressed import opened_osm
+from mongo_audit import get_collection, delete_collection, forget_nodes, resolve_node_refs
+
+#OSCFILE = "../san-francisco.osc"
+
+ACTIONS = ("create", "modify", "delete")
+DEFAULT_CHANGE_BATCH_SIZE = 1000
+
+
+def element_version(doc):
+    """Version of a shaped document (or of a document in the collection) as an int"""
+    try:
+        return int(doc['created']['version'])
+    except (KeyError, TypeError, ValueError):
+        return 0
+
+
+def iter_changes(file_in):
+    """Generator of (action, shaped document) for each element in the change file.
+    Delete actions only need the type, id and version, but are shaped the same way.
+    The change file can be compressed (i.e. the .osc.gz files of the replication diffs)."""
+    with opened_osm(file_in) as change_file:
+        context = iter(ET.iterparse(change_file, events=("start", "end")))
+        event, root = context.next() # get the root element
+        action = None
+        action_elem = None
+        depth = 0
+        for event, elem in context:
+            if event == "start":
+                depth += 1
+                if depth == 1:
+                    action = elem.tag
+                    action_elem = elem
+            else:
+                depth -= 1
+                if depth == 1:
+                    if action in ACTIONS:
+                        el = shape_element(elem)
+                        if el:
+                            yield action, el
+                    # Drop the finished element from its action, which can hold
+                    # a whole diff's worth of elements
+                    action_elem.clear()
+                elif depth == 0:
+                    root.clear()
+
+
+def existing_versions(docs, keys):
+    """Version in the collection of each (type, id) in keys that is there"""
+    versions = {}
+    existing = docs.find({ "id" : { "$in" : list(set(k[1] for k in keys)) } },
+                         { "_id" : 0, "type" : 1, "id" : 1, "created.version" : 1 })
+    for doc in existing:
+        key = (doc.get('type'), doc.get('id'))
+        if key in keys:
+            versions[key] = max(versions.get(key, 0), element_version(doc))
+    return versions
+
+
+def write_ops(docs, ops):
+    """Writes the (type, id) : (action, shaped document) ops in one unordered bulk
+    write, upserting creates/modifies and removing deletes.  The nodes are also
+    removed from mongo_audit's node_refs cache, so find_name sees the changes."""
+    if ops:
+        bulk = docs.initialize_unordered_bulk_op()
+        for (el_type, el_id), (action, el) in ops.iteritems():
+            selector = bulk.find({ "type" : el_type, "id" : el_id })
+            if action == 'delete':
+                selector.remove()
+            else:
+                selector.upsert().replace_one(el)
+        try:
+            bulk.execute()
+        finally:
+            forget_nodes(docs, [el_id for el_type, el_id in ops if el_type == 'node'])
+
+
+def apply_batch(docs, batch, counts):
+    """Applies a list of (action, shaped document), skipping any that are
+    not newer than what is in the collection.  Updates the counts dictionary.
+    Ways are written as shaped, without way geometry (see the module docstring)."""
+    keys = set((el['type'], el['id']) for _, el in batch)
+    versions = existing_versions(docs, keys)
+
+    # Only the last action applied to each element within the batch is written
+    ops = OrderedDict()
+    for action, el in batch:
+        key = (el['type'], el['id'])
+        version = element_version(el)
+        current = versions.get(key)
+        if action == 'delete':
+            if current is None or version < current:
+                counts['skipped'] += 1
+                continue
+            versions.pop(key)
+        else:
+            if current is not None and version <= current:
+                counts['skipped'] += 1
+                continue
+            versions[key] = version
+        if key in ops:
+            # Replaced by a later action in the same batch
+            counts[ops[key][0]] -= 1
+        ops[key] = (action, el)
+        counts[action] += 1
+
+    write_ops(docs, ops)
+    return counts
+
+
+def apply_changes(changes, docs, batch_size=DEFAULT_CHANGE_BATCH_SIZE):
+    """Applies an iterable of (action, shaped document) in batches,
+    returns the count of applied creates/modifies/deletes and of skipped actions"""
+    counts = { "create" : 0, "modify" : 0, "delete" : 0, "skipped" : 0 }
+    batch = []
+    for change in changes:
+        batch.append(change)
+        if len(batch) >= batch_size:
+            apply_batch(docs, batch, counts)
+            batch = []
+    if batch:
+        apply_batch(docs, batch, counts)
+    return counts
+
+
+def apply_change_file(file_in, docs=None, batch_size=DEFAULT_CHANGE_BATCH_SIZE):
+    """Streams the osmChange file into the collection (default collection if docs is None)"""
+    if docs is None:
+        docs = get_collection()
+    counts = apply_changes(iter_changes(file_in), docs, batch_size)
+    print "Applied %d creates, %d modifies, %d deletes (%d skipped)"%(counts['create'],\
+        counts['modify'], counts['delete'], counts['skipped'])
+    return counts
+
+
+def compact_id(el_id):
+    """id as an int if it's all digits (a much smaller set member than the string)"""
+    if isinstance(el_id, basestring) and el_id.isdigit():
+        return int(el_id)
+    return el_id
+
+
+def reload_batch(docs, batch, counts, seen):
+    """Upserts the shaped documents that aren't in the collection (create) or
+    whose version is different (modify), counting the rest as unchanged.
+    Adds each (type, id) to seen (a dictionary of the sets of ids of each type)."""
+    keys = set((el['type'], el['id']) for el in batch)
+    versions = existing_versions(docs, keys)
+    ops = OrderedDict()
+    for el in batch:
+        key = (el['type'], el['id'])
+        seen[el['type']].add(compact_id(el['id']))
+        current = versions.get(key)
+        if current is None:
+            action = 'create'
+        elif element_version(el) != current:
+            action = 'modify'
+        else:
+            counts['unchanged'] += 1
+            continue
+        if key in ops:
+            # Repeated within the extract, the last one is written
+            counts[ops[key][0]] -= 1
+        ops[key] = (action, el)
+        counts[action] += 1
+    write_ops(docs, ops)
+    return counts
+
+
+def sweep(docs, seen, counts, batch_size=DEFAULT_CHANGE_BATCH_SIZE):
+    """Deletes the documents whose (type, id) isn't in seen"""
+    stale = []
+    for doc in docs.find({}, { "_id" : 0, "type" : 1, "id" : 1 }):
+        if compact_id(doc.get('id')) not in seen.get(doc.get('type'), ()):
+            stale.append((doc.get('type'), doc.get('id')))
+    for i in range(0, len(stale), batch_size):
+        write_ops(docs, OrderedDict((key, ('delete', None)) for key in stale[i:i + batch_size]))
+    counts['delete'] += len(stale)
+    return counts
+
+
+def reload_docs(shaped, docs, batch_size=DEFAULT_CHANGE_BATCH_SIZE, delete_missing=True):
+    """Reloads the collection from an iterable of every shaped document of the
+    extract (see reload_file), returns the count of creates/modifies/deletes and
+    of unchanged documents"""
+    counts = { "create" : 0, "modify" : 0, "delete" : 0, "unchanged" : 0 }
+    seen = defaultdict(set)
+    batch = []
+    for el in shaped:
+        batch.append(el)
+        if len(batch) >= batch_size:
+            reload_batch(docs, batch, counts, seen)
+            batch = []
+    if batch:
+        reload_batch(docs, batch, counts, seen)
+    if delete_missing:
+        sweep(docs, seen, counts, batch_size)
+    return counts
+
+
+def reload_file(file_in, docs=None, workers=None, batch_size=DEFAULT_CHANGE_BATCH_SIZE,
+                delete_missing=True, way_geometry=False):
+    """Reloads the collection (default collection if docs is None) from the whole
+    extract, only writing what changed and deleting what is no longer in it
+    (unless not delete_missing).  workers shapes the file in parallel (see data.iter_shaped).
+    way_geometry adds the node positions to the ways written, for collections loaded
+    with way_geometry (see data.iter_shaped_with_geometry)."""
+    if docs is None:
+        docs = get_collection()
+    if way_geometry:
+        shaped = iter_shaped_with_geometry(file_in, file_in + ".nodes", workers)
+    else:
+        shaped = iter_shaped(file_in, workers)
+    counts = reload_docs(shaped, docs, batch_size, delete_missing)
+    print "Reloaded %d creates, %d modifies, %d deletes (%d unchanged)"%(counts['create'],\
+        counts['modify'], counts['delete'], counts['unchanged'])
+    return counts
+
+
+def test():
+    """Applies a small change file to a copy of the example data"""
+    from cStringIO import StringIO
+    import data
+    test_collection = 'ChangeTest'
+    delete_collection(test_collection)
+    docs = get_collection(test_collection)
+    for el in data.iter_shaped("../example.osm"):
+        docs.insert(el)
+    osc = """<?xml version='1.0' encoding='UTF-8'?>
+<osmChange version="0.6">
+  <modify>
+    <node id="261114295" version="8" changeset="1" timestamp="2014-01-01T00:00:00Z" user="x" uid="1" lat="41.9730791" lon="-87.6866303">
+      <tag k="amenity" v="cafe"/>
+    </node>
+    <node id="261114296" version="6" changeset="1" timestamp="2014-01-01T00:00:00Z" user="x" uid="1" lat="41.9730416" lon="-87.6878512"/>
+  </modify>
+  <delete>
+    <node id="261114299" version="5" changeset="1" timestamp="2014-01-01T00:00:00Z" user="x" uid="1" lat="41.9729565" lon="-87.6939548"/>
+  </delete>
+  <create>
+    <node id="1" version="1" changeset="1" timestamp="2014-01-01T00:00:00Z" user="x" uid="1" lat="41.97" lon="-87.68"/>
+  </create>
+</osmChange>"""
+    before = docs.find().count()
+    # Cached by find_name's node_refs lookups (and not shared with other collections)
+    assert isinstance(resolve_node_refs(docs, [["261114299"]])[0][0], dict)
+    assert resolve_node_refs(get_collection(test_collection + "Other"), [["261114299"]]) == [["261114299"]]
+    counts = apply_change_file(StringIO(osc), docs)
+    pprint.pprint(counts)
+    assert counts == { "create" : 1, "modify" : 1, "delete" : 1, "skipped" : 1 }
+    assert docs.find().count() == before
+    assert docs.find_one({ "type" : "node", "id" : "261114295" })['amenity'] == 'cafe'
+    assert docs.find_one({ "type" : "node", "id" : "261114299" }) is None
+    assert resolve_node_refs(docs, [["261114299"]]) == [["261114299"]]
+    # Applying the same changes again skips all of them
+    counts = apply_change_file(StringIO(osc), docs)
+    assert counts['skipped'] == 4
+    delete_collection(test_collection)
+
+    # Reloading the extract
+    docs = get_collection(test_collection)
+    total = sum(1 for _ in data.iter_shaped("../example.osm"))
+    counts = reload_file("../example.osm", docs, batch_size=7)
+    assert counts == { "create" : total, "modify" : 0, "delete" : 0, "unchanged" : 0 }
+    ids = set(doc['_id'] for doc in docs.find())
+    assert reload_file("../example.osm", docs, batch_size=7)['unchanged'] == total
+    assert set(doc['_id'] for doc in docs.find()) == ids
+    docs.update({ "type" : "node", "id" : "261114295" }, { "$set" : { "created.version" : "1" } })
+    docs.insert({ "type" : "node", "id" : "1", "created" : { "version" : "1" } })
+    counts = reload_file("../example.osm", docs, batch_size=7)
+    assert counts == { "create" : 0, "modify" : 1, "delete" : 1, "unchanged" : total - 1 }
+    assert docs.find().count() == total and docs.find_one({ "id" : "1" }) is None
+    delete_collection(test_collection)
+
+    # A collection with way geometry keeps it on the modified ways
+    import os
+    import shutil
+    import tempfile
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        osm_file = os.path.join(tmp_dir, "example_sf.osm")
+        shutil.copy("../example_sf.osm", osm_file)
+        docs = get_collection(test_collection)
+        reload_file(osm_file, docs, way_geometry=True)
+        way = docs.find_one({ "type" : "way", "geometry" : { "$exists" : 1 } })
+        docs.update({ "_id" : way['_id'] }, { "$set" : { "created.version" : "0" },
+                                             "$unset" : { "geometry" : 1, "bbox" : 1 } })
+        counts = reload_file(osm_file, docs, way_geometry=True)
+        assert counts['modify'] == 1
+        reloaded = docs.find_one({ "type" : "way", "id" : way['id'] })
+        assert reloaded['geometry'] == way['geometry'] and reloaded['bbox'] == way['bbox']
+        assert reloaded['pos'] == way['pos']
+        delete_collection(test_collection)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    test()
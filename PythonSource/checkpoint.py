@@ -0,0 +1,45 @@
+"""
+Checkpoint file for resumable imports (data.mongo_process_map with checkpoint=True).
+
+After each chunk of the .osm file has been written to MongoDB, the import
+records where it got to in a small json file next to the input file:
+    offset     byte offset of the next (unprocessed) element in the input file
+    count      number of documents shaped from the file before that offset
+    last_id    id of the last document written
+    file_size  size of the input file, so a checkpoint isn't resumed on a different file
+The file is replaced atomically (written to a temporary file, then renamed),
+so a crash while saving leaves the previous checkpoint intact.
+
+>>> import checkpoint
+>>> checkpoint.load_checkpoint(checkpoint.checkpoint_path("../san-francisco.osm"))
+{u'count': 1250000, u'file_size': 730234342, u'last_id': u'368171652', u'offset': 285212843}
+"""
+import json
+import os
+
+
+def checkpoint_path(file_in):
+    return "{0}.checkpoint.json".format(file_in)
+
+
+def load_checkpoint(path):
+    """Returns the saved checkpoint, or None if there isn't one"""
+    if not os.path.exists(path):
+        return None
+    with open(path) as fi:
+        return json.load(fi)
+
+
+def save_checkpoint(path, state):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as fo:
+        json.dump(state, fo)
+        fo.flush()
+        os.fsync(fo.fileno())
+    os.rename(tmp_path, path)
+
+
+def clear_checkpoint(path):
+    """Removes the checkpoint (once the import has finished)"""
+    if os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,362 @@
+"""
+Transparent reading of compressed .osm files (.osm.gz / .osm.bz2), so the
+full dataset doesn't have to be kept uncompressed on disk.
+
+osm_open(file_in) returns a file object for any .osm file, detected by its
+first bytes (not the extension):
+- uncompressed files are opened as usual
+- gzip and bzip2 files are decompressed on a background thread (zlib and bz2
+  release the GIL while decompressing), feeding the parser through a bounded
+  queue of decompressed chunks, so parsing and decompressing overlap
+- multi-stream bzip2 files (i.e. from pbzip2 or lbzip2, which compress every
+  900KB block as its own stream) are split at the stream boundaries and
+  decompressed in parallel across worker processes, in file order
+
+parsers.iter_elements (and so data.iter_shaped), mapparser, users, tags, audit,
+scan and changes all open their input with osm_open (opened_osm).  Compressed files can't
+be split into byte ranges, so parallel shaping and checkpointed imports need
+an uncompressed file (the decompression itself is already parallel).
+
+>>> with osm_open("../san-francisco.osm.bz2") as fo:
+...     data = fo.read(1024)
+"""
+import bz2
+import mmap
+import multiprocessing
+import os
+import Queue
+import re
+import threading
+import zlib
+from collections import deque
+from contextlib import contextmanager
+
+#OSMFILE = "../example.osm"
+OSMFILE = "../example_sf.osm"
+#OSMFILE = "../san-francisco.osm"
+
+GZIP = 'gzip'
+BZIP2 = 'bzip2'
+MAGIC = [ ('\x1f\x8b', GZIP),
+          ('BZh', BZIP2) ]
+
+# Compressed bytes read at a time, and decompressed chunks buffered ahead of the parser
+READ_SIZE = 1024 * 1024
+BUFFER_CHUNKS = 16
+# Compressed bytes per task when decompressing multi-stream bzip2 files in parallel
+BZ2_TASK_SIZE = 4 * 1024 * 1024
+
+# Each bzip2 stream starts with 'BZh' + block size, then the first block's magic
+# (pi), or the end of stream magic (sqrt(pi)) if the stream is empty
+bz2_stream_re = re.compile(r'BZh[1-9](?:1AY&SY|\x17rE8P\x90)')
+BZ2_EOS_MAGIC = 0x177245385090
+
+
+def compression(file_in):
+    """GZIP or BZIP2 if the file is compressed, else None"""
+    with open(file_in, 'rb') as fi:
+        start = fi.read(3)
+    for magic, kind in MAGIC:
+        if start.startswith(magic):
+            return kind
+    return None
+
+
+def is_compressed(file_in):
+    return isinstance(file_in, basestring) and compression(file_in) is not None
+
+
+def osm_open(file_in, workers=None):
+    """File object for reading the (possibly compressed) file.  File objects
+    are returned as is.  workers is the number of processes used for multi-stream
+    bzip2 files (default cpu_count, 1 decompresses on the background thread only)."""
+    if not isinstance(file_in, basestring):
+        return file_in
+    kind = compression(file_in)
+    if kind == GZIP:
+        return DecompressedFile(file_in, iter_gzip)
+    if kind == BZIP2:
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if workers > 1:
+            ranges = bz2_task_ranges(file_in)
+            if len(ranges) > 1:
+                return DecompressedFile(file_in, lambda path: iter_bz2_parallel(path, ranges, workers))
+        return DecompressedFile(file_in, iter_bz2)
+    return open(file_in, 'rb')
+
+
+@contextmanager
+def opened_osm(file_in, workers=None):
+    """osm_open for a with statement, only closing the file if it was opened here
+    (file objects passed in are left open for the caller)"""
+    fo = osm_open(file_in, workers)
+    try:
+        yield fo
+    finally:
+        if fo is not file_in:
+            fo.close()
+
+
+def iter_gzip(file_in):
+    """(decompressed chunk, compressed bytes read) of a gzip file (including
+    files of several gzip members)"""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    with open(file_in, 'rb') as fi:
+        while True:
+            data = fi.read(READ_SIZE)
+            if not data:
+                break
+            while data:
+                chunk = decompressor.decompress(data)
+                if chunk:
+                    yield chunk, fi.tell()
+                data = decompressor.unused_data
+                if data:
+                    # Start of the next member
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk, fi.tell()
+
+
+def iter_bz2(file_in):
+    """(decompressed chunk, compressed bytes read) of a bzip2 file (including
+    multi-stream files)"""
+    decompressor = bz2.BZ2Decompressor()
+    with open(file_in, 'rb') as fi:
+        while True:
+            data = fi.read(READ_SIZE)
+            if not data:
+                break
+            while data:
+                try:
+                    chunk = decompressor.decompress(data)
+                except EOFError:
+                    # Previous stream ended exactly at the end of the last read
+                    decompressor = bz2.BZ2Decompressor()
+                    continue
+                if chunk:
+                    yield chunk, fi.tell()
+                data = decompressor.unused_data
+                if data:
+                    decompressor = bz2.BZ2Decompressor()
+
+
+def decompress_bz2(data):
+    """Decompresses whole bzip2 streams, raising ValueError if the last is incomplete"""
+    out = []
+    while data:
+        decompressor = bz2.BZ2Decompressor()
+        out.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+    try:
+        decompressor.decompress('')
+    except EOFError:
+        return ''.join(out)
+    raise ValueError("Incomplete bzip2 stream")
+
+
+def decompress_bz2_range(args):
+    file_in, start, end = args
+    with open(file_in, 'rb') as fi:
+        fi.seek(start)
+        return decompress_bz2(fi.read(end - start))
+
+
+def is_stream_end(data, offset):
+    """Whether a bzip2 stream ends just before offset: the end of stream magic
+    and 32 bit crc end 0-7 (padding) bits before the byte boundary"""
+    if offset < 11:
+        return False
+    last_bits = int(data[offset - 11:offset].encode('hex'), 16)
+    for pad in range(8):
+        if (last_bits >> (pad + 32)) & 0xffffffffffff == BZ2_EOS_MAGIC:
+            return True
+    return False
+
+
+def bz2_stream_offsets(file_in):
+    """Byte offsets of the streams in a bzip2 file.  A stream header can also
+    appear by chance within the compressed data, so each one has to follow
+    the end of the previous stream."""
+    offsets = [0]
+    if os.path.getsize(file_in) == 0:
+        return offsets
+    with open(file_in, 'rb') as fi:
+        data = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for match in bz2_stream_re.finditer(data, 1):
+                if is_stream_end(data, match.start()):
+                    offsets.append(match.start())
+        finally:
+            data.close()
+    return offsets
+
+
+def bz2_task_ranges(file_in, task_size=BZ2_TASK_SIZE):
+    """(start, end) byte ranges of whole streams, of at least task_size bytes each
+    (unless the file is a single stream)"""
+    offsets = bz2_stream_offsets(file_in) + [os.path.getsize(file_in)]
+    ranges = []
+    start = 0
+    for offset in offsets[1:]:
+        if offset - start >= task_size or offset == offsets[-1]:
+            ranges.append((start, offset))
+            start = offset
+    return ranges
+
+
+def iter_bz2_parallel(file_in, ranges, workers):
+    """(decompressed chunk, compressed bytes read) of a multi-stream bzip2 file,
+    each range of streams decompressed in a worker process (only a few ranges
+    ahead of the reader)"""
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = deque()
+        for start, end in ranges:
+            pending.append((end, pool.apply_async(decompress_bz2_range, ((file_in, start, end),))))
+            if len(pending) >= 2 * workers:
+                end, result = pending.popleft()
+                yield result.get(), end
+        while pending:
+            end, result = pending.popleft()
+            yield result.get(), end
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class DecompressedFile(object):
+    """Read only file object of the chunks from chunks(file_in), which are
+    produced on a background thread up to buffer_chunks ahead of the reader.
+    raw_bytes_read is how far through the compressed file the chunks read
+    so far came from (i.e. for progress reports)."""
+
+    def __init__(self, file_in, chunks, buffer_chunks=BUFFER_CHUNKS):
+        self.name = file_in
+        self.raw_bytes_read = 0
+        self.queue = Queue.Queue(maxsize=buffer_chunks)
+        self.buffer = ''
+        self.offset = 0
+        self.done = False
+        self.closed = False
+        self.error = None
+        self.thread = threading.Thread(target=self._run, args=(chunks, file_in))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, chunks, file_in):
+        produced = chunks(file_in)
+        try:
+            for item in produced:
+                if not self._put(item):
+                    produced.close()
+                    return
+        except Exception as e:
+            self.error = e
+        self._put(None)
+
+    def _put(self, item):
+        """Queues the item, returns False if the file was closed while waiting"""
+        while not self.closed:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _next_chunk(self):
+        item = self.queue.get()
+        if item is None:
+            self.done = True
+            if self.error is not None:
+                raise self.error
+            return ''
+        chunk, self.raw_bytes_read = item
+        return chunk
+
+    def read(self, size=-1):
+        if self.done:
+            return ''
+        if size is None or size < 0:
+            parts = [self.buffer[self.offset:]]
+            while not self.done:
+                parts.append(self._next_chunk())
+            self.buffer, self.offset = '', 0
+            return ''.join(parts)
+        # Full reads (like a regular file) until the end, even across chunks
+        parts = []
+        while size > 0 and not self.done:
+            if self.offset >= len(self.buffer):
+                self.buffer, self.offset = self._next_chunk(), 0
+                continue
+            data = self.buffer[self.offset:self.offset + size]
+            self.offset += len(data)
+            size -= len(data)
+            parts.append(data)
+        return ''.join(parts)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def test():
+    import gzip
+    import shutil
+    import tempfile
+    with open(OSMFILE, 'rb') as fi:
+        expected = fi.read()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        gz_path = os.path.join(tmp_dir, "test.osm.gz")
+        with gzip.open(gz_path, 'wb') as fo:
+            fo.write(expected)
+        bz2_path = os.path.join(tmp_dir, "test.osm.bz2")
+        with open(bz2_path, 'wb') as fo:
+            fo.write(bz2.compress(expected))
+        # Multi-stream, as pbzip2 writes them
+        multi_path = os.path.join(tmp_dir, "multi.osm.bz2")
+        with open(multi_path, 'wb') as fo:
+            for i in range(0, len(expected), 2000):
+                fo.write(bz2.compress(expected[i:i + 2000]))
+        assert compression(OSMFILE) is None
+        assert compression(gz_path) == GZIP and compression(bz2_path) == BZIP2
+        assert len(bz2_stream_offsets(multi_path)) == (len(expected) + 1999) // 2000
+        parallel = lambda path: iter_bz2_parallel(path, bz2_task_ranges(path, 2000), 3)
+        assert len(bz2_task_ranges(multi_path, 2000)) > 1
+        for fo, path in [(osm_open(gz_path), gz_path), (osm_open(bz2_path), bz2_path),
+                         (osm_open(multi_path, 1), multi_path),
+                         (DecompressedFile(multi_path, parallel), multi_path)]:
+            with fo:
+                parts = []
+                while True:
+                    data = fo.read(4096)
+                    if not data:
+                        break
+                    parts.append(data)
+            assert ''.join(parts) == expected
+            assert fo.raw_bytes_read == os.path.getsize(path)
+        with DecompressedFile(multi_path, parallel) as fo:
+            assert fo.read() == expected
+        # Closing before the end stops the background thread
+        fo = DecompressedFile(multi_path, parallel, buffer_chunks=1)
+        fo.read(10)
+        fo.close()
+        print "Decompressed %d bytes from gzip, bzip2 and multi-stream bzip2"%(len(expected))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    test()
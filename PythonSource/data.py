@@ -87,14 +87,30 @@ should be turned into
 """
 from pymongo import MongoClient
 import xml.etree.ElementTree as ET
+from cStringIO import StringIO
+from collections import deque
+import json
+import multiprocessing
+import os
 import pprint
 import re
-import codecs
-import json
-from audit import mapping, city_mapping, normalize_capitalization, \
-    street_type_re, update_name, update_city, default_city
+import time
+from audit import mapping, city_mapping, default_city, street_type_re, \
+    cached_normalize_capitalization as normalize_capitalization, \
+    cached_update_name as update_name, cached_update_city as update_city
 from mongo_audit import client, db, get_collection, delete_collection, \
     size_of_collection, check_collection_exists
+from bulk_writer import BulkWriter, DEFAULT_BATCH_SIZE, DEFAULT_BATCH_BYTES, DEFAULT_WRITERS
+from sinks import write_file, insert_mongo, JSON, BSON_DUMP, SHARD_BY_ID
+from parsers import iter_elements, DEFAULT_PARSER
+from compressed import is_compressed, opened_osm
+from pbf import is_pbf, iter_pbf, iter_blobs, iter_pool, decode_blob
+from nodestore import NodeStore, build_node_store, is_current
+from checkpoint import checkpoint_path, load_checkpoint, save_checkpoint, clear_checkpoint
+from dog_query import classify_dog, DOG_FIELD, DOG_CATEGORY_FIELD
+from name_search import add_name_search, NAME_FOLDED_FIELD, NAME_GRAMS_FIELD
+from stats import PipelineStats, ProgressFile, Sampler
+from records import RecordList
 
 #OSMFILE = "../example.osm"
 #OSMFILE = "../example_sf.osm"
@@ -104,22 +120,45 @@ lower = re.compile(r'^([a-z]|_)*$')
 lower_colon = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
 problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 skip_colon = re.compile(r'^((sfgov)|(.*_ca)|(gosm)|(massgis)):')
+name_re = re.compile(r'name', re.IGNORECASE)
 
 CREATED = [ "version", "changeset", "timestamp", "user", "uid"]
 NAMES = [ "alt_name", "name_1", "old_name" ]
-RESERVED_KEYS = [ "address", "name", "tiger", "created", "gnis", "pos", "id" ]
+RESERVED_KEYS = [ "address", "name", "tiger", "created", "gnis", "pos", "id", "geometry", "bbox",
+                  DOG_FIELD, DOG_CATEGORY_FIELD, NAME_FOLDED_FIELD, NAME_GRAMS_FIELD ]
+
+# Parallel shaping splits the file into byte ranges starting on a top level element
+element_start_re = re.compile(r'<(?:node|way|relation)[\s/>]')
+PARALLEL_CHUNK_SIZE = 32 * 1024 * 1024
+BOUNDARY_READ_SIZE = 1024 * 1024
+# Bytes of the file imported between checkpoints, and ids per $in query when resuming
+CHECKPOINT_CHUNK_SIZE = 8 * 1024 * 1024
+EXISTING_CHUNK_SIZE = 1000
+
+# Counts of the tags seen and cleaning done while shaping (in this process),
+# reported by PipelineStats (see stats.py)
+shape_counts = { "tags" : 0, "key_fixes" : 0, "capitalization_fixes" : 0, "street_fixes" : 0,
+                 "city_fixes" : 0, "problem_keys" : 0, "skipped_keys" : 0 }
+
+def shape_counts_since(before):
+    """Change in each of the shape_counts since before (a copy of them)"""
+    return dict((name, shape_counts[name] - before[name]) for name in shape_counts)
+
+def reset_shape_counts():
+    for name in shape_counts:
+        shape_counts[name] = 0
 
 def node_way_shape(key, val, node):
     """Helper function to shape key/value pairs in top level node/way tag"""
     # Created array
     if key in CREATED:
-        if 'created' not in node.keys():
+        if 'created' not in node:
             node['created'] = {}
         node['created'].update( {key:val} )
     elif key == 'lat' or key == 'lon':
         # Remove spaces from invalid data
         val = float(re.sub('\s','',val.strip()))
-        if 'pos' not in node.keys():
+        if 'pos' not in node:
             node['pos'] = [val]
         elif key == 'lon':
             node['pos'].insert(0, val)
@@ -129,92 +168,215 @@ def node_way_shape(key, val, node):
         node[key] = val
     return node
     
-def colon_clean(key, val, node):
-    """Performs the shaping and cleaning for keys with a ':'
-    in their names.  Handles a variety of cases by ensuring protected
-    keys are not overwritten or reformatted improperly.  In general, 
-    creates nested dictionaries with the first part preceding the colon
-    as the top level key, and string following the colon will be the nested dictionary
-    key values."""
+def add_to_group(node, group, key, val):
+    """Adds key/val to the node's nested dictionary named group"""
+    if group not in node:
+        node[group] = {key:val}
+    else:
+        node[group].update( {key:val} )
+    return node
+
+def shape_problem(node, key, val, arg1, arg2, debug):
+    if debug: print "PROBLEM key: %s, val: %s"%(key,val)
+    shape_counts['problem_keys'] += 1
+    return node
+
+def shape_skip(node, key, val, arg1, arg2, debug):
+    shape_counts['skipped_keys'] += 1
+    return node
+
+def shape_name(node, key, val, arg1, arg2, debug):
+    # Handling 'name' since it is in RESERVED_KEYS
+    node[key] = val
+    return node
+
+def shape_group(node, key, val, group, nested_key, debug):
+    # Alternate names (or names in different languages), 'tiger:' and 'gnis:' keys
+    return add_to_group(node, group, nested_key, val)
+
+def shape_pos(node, key, val, arg1, arg2, debug):
+    parsed_pos = re.search(r'(-?\w*\d*\.\d*)',val)
+    if parsed_pos is not None:
+        float_val = float(parsed_pos.group())
+        val = float_val
+        if 'pos' not in node:
+            node['pos'] = [val]
+        elif len(node['pos']) == 1:
+            if key == 'longitude':
+                node['pos'].insert(0,val)
+            else: # 'latitude'
+                node['pos'].append(val)
+            # else: Ignore latitude/longitude (already set by attrib in top level node)
+    else:
+        print 'WARNING: Regex failed for %s=%s'%(key,val)
+    return node
+
+def shape_address(node, key, val, addr_key, arg2, debug):
+    # For all address values, capitalize only the first character of each word
+    fixed_val = normalize_capitalization(val)
+    if fixed_val != val:
+        shape_counts['capitalization_fixes'] += 1
+        val = fixed_val
+    if addr_key == "city":
+        fixed_city = update_city(val, city_mapping)
+        if fixed_city != val: 
+            print val, "=>", fixed_city
+            shape_counts['city_fixes'] += 1
+            val = fixed_city
+    #Defaults to having 'San Francisco' as city name
+    elif "address" not in node:
+        node['address'] = {'city':default_city}
+    elif "city" not in node['address']:
+        node['address'].update({'city':default_city})
+    if addr_key == "street":
+        fixed_name = update_name(val, mapping)
+        if fixed_name != val: 
+            print val, "=>", fixed_name
+            shape_counts['street_fixes'] += 1
+            val = fixed_name
+    return add_to_group(node, 'address', addr_key, val)
+
+def shape_skip_colon(node, key, val, arg1, arg2, debug):
+    # These keys have garbage values, don't store them
+    # Examples of keys that are skipped:
+    #  'redwood_city_ca:addr_id', 'rwc_ca:buildingid', 'paloalto_ca:id'
+    #  'gosm:sig:8CBDE645', 'massgis:cat'
+    print 'Skip colon match: %s=%s'%(key,val)
+    shape_counts['skipped_keys'] += 1
+    return node
+
+def shape_note_address(node, key, val, arg1, arg2, debug):
+    # Key 'note:address' contains a street address, save it
+    val = update_name(val, mapping)
+    if 'address' not in node:
+        node['address'] = {'street':val}
+    elif 'street' not in node['address']:
+        node['address'].update({'street':val})
+    else:
+        node['address'].update({'street_address':val})
+    return node
+
+def shape_nested(node, key, val, dict_key, nested_key, debug):
+    #if debug: print "Other (%s) key: %s, val: %s"%(key,nested_key,val)
+    if dict_key not in node:
+        node[dict_key] = {nested_key:val}
+    else:
+        if isinstance(node[dict_key],dict):
+            node[dict_key].update({nested_key:val})
+        else:
+            # Convert to dict (use orig outer dict_key with '_key'
+            # appended as the nested key for the original value
+            node[dict_key] = {dict_key+'_key':node[dict_key], nested_key:val}
+    return node
+
+def shape_reserved(node, key, val, arg1, arg2, debug):
+    if debug: print "Reserved key: %s, val: %s"%(key,val)
+    # Change the key or add to dict structure
+    if key == 'address' or key == 'created':
+        return add_to_group(node, key, key+'_key', val)
+    node[key+'key'] = val
+    return node
+
+def shape_plain(node, key, val, arg1, arg2, debug):
+    #if debug: print "Adding key: %s, val: %s"%(key,val)
+    node[key] = val
+    return node
+
+def classify_colon_key(key):
+    """Works out how colon_clean should handle a key containing a ':'.
+    Returns a (handler, arg1, arg2) tuple, where the handler is called with
+    (node, key, val, arg1, arg2, debug) to shape the key/value pair"""
     if len(key) > 5 and key[:5] == 'name:':
         # Create array of alternate names (or names in different languages)
-        key = key[5:]
-        if 'other_names' not in node.keys():
-            node['other_names'] = {key:val}
-        else:
-            node['other_names'].update( {key:val} )
+        return shape_group, 'other_names', key[5:]
     elif len(key) > 5 and key[:5] == 'addr:':
-        # For all address values, capitalize only the first character of each word
-        val = normalize_capitalization(val)
-        key = key[5:]
-        if lower_colon.search(key) is None:
-            if key == "city":
-                fixed_city = update_city(val, city_mapping)
-                if fixed_city != val: 
-                    print val, "=>", fixed_city
-                    val = fixed_city
-            #Defaults to having 'San Francisco' as city name
-            elif "address" not in node.keys():
-                node['address'] = {'city':default_city}
-            elif "city" not in node['address'].keys():
-                node['address'].update({'city':default_city})
-            if key == "street":
-                fixed_name = update_name(val, mapping)
-                if fixed_name != val: 
-                    print val, "=>", fixed_name
-                    val = fixed_name
-            if 'address' not in node.keys():
-                node['address'] = {key:val}
-            else:
-                node['address'].update({key:val})
+        if lower_colon.search(key[5:]) is None:
+            return shape_address, key[5:], None
         # Ignore keys with more than 1 colon (and starting with "addr:")
+        return shape_skip, None, None
     elif len(key) > 6 and key[:6] == 'tiger:':
-        key = key[6:]
         # Skips 'Tiger:MTFCC' keys
-        if key == 'mtfcc':
-            return node
-        if 'tiger' not in node.keys():
-            node['tiger'] = {key:val}
-        else:
-            node['tiger'].update({key:val})
+        if key[6:] == 'mtfcc':
+            return shape_skip, None, None
+        return shape_group, 'tiger', key[6:]
     elif len(key) > 5 and key[:5] == 'gnis:':
-        key = key[5:]
-        if 'gnis' not in node.keys():
-            node['gnis'] = {key:val}
-        else:
-            node['gnis'].update({key:val})
+        return shape_group, 'gnis', key[5:]
     elif skip_colon.search(key) is not None:
-        # These keys have garbage values, don't store them
-        # Examples of keys that are skipped:
-        #  'redwood_city_ca:addr_id', 'rwc_ca:buildingid', 'paloalto_ca:id'
-        #  'gosm:sig:8CBDE645', 'massgis:cat'
-        print 'Skip colon match: %s=%s'%(key,val)
-        return node
+        return shape_skip_colon, None, None
+    dict_key,nested_key = key.split(":",1) # Only create dict with first part of key
+    if nested_key in RESERVED_KEYS:
+        if dict_key == 'note' and nested_key == 'address':
+            return shape_note_address, None, None
+        # Skipping 'source:name'
+        return shape_skip, None, None
+    return shape_nested, dict_key, nested_key
+
+def classify_key(key):
+    """Works out how tag_shape should handle the (standardized) key, which only
+    depends on the key itself and not the value or the rest of the element.
+    Returns a (handler, fixed key, is name key, arg1, arg2) tuple"""
+    if problemchars.search(key) is not None:
+        return shape_problem, key, False, None, None
+    if key[-1] == ':':
+        # remove trailing ':' from key
+        key = key[:-1]
+    # For all name keys, capitalize only the first character of each word (value)
+    is_name = name_re.search(key) is not None
+    if key == 'name':
+        handler, arg1, arg2 = shape_name, None, None
+    elif key in NAMES:
+        handler, arg1, arg2 = shape_group, 'other_names', key
+    elif key == 'latitude' or key == 'longitude':
+        handler, arg1, arg2 = shape_pos, None, None
+    elif ':' in key:
+        handler, arg1, arg2 = get_colon_plan(key)
+    elif key in RESERVED_KEYS:
+        handler, arg1, arg2 = shape_reserved, None, None
     else:
-        dict_key,nested_key = key.split(":",1) # Only create dict with first part of key
-        if nested_key in RESERVED_KEYS:
-            # Key 'note:address' contains a street address, save it
-            if dict_key == 'note' and nested_key == 'address':
-                val = update_name(val, mapping)
-                if 'address' not in node.keys():
-                    node['address'] = {'street':val}
-                elif 'street' not in node['address'].keys():
-                    node['address'].update({'street':val})
-                else:
-                    node['address'].update({'street_address':val})
-            # Skipping 'source:name'
-            return node
-        #if debug: print "Other (%s) key: %s, val: %s"%(key,nested_key,val)
-        if dict_key not in node.keys():
-            node[dict_key] = {nested_key:val}
-        else:
-            if isinstance(node[dict_key],dict):
-                node[dict_key].update({nested_key:val})
-            else:
-                # Convert to dict (use orig outer dict_key with '_key'
-                # appended as the nested key for the original value
-                node[dict_key] = {dict_key+'_key':node[dict_key], nested_key:val}
-    return node
+        handler, arg1, arg2 = shape_plain, None, None
+    return handler, key, is_name, arg1, arg2
+
+# Keys repeat a lot (i.e. 'building', 'addr:street', 'tiger:cfcc'), so each
+# distinct key is only classified once and the resulting plan is reused.
+# Some keys are open ended (i.e. 'name:<language>', per import/source keys), so
+# a cache is emptied once it has KEY_PLAN_CACHE_SIZE plans (the common keys are
+# classified again straight away, and hits stay a plain dictionary lookup, which
+# an LRUCache would slow down by ~40%).
+KEY_PLAN_CACHE_SIZE = 10000
+key_plans = {}
+colon_key_plans = {}
+
+def get_key_plan(key):
+    plan = key_plans.get(key)
+    if plan is None:
+        if len(key_plans) >= KEY_PLAN_CACHE_SIZE:
+            key_plans.clear()
+        plan = key_plans[key] = classify_key(key)
+    return plan
+
+def get_colon_plan(key):
+    plan = colon_key_plans.get(key)
+    if plan is None:
+        if len(colon_key_plans) >= KEY_PLAN_CACHE_SIZE:
+            colon_key_plans.clear()
+        plan = colon_key_plans[key] = classify_colon_key(key)
+    return plan
+
+def clear_key_plans():
+    """Needs to be called if any of the lists/regular expressions used to
+    classify keys (i.e. RESERVED_KEYS, skip_colon) are changed"""
+    key_plans.clear()
+    colon_key_plans.clear()
+    
+def colon_clean(key, val, node, debug=False):
+    """Performs the shaping and cleaning for keys with a ':'
+    in their names.  Handles a variety of cases by ensuring protected
+    keys are not overwritten or reformatted improperly.  In general, 
+    creates nested dictionaries with the first part preceding the colon
+    as the top level key, and string following the colon will be the nested dictionary
+    key values."""
+    handler, arg1, arg2 = get_colon_plan(key)
+    return handler(node, key, val, arg1, arg2, debug)
     
 def tag_shape(key, val, node, debug=False):
     """Helper function to shape key/value pairs in child tag.
@@ -225,60 +387,18 @@ def tag_shape(key, val, node, debug=False):
     after the first colon as the nested dictionary key (part before the colon is 
     the top level key).
     Expects calling function to convert key to lowercase and
-    trim leading/trailing spaces."""
-    if problemchars.search(key) is None:
-        if key[-1] == ':':
-            # remove trailing ':' from key
-            print 'Fixing %s key -> %s=%s'%(key,key[:-1],val)
-            key = key[:-1]
-        
-        if re.search('name',key,re.IGNORECASE) is not None:
-            # For all name keys, capitalize only the first character of each word (value)
-            val = normalize_capitalization(val)
-        if key == 'name':
-            # Handling 'name' since it is in RESERVED_KEYS
-            node[key] = val
-        elif key in NAMES:
-            # Create array of alternate names (or names in different languages)
-            if 'other_names' not in node.keys():
-                node['other_names'] = {key:val}
-            else:
-                node['other_names'].update( {key:val} )
-        elif key == 'latitude' or key == 'longitude':
-            parsed_pos = re.search(r'(-?\w*\d*\.\d*)',val)
-            if parsed_pos is not None:
-                float_val = float(parsed_pos.group())
-                val = float_val
-                if 'pos' not in node.keys():
-                    node['pos'] = [val]
-                elif len(node['pos']) == 1:
-                    if key == 'longitude':
-                        node['pos'].insert(0,val)
-                    else: # 'latitude'
-                        node['pos'].append(val)
-                    # else: Ignore latitude/longitude (already set by attrib in top level node)
-            else:
-                print 'WARNING: Regex failed for %s=%s'%(key,val)
-        # Handles all keys with a colon
-        elif re.search(":",key) is not None:
-            return colon_clean(key, val, node)
-        else:
-            #if debug: print "Adding key: %s, val: %s"%(key,val)
-            if key in RESERVED_KEYS:
-                if debug: print "Reserved key: %s, val: %s"%(key,val)
-                # Change the key or add to dict structure
-                if key == 'address' or key == 'created':
-                    if key not in node.keys():
-                        node[key] = {key+'_key':val}
-                    else:
-                        node[key].update({key+'_key':val})
-                else:
-                    node[key+'key'] = val
-            else:
-                node[key] = val
-    else:
-        if debug: print "PROBLEM key: %s, val: %s"%(key,val)
-    return node
+    trim leading/trailing spaces.
+    How each key is handled is looked up from key_plans (see classify_key)."""
+    handler, fixed_key, is_name, arg1, arg2 = get_key_plan(key)
+    if fixed_key != key:
+        print 'Fixing %s key -> %s=%s'%(key,fixed_key,val)
+        shape_counts['key_fixes'] += 1
+    if is_name:
+        fixed_val = normalize_capitalization(val)
+        if fixed_val != val:
+            shape_counts['capitalization_fixes'] += 1
+            val = fixed_val
+    return handler(node, fixed_key, val, arg1, arg2, debug)
 
 
 def standardize_key(key):
@@ -299,89 +419,546 @@ def shape_element(element):
             node = node_way_shape(standardize_key(key), val, node)
         
         for tag in element.iter('tag'):
-            if 'k' in tag.attrib.keys() and 'v' in tag.attrib.keys():
+            shape_counts['tags'] += 1
+            if 'k' in tag.attrib and 'v' in tag.attrib:
                 node = tag_shape(standardize_key(tag.attrib['k']), tag.attrib['v'], node, True)
             else:
                 print "Invalid tag element attrib: %s"%(element.attrib)
         
-        for nd in element.iter('nd'):
-            if 'ref' in nd.attrib.keys():
-                val = nd.attrib['ref']
-                if 'node_refs' not in node.keys():
-                    node['node_refs'] = [val]
-                else:
-                    node['node_refs'].append(val)
-                        
+        node_refs = [nd.attrib['ref'] for nd in element.iter('nd') if 'ref' in nd.attrib]
+        if node_refs:
+            node['node_refs'] = node_refs
+
+        # Adds the indexed dog_related/dog_category fields (see dog_query.py)
+        classify_dog(node)
+        # and the name_folded/name_grams fields for find_name (see name_search.py)
+        add_name_search(node)
         return node
         
     else:
         return None
 
 
-def process_map(file_in, pretty = False):
+def iter_shaped(file_in, workers=None, chunk_size=PARALLEL_CHUNK_SIZE, parser=DEFAULT_PARSER):
+    """Generator of the shaped node/way documents in the file (a filename or
+    file object).  Each element (and anything before it under the root) is
+    cleared as soon as it has been shaped, so memory use stays flat no matter
+    how large the file is.  If workers is specified, the shaping is split
+    across that many processes (see parallel_shape, filenames only).
+    parser selects the xml parser backend ('etree', 'expat' or 'lxml', see parsers.py).
+    Compressed files (.gz/.bz2, see compressed.py) are always shaped in this process,
+    as they can't be split up (multi-stream .bz2 files are decompressed in parallel).
+    .osm.pbf files (see pbf.py) are split into their blocks instead of byte ranges.
+    The output can be passed to any of the sinks in sinks.py."""
+    if workers and is_pbf(file_in):
+        for el in parallel_shape_pbf(file_in, workers):
+            yield el
+        return
+    if workers and not is_compressed(file_in):
+        for el in parallel_shape(file_in, workers, chunk_size, parser):
+            yield el
+        return
+    for elem in iter_elements(file_in, parser):
+        el = shape_element(elem)
+        if el:
+            yield el
+
+
+def add_way_geometry(shaped, node_store):
+    """Generator that adds the positions of each way's nodes to the shaped way
+    documents (looked up from the NodeStore, see nodestore.py):
+    'geometry': list of [lon, lat] of the way's nodes (those found in the store)
+    'bbox': [[min lon, min lat], [max lon, max lat]]
+    'pos': centroid [lon, lat] of the way's nodes, unless the way already has a pos
+    so that ways (i.e. parks) can be found by geo queries on pos, same as nodes"""
+    for el in shaped:
+        if el['type'] == 'way' and el.get('node_refs'):
+            coords, found = node_store.lookup_many(el['node_refs'])
+            coords = coords[found]
+            if len(coords):
+                el['geometry'] = coords.tolist()
+                el['bbox'] = [coords.min(axis=0).tolist(), coords.max(axis=0).tolist()]
+                if len(el.get('pos', [])) != 2:
+                    if len(coords) > 1 and found[0] and found[-1] and \
+                       el['node_refs'][0] == el['node_refs'][-1]:
+                        # Closed way, don't count the first node twice
+                        coords = coords[:-1]
+                    el['pos'] = coords.mean(axis=0).tolist()
+        yield el
+
+
+def get_node_store(file_in, node_store_path=None, parser=DEFAULT_PARSER):
+    """Loads the NodeStore saved at node_store_path (memory-mapped), or builds it
+    from a first pass through the file (saving it there if a path is given).
+    A saved store is rebuilt if file_in has changed since (size or modification time)."""
+    if node_store_path is not None and is_current(node_store_path, file_in):
+        return NodeStore.load(node_store_path)
+    if node_store_path is not None and os.path.exists(node_store_path + ".ids.npy"):
+        print "%s has changed, rebuilding the node store %s"%(file_in, node_store_path)
+    store = build_node_store(file_in, parser)
+    if node_store_path is not None:
+        store.save(node_store_path, file_in)
+        return NodeStore.load(node_store_path)
+    return store
+
+
+def iter_shaped_with_geometry(file_in, node_store_path=None, workers=None, parser=DEFAULT_PARSER):
+    """Two passes through the file, the first builds a NodeStore of all the node
+    positions (saved to/loaded from node_store_path, so only the pages needed are
+    kept in memory), the second shapes the elements and adds the way geometry
+    (see add_way_geometry)"""
+    node_store = get_node_store(file_in, node_store_path, parser)
+    return add_way_geometry(iter_shaped(file_in, workers, parser=parser), node_store)
+
+
+def find_element_start(fo, offset):
+    """Returns the byte offset of the first node/way/relation start tag
+    at or after offset, or None if there aren't any left in the file"""
+    fo.seek(offset)
+    overlap = ''
+    pos = offset
+    while True:
+        block = fo.read(BOUNDARY_READ_SIZE)
+        if not block:
+            return None
+        buf = overlap + block
+        m = element_start_re.search(buf)
+        if m:
+            return pos - len(overlap) + m.start()
+        # Keep the end of the block in case a start tag is split across reads
+        overlap = buf[-10:]
+        pos += len(block)
+
+
+def split_osm_file(file_in, chunk_size=PARALLEL_CHUNK_SIZE, start=None):
+    """Splits the file into (start, end) byte ranges of roughly chunk_size bytes,
+    where each range begins on a top level element (so it can be parsed on its own).
+    Also returns the header (everything before the first element, i.e. the
+    xml declaration and opening <osm> tag), needed to parse each range.
+    If start is given, the ranges begin at the first element at or after that offset."""
+    if is_compressed(file_in) or is_pbf(file_in):
+        raise ValueError("%s isn't an uncompressed .osm file, it can't be split into byte ranges"%(file_in))
+    with open(file_in, 'rb') as fo:
+        first = find_element_start(fo, 0)
+        if first is None:
+            return '', []
+        fo.seek(0)
+        header = fo.read(first)
+        # Ranges stop at the closing </osm> tag
+        fo.seek(0, 2)
+        size = fo.tell()
+        fo.seek(max(0, size - 4096))
+        tail = fo.read()
+        close_pos = tail.rfind('</osm>')
+        body_end = size - len(tail) + close_pos if close_pos >= 0 else size
+
+        if start is not None:
+            first = find_element_start(fo, max(start, first))
+            if first is None or first >= body_end:
+                return header, []
+        starts = [first]
+        while True:
+            next_start = find_element_start(fo, starts[-1] + chunk_size)
+            if next_start is None or next_start >= body_end:
+                break
+            starts.append(next_start)
+    return header, zip(starts, starts[1:] + [body_end])
+
+
+def shape_byte_range(args):
+    """Worker function for parallel_shape: parses one byte range of the file
+    (wrapped in the file's header and a closing </osm> tag) and returns the
+    list of shaped elements, and the shape_counts of shaping them"""
+    file_in, header, start, end, parser = args
+    with open(file_in, 'rb') as fo:
+        fo.seek(start)
+        chunk = fo.read(end - start)
+    before = dict(shape_counts)
+    shaped = list(iter_shaped(StringIO(header + chunk + '</osm>'), parser=parser))
+    return shaped, shape_counts_since(before)
+
+
+def iter_shaped_ranges(file_in, header, ranges, workers=None, parser=DEFAULT_PARSER):
+    """Generator of (start, end, list of shaped elements) for each byte range
+    (from split_osm_file), in order.  If workers is specified the ranges are shaped
+    across a pool of that many processes, with only a couple of ranges per worker
+    held in memory at a time."""
+    if not workers:
+        for start, end in ranges:
+            yield start, end, shape_byte_range((file_in, header, start, end, parser))[0]
+        return
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = deque()
+        for start, end in ranges:
+            pending.append((start, end,
+                pool.apply_async(shape_byte_range, ((file_in, header, start, end, parser),))))
+            if len(pending) >= 2 * workers:
+                start, end, result = pending.popleft()
+                yield start, end, merge_shape_counts(result.get())
+        while pending:
+            start, end, result = pending.popleft()
+            yield start, end, merge_shape_counts(result.get())
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def merge_shape_counts(result):
+    """Adds the shape_counts from a worker's shape_byte_range result to this
+    process's counts, returns the shaped elements"""
+    shaped, counts = result
+    for name, n in counts.iteritems():
+        shape_counts[name] += n
+    return shaped
+
+
+def parallel_shape(file_in, workers=None, chunk_size=PARALLEL_CHUNK_SIZE, parser=DEFAULT_PARSER):
+    """Shapes the file across a pool of worker processes (defaults to one per cpu),
+    each shaping a separate byte range of the file.  Yields the shaped elements
+    in the same order as parsing the file serially."""
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    header, ranges = split_osm_file(file_in, chunk_size)
+    for start, end, shaped in iter_shaped_ranges(file_in, header, ranges, workers, parser):
+        for el in shaped:
+            yield el
+
+
+def shape_pbf_blob(blob):
+    """Worker function for parallel_shape_pbf: decodes and shapes one block of an
+    .osm.pbf file, returns the list of shaped elements and the shape_counts of shaping them"""
+    before = dict(shape_counts)
+    shaped = [el for el in (shape_element(elem) for elem in decode_blob(blob)) if el]
+    return shaped, shape_counts_since(before)
+
+
+def iter_shaped_blocks(file_in, workers):
+    """Generator of (bytes read, list of shaped elements) for each block of the
+    .osm.pbf file (a filename or file object), shaped across a pool of workers"""
+    for result in iter_pool(shape_pbf_blob, iter_blobs(file_in), workers):
+        yield getattr(file_in, 'bytes_read', None), merge_shape_counts(result)
+
+
+def parallel_shape_pbf(file_in, workers=None):
+    """Same as parallel_shape for .osm.pbf files, each worker decoding
+    and shaping whole blocks of the file"""
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    for end, shaped in iter_shaped_blocks(file_in, workers):
+        for el in shaped:
+            yield el
+
+
+def count_element(stats, tag):
+    stats.count(tag if tag in ("node", "way", "relation") else "other_element")
+
+
+def iter_shaped_stats(file_in, stats, workers=None, chunk_size=PARALLEL_CHUNK_SIZE, parser=DEFAULT_PARSER):
+    """Same as iter_shaped (filenames only), recording the time spent parsing and
+    shaping, the elements by type and the shape_counts in stats (a PipelineStats),
+    and its progress through the file.  With workers, the parsing and shaping
+    happens in the worker processes, timed together as 'shape' (the time
+    waiting for each chunk), and only the shaped node/way elements are counted."""
+    before = dict(shape_counts)
+    try:
+        if workers and is_pbf(file_in):
+            with open(file_in, 'rb') as fo:
+                progress_file = ProgressFile(fo)
+                for el in timed_chunks(iter_shaped_blocks(progress_file, workers), stats):
+                    yield el
+            return
+        if workers and not is_compressed(file_in):
+            header, ranges = split_osm_file(file_in, chunk_size)
+            chunks = ((end, shaped) for start, end, shaped in
+                      iter_shaped_ranges(file_in, header, ranges, workers, parser))
+            for el in timed_chunks(chunks, stats):
+                yield el
+            return
+        with opened_osm(file_in) as fo:
+            progress_file = ProgressFile(fo)
+            if is_pbf(file_in):
+                elements = iter_pbf(progress_file)
+            else:
+                elements = iter_elements(progress_file, parser)
+            while True:
+                start_time = time.time()
+                try:
+                    elem = next(elements)
+                except StopIteration:
+                    break
+                shape_time = time.time()
+                el = shape_element(elem)
+                stats.add_time('parse', shape_time - start_time)
+                stats.add_time('shape', time.time() - shape_time)
+                count_element(stats, elem.tag)
+                # Compressed files report progress through the compressed bytes
+                stats.progress(getattr(fo, 'raw_bytes_read', progress_file.bytes_read))
+                if el:
+                    yield el
+    finally:
+        stats.update_counts(shape_counts_since(before))
+
+
+def timed_chunks(chunks, stats):
+    """Shaped elements of each (byte offset, list of shaped elements) chunk, recording
+    the time waiting for each chunk as 'shape' time and the progress in stats"""
+    while True:
+        start_time = time.time()
+        try:
+            end, shaped = next(chunks)
+        except StopIteration:
+            break
+        stats.add_time('shape', time.time() - start_time)
+        for el in shaped:
+            count_element(stats, el['type'])
+            yield el
+        stats.progress(end)
+
+
+def skip_existing(shaped, docs):
+    """Filters out the shaped elements whose (type, id) is already in the collection
+    (i.e. written by an import that was interrupted before its next checkpoint)"""
+    existing = set()
+    ids = [el['id'] for el in shaped]
+    for i in range(0, len(ids), EXISTING_CHUNK_SIZE):
+        for doc in docs.find({ "id" : { "$in" : ids[i:i + EXISTING_CHUNK_SIZE] } },
+                             { "_id" : 0, "type" : 1, "id" : 1 }):
+            existing.add((doc.get('type'), doc.get('id')))
+    return [el for el in shaped if (el['type'], el['id']) not in existing]
+
+
+def checkpointed_insert(file_in, docs, resume=False, workers=None, chunk_size=CHECKPOINT_CHUNK_SIZE,
+                        batch_size=DEFAULT_BATCH_SIZE, batch_bytes=DEFAULT_BATCH_BYTES,
+                        verbose=False, parser=DEFAULT_PARSER, node_store=None, stats=None,
+                        writers=DEFAULT_WRITERS):
+    """Inserts the file into the collection one chunk (byte range) at a time, saving a
+    checkpoint (see checkpoint.py) once each chunk has been written.  With resume, an
+    interrupted import continues from the element boundary after the last checkpoint,
+    skipping any documents from the following chunk that were already written.
+    The checkpoint is removed once the whole file has been imported.
+    stats (a PipelineStats) records the time shaping and writing each chunk.
+    Returns the BulkWriter, for its stats/report."""
+    path = checkpoint_path(file_in)
+    file_size = os.path.getsize(file_in)
+    state = load_checkpoint(path) if resume else None
+    if state is not None and state.get('file_size') != file_size:
+        raise ValueError("Checkpoint %s does not match %s (file size changed)"%(path, file_in))
+    if state is not None:
+        print "Resuming at byte %d of %d, %d documents already written (last id %s)"%(state['offset'],\
+            file_size, state['count'], state['last_id'])
+        header, ranges = split_osm_file(file_in, chunk_size, state['offset'])
+        count, last_id = state['count'], state['last_id']
+    else:
+        if resume:
+            print "No checkpoint found, starting from the beginning"
+        header, ranges = split_osm_file(file_in, chunk_size)
+        count, last_id = 0, None
+    writer = BulkWriter(docs, batch_size, batch_bytes, verbose=verbose, writers=writers)
+    before = dict(shape_counts)
+    chunks = iter_shaped_ranges(file_in, header, ranges, workers, parser)
+    try:
+        while True:
+            start_time = time.time()
+            try:
+                start, end, shaped = next(chunks)
+            except StopIteration:
+                break
+            if stats is not None:
+                stats.add_time('shape', time.time() - start_time)
+                for el in shaped:
+                    count_element(stats, el['type'])
+            count += len(shaped)
+            if shaped:
+                last_id = shaped[-1]['id']
+            if node_store is not None:
+                shaped = list(add_way_geometry(shaped, node_store))
+            if state is not None:
+                # Only the chunk after the checkpoint can have been partially written
+                shaped = skip_existing(shaped, docs)
+                state = None
+            start_time = time.time()
+            for el in shaped:
+                writer.insert(el)
+            writer.sync()
+            save_checkpoint(path, { "offset" : end, "count" : count, "last_id" : last_id,
+                                    "file_size" : file_size })
+            if stats is not None:
+                stats.add_time('insert', time.time() - start_time)
+                stats.progress(end)
+    finally:
+        writer.close()
+        if stats is not None:
+            stats.update_counts(shape_counts_since(before))
+            stats.add_time('write', sum(t for _, _, t in writer.batch_stats))
+            stats.count('docs_written', writer.num_written())
+    clear_checkpoint(path)
+    return writer
+
+
+def process_map(file_in, pretty = False, workers = None, keep_data = True, parser = DEFAULT_PARSER,
+                way_geometry = False, output = JSON, encode_workers = None, shards = None,
+                shard_by = SHARD_BY_ID):
     """Default (provided from class) way to read
-    the file and iteratively build an element tree with
-    all the elements, shaping them as the tree is built,
-    and iteratively writing the shaped data to a json file,
-    potentially in a prettied format"""
-    file_out = "{0}.json".format(file_in)
-    data = []
-    with codecs.open(file_out, "w") as fo:
-        for _, element in ET.iterparse(file_in):
-            el = shape_element(element)
-            if el:
-                data.append(el)
-                if pretty:
-                    fo.write(json.dumps(el, indent=2)+"\n")
-                else:
-                    fo.write(json.dumps(el) + "\n")
-    return data
+    the file and shape the elements, iteratively writing the
+    shaped data to a json file, potentially in a prettied format.
+    output BSON_DUMP ('bson') writes a <file_in>.bson dump for mongorestore instead,
+    and encode_workers encodes the output in that many processes (see sinks.py).
+    shards splits the output into that many <file_in>.<shard>.json/.bson files by
+    id (or shard_by 'type' one file per element type), which loader.load_files
+    can import in parallel.
+    Returns the list of all the shaped data (held as compact records, see
+    records.py, but still a memory hog for large files),
+    or if keep_data is False only the number of documents written
+    (use iter_shaped directly to stream the documents somewhere else).
+    If workers is specified, the shaping is split across that many processes
+    (see parallel_shape), output is the same as the serial parse.
+    parser selects the xml parser backend (see parsers.py).
+    way_geometry adds node positions to ways (see iter_shaped_with_geometry)."""
+    if way_geometry:
+        shaped = iter_shaped_with_geometry(file_in, file_in + ".nodes", workers, parser)
+    else:
+        shaped = iter_shaped(file_in, workers, parser=parser)
+    if keep_data:
+        data = RecordList()
+        write_file(data.keeping(shaped), file_in, output, pretty, encode_workers, shards, shard_by)
+        return data
+    return write_file(shaped, file_in, output, pretty, encode_workers, shards, shard_by)
   
-def mongo_process_map(file_in,print_only=None):
+def mongo_process_map(file_in,print_only=None,workers=None,batch_size=DEFAULT_BATCH_SIZE,\
+                      batch_bytes=DEFAULT_BATCH_BYTES,verbose=False,parser=DEFAULT_PARSER,\
+                      way_geometry=False,checkpoint=False,resume=False,stats=False,profile=None,\
+                      writers=DEFAULT_WRITERS):
     """Iteratively parse file and read into mongoDB incrementally,
-    clearing elements as they are read in."""
-    context = ET.iterparse(file_in, events=("start", "end"))
-    context = iter(context) # make iterator
-    event, root = context.next() # get the root element
+    clearing elements as they are read in.
+    If workers is specified, the shaping is split across that many processes.
+    Documents are written in unordered bulk inserts of up to batch_size documents
+    (or batch_bytes of BSON) from background threads, with up to writers batches
+    written at once and transient errors retried, see bulk_writer.py.
+    verbose prints the latency and throughput of each batch as it is written.
+    parser selects the xml parser backend (see parsers.py).
+    way_geometry adds node positions to ways (see iter_shaped_with_geometry).
+    checkpoint saves the progress after every chunk of the file is written, so that
+    an interrupted import can be continued with resume (see checkpointed_insert).
+    stats prints the time spent in each stage, elements/tags per second and the
+    cleaning counts (see stats.py), with progress and an ETA every few seconds,
+    and saves them as json to <file_in>.stats.json (or stats, if it is a filename).
+    profile runs the import under a profiler: 'cprofile' (saved to <file_in>.prof)
+    or 'sample' (the low overhead Sampler, added to the stats json)."""
+    if profile not in (None, 'cprofile', 'sample'):
+        raise ValueError("Unknown profile %s, expected 'cprofile' or 'sample'"%(profile))
+    pipeline_stats = None
+    if stats or profile:
+        pipeline_stats = PipelineStats(total_bytes=os.path.getsize(file_in))
+    sampler = Sampler() if profile == 'sample' else None
+    if profile == 'cprofile':
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        docs = profiler.runcall(run_mongo_process_map, file_in, print_only, workers, batch_size,
+                                batch_bytes, verbose, parser, way_geometry, checkpoint, resume,
+                                pipeline_stats, writers)
+        profiler.dump_stats(file_in + ".prof")
+        print "Profile saved to %s"%(file_in + ".prof")
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+    else:
+        if sampler is not None:
+            sampler.start()
+        try:
+            docs = run_mongo_process_map(file_in, print_only, workers, batch_size, batch_bytes,
+                                         verbose, parser, way_geometry, checkpoint, resume,
+                                         pipeline_stats, writers)
+        finally:
+            if sampler is not None:
+                sampler.stop()
+    if pipeline_stats is not None:
+        pipeline_stats.finish()
+        pipeline_stats.report()
+        if sampler is not None:
+            sampler.report()
+        stats_out = stats if isinstance(stats, basestring) else file_in + ".stats.json"
+        stats_dict = pipeline_stats.to_dict()
+        if sampler is not None:
+            stats_dict['profile'] = sampler.to_dict()
+        with open(stats_out, "w") as fo:
+            json.dump(stats_dict, fo, indent=2, sort_keys=True)
+        print "Stats saved to %s"%(stats_out)
+    return docs
+
+def run_mongo_process_map(file_in, print_only, workers, batch_size, batch_bytes, verbose, parser,
+                          way_geometry, checkpoint, resume, stats, writers=DEFAULT_WRITERS):
+    """mongo_process_map, recording the stats (a PipelineStats) if not None"""
     docs = get_collection()
-    for event, elem in context:
-        if event == "end":
-            el = shape_element(elem)
-            if el:
-                if print_only:
-                    pprint.pprint(el)
-                else:
-                    docs.insert(el)
-                # clear element once end event of node/way has been shaped and read in
-                elem.clear()
-        root.clear() # delete root (no useful info)
+    if (checkpoint or resume) and not print_only:
+        node_store = None
+        if way_geometry:
+            node_store = get_node_store(file_in, file_in + ".nodes", parser)
+        writer = checkpointed_insert(file_in, docs, resume, workers, batch_size=batch_size,
+                                     batch_bytes=batch_bytes, verbose=verbose, parser=parser,
+                                     node_store=node_store, stats=stats, writers=writers)
+        writer.report()
+        return docs
+    if stats is not None:
+        shaped = iter_shaped_stats(file_in, stats, workers, parser=parser)
+        if way_geometry:
+            shaped = add_way_geometry(shaped, get_node_store(file_in, file_in + ".nodes", parser))
+    elif way_geometry:
+        shaped = iter_shaped_with_geometry(file_in, file_in + ".nodes", workers, parser)
+    else:
+        shaped = iter_shaped(file_in, workers, parser=parser)
+    if print_only:
+        for el in shaped:
+            pprint.pprint(el)
+        return docs
+    writer = insert_mongo(shaped, docs, batch_size, batch_bytes, verbose, stats, writers)
+    writer.report()
     return docs  
 
-def import_to_mongodb(data,clear_all=False):
-    """Inserts the data to the MongoDB collection.
+def import_to_mongodb(data,clear_all=False,writers=DEFAULT_WRITERS,reload=False,way_geometry=False):
+    """Inserts the data to the MongoDB collection (in bulk inserts,
+    see bulk_writer.py).
+    reload instead upserts only the new/changed documents and deletes the ones
+    not in data, without emptying the collection (see changes.reload_docs).
+    way_geometry adds the positions of the OSMFILE nodes to the ways in data
+    (see add_way_geometry), needed to reload a collection loaded with way_geometry.
     Make sure MongoDB is started, i.e.:
     mongod --dbpath /Users/cminnich/data/db/
     Alternatively, can use command line import of
     .json file after it is saved to a file, i.e.:
     mongoimport --dbpath /Users/cminnich/data/db/ -d OpenStreetMaps -c SanFrancisco --file san-francisco.osm.json
     """
-    if clear_all:
+    if clear_all and not reload:
         delete_collection()
         print "DB Emptied!"
     docs = get_collection()
     print "Before: %d documents"%(docs.find().count())
-    docs.insert(data) # Batch insert
+    if way_geometry:
+        data = add_way_geometry(data, get_node_store(OSMFILE, OSMFILE + ".nodes"))
+    if reload:
+        import changes
+        pprint.pprint(changes.reload_docs(data, docs))
+    else:
+        insert_mongo(data, docs, writers=writers).report()
     print "After: %d documents"%(docs.find().count())
 
-def test(overwite_collection = False):
+def test(overwite_collection = False, reload = False, way_geometry = False):
     """if the input parameter overwite_collection is not specified (changed from False default),
     then the existing collections will be deleted and overwritten by the
-    reprocessed OSMFILE data"""
+    reprocessed OSMFILE data.
+    reload updates the existing collection in place instead (only writing what
+    changed, see changes.reload_file), so it can still be queried meanwhile.
+    way_geometry adds the node positions to the ways (see iter_shaped_with_geometry)."""
+    if reload:
+        import changes
+        docs = get_collection()
+        changes.reload_file(OSMFILE, docs, way_geometry=way_geometry)
+        print 'Now has %d documents in collection'%(docs.find().count())
+        return
     if overwite_collection:
         if check_collection_exists():
             print 'Deleting existing collection'
             delete_collection()
-    docs = mongo_process_map(OSMFILE,skip_mongo)
+    docs = mongo_process_map(OSMFILE,skip_mongo,way_geometry=way_geometry)
     if docs:
         print 'Now has %d documents in collection'%(docs.find().count())
     
@@ -418,7 +995,126 @@ def test_1():
                     
         else:
             print "WARNING: No data!"
+
+def test_parallel(workers = 4):
+    """Parallel shaping (in small chunks) should produce exactly the serial output"""
+    serial = process_map(OSMFILE)
+    header, ranges = split_osm_file(OSMFILE, 2048)
+    print "Split into %d byte ranges"%(len(ranges))
+    parallel = list(parallel_shape(OSMFILE, workers, 2048))
+    assert parallel == serial
+    assert process_map(OSMFILE, workers=workers) == serial
+    assert list(iter_shaped(OSMFILE, workers, 2048)) == serial
+
+def test_way_geometry():
+    """Geometry, bbox and centroid pos of ways, including closed ways whose
+    closing node isn't in the NodeStore"""
+    from nodestore import NodeStoreBuilder
+    builder = NodeStoreBuilder()
+    for node_id, lon, lat in [(1, 0.0, 0.0), (2, 2.0, 0.0), (3, 2.0, 2.0), (4, 0.0, 2.0)]:
+        builder.add(node_id, lon, lat)
+    store = builder.finish()
+    ways = [{'type' : 'way', 'id' : '10', 'node_refs' : ['1', '2', '3', '4', '1']},
+            {'type' : 'way', 'id' : '11', 'node_refs' : ['5', '2', '3', '5']},
+            {'type' : 'way', 'id' : '12', 'node_refs' : ['1', '2'], 'pos' : [5.0, 5.0]},
+            {'type' : 'way', 'id' : '13', 'node_refs' : ['5', '6']}]
+    closed, missing_end, with_pos, not_found = list(add_way_geometry(ways, store))
+    assert closed['geometry'] == [[0, 0], [2, 0], [2, 2], [0, 2], [0, 0]]
+    assert closed['bbox'] == [[0, 0], [2, 2]]
+    assert closed['pos'] == [1, 1]
+    # Only nodes 2 and 3 were found, both count towards the centroid
+    assert missing_end['geometry'] == [[2, 0], [2, 2]]
+    assert missing_end['pos'] == [2, 1]
+    assert with_pos['pos'] == [5, 5]
+    assert 'geometry' not in not_found and 'pos' not in not_found
+    # Tags can't overwrite the added fields
+    for key in ('geometry', 'bbox'):
+        assert classify_key(key)[0] == shape_reserved
+
+def test_resume(chunk_size = 4096):
+    """Interrupts a checkpointed import part way through, then resumes it.
+    The collection should end up with every document exactly once."""
+    import checkpoint
+    test_collection = 'CheckpointTest'
+    delete_collection(test_collection)
+    docs = get_collection(test_collection)
+    expected = [(el['type'], el['id']) for el in iter_shaped(OSMFILE)]
+    saved = []
+    def interrupt(path, state):
+        checkpoint.save_checkpoint(path, state)
+        saved.append(state)
+        if len(saved) == 3:
+            # Simulate the next chunk being partially written before the crash
+            _, ranges = split_osm_file(OSMFILE, chunk_size, state['offset'])
+            start, end = ranges[0]
+            partial = shape_byte_range((OSMFILE, split_osm_file(OSMFILE)[0], start, end, DEFAULT_PARSER))[0]
+            docs.insert(partial[:len(partial)//2])
+            raise KeyboardInterrupt
+    global save_checkpoint
+    save_checkpoint = interrupt
+    try:
+        checkpointed_insert(OSMFILE, docs, chunk_size=chunk_size)
+    except KeyboardInterrupt:
+        print "Interrupted after %d documents"%(saved[-1]['count'])
+    finally:
+        save_checkpoint = checkpoint.save_checkpoint
+    assert load_checkpoint(checkpoint_path(OSMFILE)) == saved[-1]
+    checkpointed_insert(OSMFILE, docs, resume=True, chunk_size=chunk_size)
+    written = sorted((doc['type'], doc['id']) for doc in docs.find())
+    assert written == sorted(expected)
+    assert load_checkpoint(checkpoint_path(OSMFILE)) is None
+    print "Resumed import wrote all %d documents once"%(len(written))
+    delete_collection(test_collection)
+
+def benchmark_tag_shape(file_in = OSMFILE, repeat = 3):
+    """Micro-benchmark of tag_shape on every tag in the file, with the key plans
+    cached (normal use) vs. classifying the key again for every tag.
+    Prints the per tag time of each (best of repeat runs)."""
+    import sys
+    from timeit import default_timer
+    pairs = [(standardize_key(tag.attrib['k']), tag.attrib['v'])
+             for _, tag in ET.iterparse(file_in) if tag.tag == 'tag']
+    def run(cached):
+        stdout = sys.stdout
+        sys.stdout = StringIO() # hide the fixing/skipping printouts
+        try:
+            start = default_timer()
+            for key, val in pairs:
+                if not cached:
+                    clear_key_plans()
+                tag_shape(key, val, {'type':'node'})
+            return default_timer() - start
+        finally:
+            sys.stdout = stdout
+    uncached = min(run(False) for _ in range(repeat))
+    cached = min(run(True) for _ in range(repeat))
+    print "%d tags, %d distinct keys"%(len(pairs), len(key_plans))
+    print "Uncached: %.2f usec/tag"%(uncached/len(pairs)*1e6)
+    print "Cached:   %.2f usec/tag (%.1fx faster)"%(cached/len(pairs)*1e6, uncached/cached)
     
 
 if __name__ == "__main__":
-    test()
+    import sys
+    profile = None
+    writers = DEFAULT_WRITERS
+    shards = None
+    for arg in sys.argv[1:]:
+        if arg.startswith("--profile="):
+            profile = arg.split("=", 1)[1]
+        elif arg.startswith("--writers="):
+            writers = int(arg.split("=", 1)[1])
+        elif arg.startswith("--shards="):
+            shards = int(arg.split("=", 1)[1])
+    if "--reload" in sys.argv:
+        test(reload=True, way_geometry="--way_geometry" in sys.argv)
+    elif "--resume" in sys.argv:
+        mongo_process_map(OSMFILE, checkpoint=True, resume=True, stats="--stats" in sys.argv,
+                          profile=profile, writers=writers)
+    elif "--bson" in sys.argv or shards:
+        output = BSON_DUMP if "--bson" in sys.argv else JSON
+        print "Wrote %d documents"%(process_map(OSMFILE, keep_data=False, output=output, shards=shards))
+    elif "--stats" in sys.argv or profile or writers != DEFAULT_WRITERS:
+        mongo_process_map(OSMFILE, stats="--stats" in sys.argv or profile is not None,
+                          profile=profile, writers=writers)
+    else:
+        test()
@@ -0,0 +1,163 @@
+"""
+The dog-related query used by mongo_audit.py, along with matches_query, which
+evaluates that query (the subset of the MongoDB query language it uses) against
+a shaped document in python.  This allows filtering shaped documents the same
+way MongoDB would (i.e. in spatial.py) without needing a running server.
+
+The query is also evaluated once per element while shaping (see classify_dog),
+and the result stored in the indexed dog_related/dog_category fields, so
+mongo_audit.py can query {"dog_related": True} (dog_indexed_qry) instead of
+running all the regular expressions over the whole collection.
+
+>>> from dog_query import dog_qry, matches_query
+>>> matches_query({"type": "node", "leisure": "dog_park"}, dog_qry)
+True
+"""
+import re
+
+any_char_re = re.compile(r".*\w+.*")
+dog_re = re.compile(r"(dog(?!patch))|(\bpup)|(\bpet(s|\b|\'))|(animal)|(canine)|(k9)|(\bvet(erinary|\b))", re.IGNORECASE)
+not_dog_amenities_re = re.compile(r"^((fast_food)|(pub)|(restaurant)|(cafe)|(parking))$", re.IGNORECASE)
+not_dog_names_re = re.compile(r"^.*rec(reation)?\s*ce?nte?r.*$", re.IGNORECASE)
+dog_park_re = re.compile(r".*((park)|(dog)).*", re.IGNORECASE)
+
+dog_qry ={"$and":[{ "amenity" : {"$not":not_dog_amenities_re}},
+                  { "name" : {"$not":not_dog_names_re}},
+                  {"$or":[{ "name" : dog_re },
+                          { "amenity" : dog_re },
+                          { "leisure" : dog_park_re },
+                          { "park" : any_char_re },
+                          { "park_type" : any_char_re },
+                          { "animal" : any_char_re },
+                          { "dog" : r'/.*[yY]es.*/' },
+                          { "grooming" : any_char_re },
+                          { "animal_shelter" : any_char_re },
+                          { "animal_shelter:adoption" : any_char_re}]}]}
+
+# Fields added to the shaped documents that match dog_qry,
+# dog_category is the field of the first $or condition that matched
+DOG_FIELD = 'dog_related'
+DOG_CATEGORY_FIELD = 'dog_category'
+dog_indexed_qry = { DOG_FIELD : True }
+
+dog_exclusions = dog_qry["$and"][:-1]
+dog_conditions = dog_qry["$and"][-1]["$or"]
+dog_condition_fields = [cond.keys()[0] for cond in dog_conditions]
+
+regex_type = type(any_char_re)
+
+
+def field_values(doc, field):
+    """Values of the (possibly dotted) field within the document, as a list
+    (empty if the field doesn't exist, elements of the array if it's an array)"""
+    val = doc
+    for part in field.split('.'):
+        if not isinstance(val, dict) or part not in val:
+            return []
+        val = val[part]
+    if isinstance(val, list):
+        return val
+    return [val]
+
+
+def matches_field(doc, field, cond):
+    values = field_values(doc, field)
+    if isinstance(cond, dict):
+        for op, arg in cond.iteritems():
+            if op == '$not':
+                if matches_field(doc, field, arg):
+                    return False
+            elif op == '$exists':
+                if bool(values) != bool(arg):
+                    return False
+            elif op == '$size':
+                val = doc
+                for part in field.split('.'):
+                    val = val.get(part) if isinstance(val, dict) else None
+                if not isinstance(val, list) or len(val) != arg:
+                    return False
+            else:
+                raise ValueError("Unsupported query operator %s"%(op))
+        return True
+    if isinstance(cond, regex_type):
+        # Regular expressions only match strings (or strings within an array)
+        return any(isinstance(v, basestring) and cond.search(v) is not None for v in values)
+    return any(v == cond for v in values)
+
+
+def matches_query(doc, query):
+    """Whether the shaped document matches the query, supports $and/$or,
+    regular expressions, equality, and $not/$exists/$size"""
+    for key, cond in query.iteritems():
+        if key == '$and':
+            if not all(matches_query(doc, q) for q in cond):
+                return False
+        elif key == '$or':
+            if not any(matches_query(doc, q) for q in cond):
+                return False
+        elif not matches_field(doc, key, cond):
+            return False
+    return True
+
+
+def is_dog_related(doc):
+    return matches_query(doc, dog_qry)
+
+
+def query_fields(query):
+    """Set of the fields used in the query"""
+    fields = set()
+    for key, cond in query.iteritems():
+        if key in ('$and', '$or'):
+            for q in cond:
+                fields.update(query_fields(q))
+        else:
+            fields.add(key)
+    return fields
+
+
+def dog_category(doc):
+    """Field of the first dog query $or condition the document matches
+    (i.e. 'name', 'amenity', 'leisure'), or None if it isn't dog related"""
+    if not any(field in doc for field in dog_condition_fields):
+        return None
+    if not all(matches_query(doc, q) for q in dog_exclusions):
+        return None
+    for field, cond in zip(dog_condition_fields, dog_conditions):
+        if matches_query(doc, cond):
+            return field
+    return None
+
+
+def classify_dog(doc):
+    """Sets the dog_related and dog_category fields if the document matches the
+    dog query (removes them if it doesn't), returns the category"""
+    category = dog_category(doc)
+    if category is None:
+        doc.pop(DOG_FIELD, None)
+        doc.pop(DOG_CATEGORY_FIELD, None)
+    else:
+        doc[DOG_FIELD] = True
+        doc[DOG_CATEGORY_FIELD] = category
+    return category
+
+
+def test():
+    assert is_dog_related({"leisure": "dog_park"})
+    assert is_dog_related({"name": "Laurelwood Veterinary Clinic", "amenity": "veterinary"})
+    assert not is_dog_related({"name": "Dogpatch Cafe", "amenity": "cafe"})
+    assert not is_dog_related({"name": "Hot Dog Stand", "amenity": "fast_food"})
+    assert not is_dog_related({"name": "Mission Recreation Center", "leisure": "park"})
+    assert not is_dog_related({"leisure": {"leisure_key": "park"}})
+    assert is_dog_related({"name": ["Bark Park", "Dog Run"]})
+    assert dog_category({"name": "Alamo Square Dog Park", "leisure": "park"}) == "name"
+    assert dog_category({"leisure": "park"}) == "leisure"
+    doc = {"name": "Mission Recreation Center", "leisure": "park", DOG_FIELD: True}
+    assert classify_dog(doc) is None and DOG_FIELD not in doc
+    assert matches_query({"pos": [1.0, 2.0]}, {"pos": {"$size": 2}})
+    assert matches_query({"address": {"street": "Main Street"}}, {"address.street": any_char_re})
+    print "Dog query tests passed"
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,130 @@
+"""
+Parallel loading of output files (i.e. the shards from sinks.write_sharded, or
+data.process_map with shards) into MongoDB, each file in its own process with
+its own connection, so the server isn't left waiting on one client decoding
+json and sending one batch at a time.
+
+Each process reads its file (json lines or a .bson dump, by the extension) and
+writes it with a BulkWriter (see bulk_writer.py), and the aggregate docs/sec of
+all of them is reported at the end.  The result is the same collection as a
+single file import (or data.mongo_process_map), just loaded in a different order.
+
+>>> counts = sinks.write_sharded(data.iter_shaped(OSMFILE), OSMFILE, 4, sinks.BSON_DUMP)
+>>> load_files(sorted(counts), workers=4)
+Loaded 3218578 docs from 4 files in 61.2 sec: 52594 docs/sec
+"""
+import json
+import multiprocessing
+import time
+import pymongo
+from bson import decode_file_iter
+from bulk_writer import BulkWriter, DEFAULT_BATCH_SIZE, DEFAULT_WRITERS
+from mongo_audit import get_collection, delete_collection, default_collection_name
+
+MONGO_HOST = "localhost"
+MONGO_PORT = 27017
+DB_NAME = 'OpenStreetMaps'
+
+
+def iter_file_docs(path):
+    """Documents of a json lines or .bson file"""
+    if path.endswith(".bson"):
+        with open(path, "rb") as fi:
+            for doc in decode_file_iter(fi):
+                yield doc
+    else:
+        with open(path) as fi:
+            for line in fi:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def load_file(path, docs, batch_size=DEFAULT_BATCH_SIZE, writers=DEFAULT_WRITERS):
+    """Inserts the file's documents into the docs collection,
+    returns (path, number of documents, seconds)"""
+    start = time.time()
+    with BulkWriter(docs, batch_size, writers=writers) as writer:
+        for doc in iter_file_docs(path):
+            writer.insert(doc)
+    return path, writer.num_written(), time.time() - start
+
+
+def load_file_task(args):
+    """load_file in a worker process, with a new connection (a MongoClient
+    shouldn't be used across a fork)"""
+    path, collection_name, batch_size, writers = args
+    client = pymongo.MongoClient(MONGO_HOST, MONGO_PORT)
+    try:
+        return load_file(path, client[DB_NAME][collection_name], batch_size, writers)
+    finally:
+        client.close()
+
+
+def load_files(paths, collection_name=default_collection_name, workers=None,
+               batch_size=DEFAULT_BATCH_SIZE, writers=DEFAULT_WRITERS, verbose=True):
+    """Loads the files into the collection, workers files at a time (default
+    cpu_count, 1 loads them one after another in this process).
+    Returns the total number of documents loaded"""
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    start = time.time()
+    if workers <= 1:
+        docs = get_collection(collection_name)
+        results = (load_file(path, docs, batch_size, writers) for path in paths)
+    else:
+        pool = multiprocessing.Pool(min(workers, len(paths)) or 1)
+        results = pool.imap_unordered(load_file_task, [(path, collection_name, batch_size, writers)
+                                                       for path in paths])
+    total = 0
+    try:
+        for path, count, seconds in results:
+            total += count
+            if verbose:
+                print "  %s: %d docs in %.1f sec (%.0f docs/sec)"%(path, count, seconds,
+                                                                count / max(seconds, 1e-6))
+    finally:
+        if workers > 1:
+            pool.terminate()
+            pool.join()
+    elapsed = time.time() - start
+    if verbose:
+        print "Loaded %d docs from %d files in %.1f sec: %.0f docs/sec"%(total, len(paths), elapsed,
+                                                                      total / max(elapsed, 1e-6))
+    return total
+
+
+def test():
+    """Loads the example data from shards and from a single file, and checks
+    the two collections match"""
+    import os
+    import shutil
+    import tempfile
+    import data
+    import sinks
+    osm_file = "../example_sf.osm"
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        base = os.path.join(tmp_dir, os.path.basename(osm_file))
+        counts = sinks.write_sharded(data.iter_shaped(osm_file), base, 3, sinks.BSON_DUMP)
+        json_shards = sinks.write_sharded(data.iter_shaped(osm_file), base, None, sinks.JSON,
+                                          sinks.SHARD_BY_TYPE)
+        single = base + ".json"
+        sinks.write_json(data.iter_shaped(osm_file), single)
+        key = lambda doc: (doc['type'], doc['id'])
+        collections = []
+        for name, paths in [('LoaderTestSingle', [single]), ('LoaderTestShards', sorted(counts)),
+                            ('LoaderTestTypes', sorted(json_shards))]:
+            delete_collection(name)
+            assert load_files(paths, name, workers=1) == sum(counts.values())
+            collections.append(sorted(get_collection(name).find({}, { "_id" : 0 }), key=key))
+            delete_collection(name)
+        assert collections[0] == collections[1] == collections[2]
+        # Across processes (each with its own connection)
+        assert load_files(sorted(counts), 'LoaderTestShards', workers=3) == sum(counts.values())
+        delete_collection('LoaderTestShards')
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    test()
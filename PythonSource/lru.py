@@ -0,0 +1,195 @@
+"""
+Bounded least-recently-used cache, with hit/miss/eviction counters.
+
+Used to memoize the cleaning functions in audit.py (street and city values
+repeat heavily across the san-francisco.osm file), and anywhere else a bounded
+cache of recent results is needed.
+
+A cache can be tied to one or more TrackedDicts (i.e. audit.mapping) with
+validate(), which empties the cache whenever any of those dictionaries has been
+changed (or a different dictionary is passed in) since the cached results were computed.
+
+>>> cache = LRUCache(2)
+>>> cache.lookup('St.', update_name, 'St.', mapping)
+>>> cache.stats()
+"""
+
+# Fields of each link in the circular doubly linked list (oldest entry first)
+PREV, NEXT, KEY, RESULT = 0, 1, 2, 3
+MISSING = object()
+
+
+class TrackedDict(dict):
+    """Dictionary that counts how many times it has been modified (version),
+    so caches of results computed from it can tell when they are stale"""
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.version = 0
+
+    def __setitem__(self, key, val):
+        dict.__setitem__(self, key, val)
+        self.version += 1
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.version += 1
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self.version += 1
+
+    def setdefault(self, key, default=None):
+        self.version += 1
+        return dict.setdefault(self, key, default)
+
+    def pop(self, key, *args):
+        self.version += 1
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        self.version += 1
+        return dict.popitem(self)
+
+    def clear(self):
+        dict.clear(self)
+        self.version += 1
+
+
+class LRUCache(object):
+    """Caches up to maxsize results, evicting the least recently used one
+    once full (maxsize of 0 disables caching)"""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.cache = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+        self.sources = ()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __contains__(self, key):
+        return key in self.cache
+
+    def get(self, key, default=None):
+        """Returns the cached result for key (marking it as most recently used)"""
+        link = self.cache.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._move_to_end(link)
+        return link[RESULT]
+
+    def put(self, key, result):
+        link = self.cache.get(key)
+        if link is not None:
+            link[RESULT] = result
+            self._move_to_end(link)
+            return
+        if self.maxsize <= 0:
+            return
+        if len(self.cache) >= self.maxsize:
+            # Reuse the oldest link for the new entry
+            oldest = self.root[NEXT]
+            del self.cache[oldest[KEY]]
+            self.evictions += 1
+            oldest[KEY] = key
+            oldest[RESULT] = result
+            self.cache[key] = oldest
+            self._move_to_end(oldest)
+            return
+        last = self.root[PREV]
+        link = [last, self.root, key, result]
+        last[NEXT] = self.root[PREV] = self.cache[key] = link
+
+    def lookup(self, key, func, *args):
+        """Returns the cached result for key, or calls func(*args)
+        and caches the result if key isn't in the cache"""
+        result = self.get(key, MISSING)
+        if result is MISSING:
+            result = func(*args)
+            self.put(key, result)
+        return result
+
+    def _move_to_end(self, link):
+        link_prev, link_next = link[PREV], link[NEXT]
+        link_prev[NEXT] = link_next
+        link_next[PREV] = link_prev
+        last = self.root[PREV]
+        last[NEXT] = self.root[PREV] = link
+        link[PREV] = last
+        link[NEXT] = self.root
+
+    def discard(self, key):
+        """Removes key from the cache, if it's there"""
+        link = self.cache.pop(key, None)
+        if link is not None:
+            link[PREV][NEXT] = link[NEXT]
+            link[NEXT][PREV] = link[PREV]
+
+    def clear(self):
+        self.cache.clear()
+        self.root[:] = [self.root, self.root, None, None]
+
+    def resize(self, maxsize):
+        """Changes the bound, empties the cache"""
+        self.maxsize = maxsize
+        self.clear()
+
+    def validate(self, *sources):
+        """Empties the cache if any of the source TrackedDicts are different
+        objects, or have been modified, since the last call"""
+        if len(sources) != len(self.sources) or \
+           any(src is not old or src.version != version
+               for src, (old, version) in zip(sources, self.sources)):
+            if self.cache:
+                self.invalidations += 1
+                self.clear()
+            self.sources = tuple((src, src.version) for src in sources)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return { "hits" : self.hits,
+                 "misses" : self.misses,
+                 "evictions" : self.evictions,
+                 "invalidations" : self.invalidations,
+                 "size" : len(self.cache),
+                 "maxsize" : self.maxsize,
+                 "hit_rate" : float(self.hits)/lookups if lookups else 0.0 }
+
+
+def test():
+    cache = LRUCache(2)
+    assert cache.lookup('a', lambda: 1) == 1
+    assert cache.lookup('b', lambda: 2) == 2
+    assert cache.lookup('a', lambda: -1) == 1 # hit, 'b' is now the oldest
+    assert cache.lookup('c', lambda: 3) == 3 # evicts 'b'
+    assert 'b' not in cache and 'a' in cache and 'c' in cache
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 3
+    assert cache.stats()['evictions'] == 1
+    cache.discard('a')
+    cache.discard('missing')
+    assert 'a' not in cache and len(cache) == 1
+    assert cache.lookup('d', lambda: 4) == 4 and len(cache) == 2
+
+    cache = LRUCache(2)
+    mapping = TrackedDict({'St': 'Street'})
+    cache.validate(mapping)
+    cache.put('x', 1)
+    cache.validate(mapping)
+    assert 'x' in cache
+    mapping['Rd'] = 'Road'
+    cache.validate(mapping)
+    assert 'x' not in cache and cache.invalidations == 1
+    print cache.stats()
+
+
+if __name__ == '__main__':
+    test()
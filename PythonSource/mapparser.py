@@ -10,6 +10,7 @@ and number of times this tag can be encountered in the map as value.
 """
 import xml.etree.ElementTree as ET
 import pprint
+from compressed import opened_osm
 
 #OSMFILE = "../example.osm"
 OSMFILE = "../example_sf.osm"
@@ -19,12 +20,13 @@ def count_tags(filename):
     """Returns dictionary of different tags and corresponding count of how
     many times that tag was seen"""
     xml_dict = {}
-    context = ET.iterparse( filename )
-    for event, elem in context:
-        if elem.tag in xml_dict:
-            xml_dict[elem.tag] = xml_dict[elem.tag] + 1
-        else:
-            xml_dict.update({elem.tag : 1})
+    with opened_osm(filename) as osm_file:
+        context = ET.iterparse( osm_file )
+        for event, elem in context:
+            if elem.tag in xml_dict:
+                xml_dict[elem.tag] = xml_dict[elem.tag] + 1
+            else:
+                xml_dict.update({elem.tag : 1})
     return xml_dict
 
 def test():
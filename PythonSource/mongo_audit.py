@@ -102,28 +102,31 @@ Top 5 (non-required) fields ediyes has entered and the associated count
 import pymongo
 import pprint
 import re
-from audit import dog_re, dog_include_keys, not_dog_amenities
-
-any_char_re = re.compile(r".*\w+.*")
-dog_re = re.compile(r"(dog(?!patch))|(\bpup)|(\bpet(s|\b|\'))|(animal)|(canine)|(k9)|(\bvet(erinary|\b))", re.IGNORECASE)
-not_dog_amenities_re = re.compile(r"^((fast_food)|(pub)|(restaurant)|(cafe)|(parking))$", re.IGNORECASE)
-not_dog_names_re = re.compile(r"^.*rec(reation)?\s*ce?nte?r.*$", re.IGNORECASE)
-dog_park_re = re.compile(r".*((park)|(dog)).*", re.IGNORECASE)
-
-std_key_list = [ "created", "id", "node_refs", "type", "pos", "ele", "gnis" ]
-
-dog_qry ={"$and":[{ "amenity" : {"$not":not_dog_amenities_re}},
-                  { "name" : {"$not":not_dog_names_re}},
-                  {"$or":[{ "name" : dog_re },
-                          { "amenity" : dog_re },
-                          { "leisure" : dog_park_re },
-                          { "park" : any_char_re },
-                          { "park_type" : any_char_re },
-                          { "animal" : any_char_re },
-                          { "dog" : r'/.*[yY]es.*/' },
-                          { "grooming" : any_char_re },
-                          { "animal_shelter" : any_char_re },
-                          { "animal_shelter:adoption" : any_char_re}]}]}
+from audit import dog_include_keys, not_dog_amenities
+from dog_query import any_char_re, dog_re, not_dog_amenities_re, not_dog_names_re, \
+    dog_park_re, dog_qry, dog_indexed_qry, query_fields, dog_category, \
+    DOG_FIELD, DOG_CATEGORY_FIELD
+from lru import LRUCache
+from name_search import mongo_query, rank_docs, add_name_search, \
+    NAME_FOLDED_FIELD, NAME_GRAMS_FIELD
+
+std_key_list = [ "created", "id", "node_refs", "type", "pos", "ele", "gnis",
+                 DOG_FIELD, DOG_CATEGORY_FIELD, NAME_FOLDED_FIELD, NAME_GRAMS_FIELD ]
+DOG_CLASSIFY_BATCH_SIZE = 1000
+NAME_INDEX_BATCH_SIZE = 1000
+
+# Nodes found when resolving way node_refs, shared across calls (keyed by the
+# collection's full name and the node id, see forget_nodes for keeping it current)
+NODE_REF_CHUNK_SIZE = 1000
+NODE_REF_CACHE_SIZE = 100000
+node_ref_cache = LRUCache(NODE_REF_CACHE_SIZE)
+node_ref_projection = { "_id" : 0, "id" : 1, "pos" : 1, "name" : 1 }
+
+# Engines for the user/key count reports: server-side aggregation pipelines
+# (default, uses indexes for the $match), or the original javascript map_reduce
+AGGREGATE = 'aggregate'
+MAPREDUCE = 'mapreduce'
+default_engine = AGGREGATE
 
 client = pymongo.MongoClient("localhost",27017)
 db = client['OpenStreetMaps']
@@ -156,6 +159,11 @@ def create_indexes(docs):
     docs.ensure_index([("created.user",1),("name",1)])
     docs.ensure_index([("name",1)])
     docs.ensure_index([("id",1)])
+    # Dog-related documents (and by user), see reclassify_dogs
+    docs.ensure_index([(DOG_FIELD,1),("created.user",1)])
+    # Name search (find_name), name_grams is a multikey index of the name's trigrams
+    docs.ensure_index([(NAME_GRAMS_FIELD,1)])
+    docs.ensure_index([(NAME_FOLDED_FIELD,1)])
     
 def get_near_loc(lat,lon,docs):
     query = { "pos" : { "$near" : [ lon, lat ] } }
@@ -170,7 +178,7 @@ def get_nearby_dog_pipeline(near_loc,near_limit):
     near_limit is the maximum number of items returned"""
     agg_query = [{ "$geoNear" : { "near" : near_loc, 
                                   "distanceField" : "distance", 
-                                  "query" : dog_qry,
+                                  "query" : dog_indexed_qry,
                                   "limit" : near_limit,
                                   "maxDistance" : 0.05 } }]
     return agg_query
@@ -180,22 +188,13 @@ def get_dog_pipeline():
     Formats the output (using project) to only output a list of relevant fields.
     Requires some type of location, either pos (lon/lat)
     or street address in the matched values"""
-    aggregate_query = [ { "$match" : {"$and":[{"$or":[{ "pos" : {"$size":2} },
-                                                      { "address.street" : any_char_re }] },
-                                              { "amenity" : {"$not":not_dog_amenities_re}},
-                                              {"$or":[{ "name" : dog_re },
-                                                      { "amenity" : dog_re },
-                                                      { "leisure" : dog_park_re },
-                                                      { "park" : any_char_re },
-                                                      { "park_type" : any_char_re },
-                                                      { "animal" : any_char_re },
-                                                      { "dog" : r'/.*[yY]es.*/' },
-                                                      { "grooming" : any_char_re },
-                                                      { "animal_shelter" : any_char_re },
-                                                      { "animal_shelter:adoption" : any_char_re}]}] } },
+    aggregate_query = [ { "$match" : {"$and":[dog_indexed_qry,
+                                              {"$or":[{ "pos" : {"$size":2} },
+                                                      { "address.street" : any_char_re }] }] } },
                         { "$project" : { "_id" : 0, "name" : 1, "pos" : 1, "address" : 1, \
                                          "amenity" : 1, "leisure" : 1, "park" : 1, "park_type" : 1, \
-                                         "animal" : 1, "dog" : 1, "grooming" : 1, "animal_shelter" : 1, "animal_shelter:adoption" : 1}}]
+                                         "animal" : 1, "dog" : 1, "grooming" : 1, "animal_shelter" : 1, "animal_shelter:adoption" : 1, \
+                                         DOG_CATEGORY_FIELD : 1}}]
     
     return aggregate_query
     
@@ -217,8 +216,14 @@ def dog_related(docs,near_loc=None,near_limit=10):
         agg_query = get_dog_pipeline()
     else:
         agg_query = get_nearby_dog_pipeline(near_loc,near_limit)
-    loc_counts = docs.aggregate(agg_query)
-    return loc_counts['result']
+    return aggregate_result(docs.aggregate(agg_query))
+
+def aggregate_result(result):
+    """List of result documents from docs.aggregate, which is a dictionary
+    with the list in 'result' for older pymongo versions, or a cursor"""
+    if isinstance(result, dict):
+        return result['result']
+    return list(result)
     
 def find_pos(docs):
     """Number of documents with a positions ('pos') key [lat,long].
@@ -247,44 +252,146 @@ def find_parks(docs):
 def find_name(srch_str, docs, limit_results=5, printout=1):
     """Searches for and prints names that match the input
     srch_str, which is split apart by spaces (and will match
-    any characters in between words)"""
-    srch_str = '.*'+re.sub(r'\W','.*',srch_str)+'.*'
+    any characters in between words).  Case and accents are ignored,
+    and the name_grams index narrows down the names checked (see name_search.py).
+    Results are ranked, best match first."""
+    qry = mongo_query(srch_str)
+    if qry is None:
+        return []
     if printout:
-        print 'Regex: %s'%(srch_str)
-    custom_re = re.compile(srch_str,re.IGNORECASE)
-    # query = { "$and" : [{ "pos" :  { "$exists" : 1 } },
-                       # { "name" : custom_re }] }
-    result_limit = 5
-    results = docs.find({ "name" : custom_re },{ "_id" : 0 }).limit(limit_results)
+        print 'Query: %s'%(qry)
+    # Rank all the matches (only their name_folded is fetched), then fetch the top results
+    matches = docs.find(qry, { NAME_FOLDED_FIELD : 1 })
+    top_ids = [m['_id'] for m in rank_docs(matches, srch_str, limit_results)]
+    found = dict((r['_id'], r) for r in docs.find({ "_id" : { "$in" : top_ids } }))
+    result_list = []
+    for _id in top_ids:
+        # Skip any removed in between the queries (i.e. by a reload's sweep)
+        r = found.get(_id)
+        if r is None:
+            continue
+        del r['_id']
+        result_list.append(r)
     if printout:
         print 'Top %d Results: %s Search'%(limit_results,srch_str)
-    result_list = []
-    for r in results:
-        if r['type'] == 'way' and 'node_refs' in r.keys():
-            r['node_refs'] = node_ref_mapping(docs, r['node_refs'])
-        if printout:
+    # Resolve the node_refs of all the ways found together
+    ways = [r for r in result_list if r['type'] == 'way' and 'node_refs' in r.keys()]
+    mapped = resolve_node_refs(docs, [r['node_refs'] for r in ways])
+    for r, node_refs in zip(ways, mapped):
+        r['node_refs'] = node_refs
+    if printout:
+        for r in result_list:
             pprint.pprint(r)
-        result_list.append(r)
     return result_list
 
+def resolve_node_refs(docs, node_ref_lists, chunk_size=NODE_REF_CHUNK_SIZE, cache=node_ref_cache):
+    """Maps the node_refs (ids) of one or many ways to the corresponding nodes
+    (w/ only id, pos, and name fields), using $in queries of up to chunk_size
+    ids rather than one query per id.  Recently found nodes are kept in a shared
+    (bounded) cache across calls, per collection (changes.py removes the nodes
+    it writes from the cache, anything else writing nodes should call forget_nodes).  Returns a list of mapped node_refs for each
+    input list, in the original order, with any ids that weren't found left as is."""
+    found = {}
+    to_query = []
+    for node_refs in node_ref_lists:
+        for nr in node_refs:
+            if nr in found:
+                continue
+            node = cache.get((docs.full_name, nr)) if cache is not None else None
+            found[nr] = node
+            if node is None:
+                to_query.append(nr)
+    for i in xrange(0, len(to_query), chunk_size):
+        chunk = to_query[i:i+chunk_size]
+        for node in docs.find({ "id" : { "$in" : chunk } }, node_ref_projection):
+            # Keep the first match for each id (same as find_one)
+            if found.get(node['id']) is None:
+                found[node['id']] = node
+                if cache is not None:
+                    cache.put((docs.full_name, node['id']), node)
+    return [[dict(found[nr]) if found[nr] is not None else nr for nr in node_refs]
+            for node_refs in node_ref_lists]
+
+def forget_nodes(docs, node_ids, cache=node_ref_cache):
+    """Removes the nodes of the docs collection from the node_refs cache
+    (i.e. after they were modified or deleted)"""
+    for node_id in node_ids:
+        cache.discard((docs.full_name, node_id))
+
 def node_ref_mapping(docs, node_ref_list):
     """Maps the list of node_refs (ids) from way types
     to corresponding node ids.  If found, replaces id in list
     with dictionary of matching node id (w/ only id, pos, and name fields)."""
-    mapped_node_refs = []
-    for nr in node_ref_list:
-        nr_query = { "id" : nr }
-        nr_projection = { "_id" : 0, "id" : 1, "pos" : 1, "name" : 1 }
-        found_nr = docs.find_one(nr_query, nr_projection)
-        if found_nr:
-            mapped_node_refs.append(found_nr)
-        else:
-            mapped_node_refs.append(nr)
-    return mapped_node_refs
+    return resolve_node_refs(docs, [node_ref_list])[0]
     
+def reclassify_dogs(docs, batch_size=DOG_CLASSIFY_BATCH_SIZE):
+    """Re-evaluates the dog query (dog_query.dog_category) for every document in
+    the collection, i.e. after the regular expressions have changed or for a
+    collection loaded before the dog_related field was added at ingest.
+    Only the documents whose dog_related/dog_category changed are updated
+    (in unordered bulk writes of up to batch_size).
+    Returns the number of documents checked and updated."""
+    projection = dict((field, 1) for field in query_fields(dog_qry))
+    projection[DOG_FIELD] = 1
+    projection[DOG_CATEGORY_FIELD] = 1
+    checked = updated = 0
+    bulk = None
+    pending = 0
+    for doc in docs.find({}, projection):
+        checked += 1
+        category = dog_category(doc)
+        if category == doc.get(DOG_CATEGORY_FIELD) and (category is not None) == (DOG_FIELD in doc):
+            continue
+        if bulk is None:
+            bulk = docs.initialize_unordered_bulk_op()
+        if category is None:
+            bulk.find({ "_id" : doc['_id'] }).update_one({ "$unset" : { DOG_FIELD : "", DOG_CATEGORY_FIELD : "" } })
+        else:
+            bulk.find({ "_id" : doc['_id'] }).update_one({ "$set" : { DOG_FIELD : True, DOG_CATEGORY_FIELD : category } })
+        pending += 1
+        updated += 1
+        if pending >= batch_size:
+            bulk.execute()
+            bulk = None
+            pending = 0
+    if bulk is not None:
+        bulk.execute()
+    print "Reclassified %d documents, %d changed"%(checked, updated)
+    return checked, updated
+
+def reindex_names(docs, batch_size=NAME_INDEX_BATCH_SIZE):
+    """Adds (or updates) the name_folded and name_grams fields used by find_name,
+    i.e. for a collection loaded before they were added at ingest.
+    Returns the number of documents checked and updated."""
+    checked = updated = 0
+    bulk = None
+    pending = 0
+    projection = { "name" : 1, NAME_FOLDED_FIELD : 1, NAME_GRAMS_FIELD : 1 }
+    for doc in docs.find({ "name" : { "$exists" : True } }, projection):
+        checked += 1
+        fields = add_name_search({ "name" : doc['name'] })
+        if NAME_FOLDED_FIELD not in fields or \
+           (doc.get(NAME_FOLDED_FIELD) == fields[NAME_FOLDED_FIELD] and \
+            doc.get(NAME_GRAMS_FIELD) == fields[NAME_GRAMS_FIELD]):
+            continue
+        if bulk is None:
+            bulk = docs.initialize_unordered_bulk_op()
+        bulk.find({ "_id" : doc['_id'] }).update_one({ "$set" : { NAME_FOLDED_FIELD : fields[NAME_FOLDED_FIELD],
+                                                                  NAME_GRAMS_FIELD : fields[NAME_GRAMS_FIELD] } })
+        pending += 1
+        updated += 1
+        if pending >= batch_size:
+            bulk.execute()
+            bulk = None
+            pending = 0
+    if bulk is not None:
+        bulk.execute()
+    print "Indexed names of %d documents, %d changed"%(checked, updated)
+    return checked, updated
+
 def dog_related_by_user(docs, username, print_names=20):
     """print_names specifies the maximum number of names to print to the screen"""
-    user_and_dog_query = {"$and":[{ "created.user" : username }, dog_qry]}
+    user_and_dog_query = { DOG_FIELD : True, "created.user" : username }
     all_posts = docs.find(user_and_dog_query)
     if print_names is not None:
         print ' %s created %d dog-related entries with the following names (only displaying %d)'%(username,all_posts.count(),print_names)
@@ -294,9 +401,9 @@ def dog_related_by_user(docs, username, print_names=20):
                 print_names -= 1
     return all_posts
                 
-def mapreduce_print_user_created_key_count(docs, username):
+def mapreduce_user_created_key_count(docs, username):
     """Runs MapReduce to generate a count of all the keys (fields)
-    created by this user, then prints out each key and count"""
+    created by this user, {'results':[{'_id':key,'value':count},...]}"""
     from bson.code import Code
     # Note: JS used for mapreduce so indexes will not help to improve performance
     mapper = Code("""
@@ -315,7 +422,29 @@ def mapreduce_print_user_created_key_count(docs, username):
                      return total;
                    }
                    """)
-    user_dict = docs.map_reduce(mapper, reducer, {'inline':1}, query={ "created.user" : username })
+    return docs.map_reduce(mapper, reducer, {'inline':1}, query={ "created.user" : username })
+
+def aggregate_user_created_key_count(docs, username):
+    """Same as mapreduce_user_created_key_count, using an aggregation pipeline
+    ($objectToArray turns each document into a list of its keys, requires MongoDB 3.4.4+)"""
+    pipeline = [ { "$match" : { "created.user" : username } },
+                 { "$project" : { "_id" : 0, "keys" : { "$objectToArray" : "$$ROOT" } } },
+                 { "$unwind" : "$keys" },
+                 { "$group" : { "_id" : "$keys.k", "value" : { "$sum" : 1 } } } ]
+    return { 'results' : aggregate_result(docs.aggregate(pipeline)) }
+
+def user_created_key_count(docs, username, engine=default_engine):
+    """Count of all the keys (fields) created by this user, using either engine"""
+    if engine == MAPREDUCE:
+        return mapreduce_user_created_key_count(docs, username)
+    elif engine == AGGREGATE:
+        return aggregate_user_created_key_count(docs, username)
+    raise ValueError("Unknown engine %s, expected %s or %s"%(engine, AGGREGATE, MAPREDUCE))
+
+def print_user_created_key_count(docs, username, engine=default_engine):
+    """Generates a count of all the keys (fields) created by this user,
+    then prints out each key and count"""
+    user_dict = user_created_key_count(docs, username, engine)
     user_tuple = [(keys['_id'],keys['value']) for keys in user_dict['results']]
     import operator
     sorted_user_keys = sorted(user_tuple, key=operator.itemgetter(1), reverse=True)
@@ -332,6 +461,9 @@ def mapreduce_print_user_created_key_count(docs, username):
                 num_displayed += 1
     print "  %s created %d total documents"%(username,total_entries)
     return user_dict
+
+def mapreduce_print_user_created_key_count(docs, username):
+    return print_user_created_key_count(docs, username, MAPREDUCE)
     
 def mapreduce_users(docs,output_inline=1,dog_specific=None):
     """Uses map_reduce (called in javascript) to create a new collection,
@@ -355,7 +487,7 @@ def mapreduce_users(docs,output_inline=1,dog_specific=None):
                    """)
     if dog_specific is not None:
         output_to = {"replace":"dog_user_count"}
-        user_col = docs.map_reduce(mapper, reducer, output_to, query=dog_qry)
+        user_col = docs.map_reduce(mapper, reducer, output_to, query=dog_indexed_qry)
     else:
         if output_inline:
             output_to = {'inline':1}
@@ -365,7 +497,44 @@ def mapreduce_users(docs,output_inline=1,dog_specific=None):
         user_col = docs.map_reduce(mapper, reducer, output_to)
     return user_col
 
-def print_user_stats(docs,dog_specific=None):
+def aggregate_users(docs,output_inline=1,dog_specific=None):
+    """Same output as mapreduce_users, using a $group aggregation
+    (the dog query $match can use the indexes)"""
+    pipeline = [ { "$group" : { "_id" : "$created.user", "value" : { "$sum" : 1 } } } ]
+    if dog_specific is not None:
+        pipeline.insert(0, { "$match" : dog_indexed_qry })
+        output_inline = 0
+        db_name = "dog_user_count"
+    else:
+        db_name = "user_count"
+    if output_inline:
+        return { 'results' : aggregate_result(docs.aggregate(pipeline)) }
+    pipeline.append({ "$out" : db_name })
+    aggregate_result(docs.aggregate(pipeline))
+    return get_collection(db_name)
+
+def count_users(docs,output_inline=1,dog_specific=None,engine=default_engine):
+    if engine == MAPREDUCE:
+        return mapreduce_users(docs,output_inline,dog_specific)
+    elif engine == AGGREGATE:
+        return aggregate_users(docs,output_inline,dog_specific)
+    raise ValueError("Unknown engine %s, expected %s or %s"%(engine, AGGREGATE, MAPREDUCE))
+
+def aggregate_top_users(docs,limit=10,dog_specific=None):
+    """Total number of users and the top contributing users (as
+    {'_id':username,'value':contributions}) in a single $facet aggregation,
+    without creating a user count collection"""
+    pipeline = [ { "$group" : { "_id" : "$created.user", "value" : { "$sum" : 1 } } },
+                 { "$facet" : { "total" : [ { "$count" : "users" } ],
+                                "top" : [ { "$sort" : { "value" : -1 } },
+                                          { "$limit" : limit } ] } } ]
+    if dog_specific is not None:
+        pipeline.insert(0, { "$match" : dog_indexed_qry })
+    result = aggregate_result(docs.aggregate(pipeline))[0]
+    total_users = result['total'][0]['users'] if result['total'] else 0
+    return total_users, result['top']
+
+def print_user_stats(docs,dog_specific=None,engine=default_engine):
     """Gets the top contributing users in the database.
     If dog_specific input is specified (if not None),
     will perform a narrower search by filtering the map_reduce query
@@ -374,19 +543,23 @@ def print_user_stats(docs,dog_specific=None):
     mapreduce_users call will be skipped and the data will be read from
     the existing collection.
     If dog_specific input is specified, runs an additional query to
-    print the names of all the entries created by the top-contributing user."""
+    print the names of all the entries created by the top-contributing user.
+    With the aggregate engine, the counts are computed directly (see aggregate_top_users)."""
     if dog_specific is not None:
         db_name = "dog_user_count"
     else:
         db_name = "user_count"
-    if not check_collection_exists(db_name):
-        print "Running MapReduce to generate new collection"
-        users = mapreduce_users(docs,0,dog_specific)
+    if engine == AGGREGATE:
+        total_users, top_usernames = aggregate_top_users(docs,10,dog_specific)
     else:
-        users = get_collection(db_name)
-        
-    total_users = users.find().count()
-    top_usernames = users.find().sort("value",-1).limit(10)
+        if not check_collection_exists(db_name):
+            print "Running MapReduce to generate new collection"
+            users = mapreduce_users(docs,0,dog_specific)
+        else:
+            users = get_collection(db_name)
+
+        total_users = users.find().count()
+        top_usernames = users.find().sort("value",-1).limit(10)
     print "Top 10 contributing users (out of %d) in %s:"%(total_users,db_name)
     top_contributor = None
     for x,user in enumerate(top_usernames):
@@ -395,13 +568,51 @@ def print_user_stats(docs,dog_specific=None):
         print "%d) %s [%d]"%(x+1,user['_id'],user['value'])
     
     # Prints the count of all the keys the top contributing user has created
-    mapreduce_print_user_created_key_count(docs,top_contributor)
+    print_user_created_key_count(docs,top_contributor,engine)
     
     if dog_specific is not None:
         # Prints entry names that match the dog query from the top user
         dog_related_by_user(docs,top_contributor,5)
         
     
+def compare_engines(docs,username=None,dog_specific=None):
+    """Runs the user and key counts with both engines, checks that
+    the results match (including the top users of aggregate_top_users,
+    used by print_user_stats) and prints how long each engine took"""
+    import time
+    def counts(results):
+        return dict((r['_id'], int(r['value'])) for r in results)
+    timings = {}
+    user_counts = {}
+    key_counts = {}
+    for engine in (MAPREDUCE, AGGREGATE):
+        start = time.time()
+        users = count_users(docs,1,None,engine) if dog_specific is None else \
+                count_users(docs,0,dog_specific,engine).find()
+        user_counts[engine] = counts(users['results'] if isinstance(users, dict) else users)
+        timings[engine] = [time.time() - start]
+        if username is None:
+            username = max(user_counts[engine].items(), key=lambda u: u[1])[0]
+        start = time.time()
+        key_counts[engine] = counts(user_created_key_count(docs,username,engine)['results'])
+        timings[engine].append(time.time() - start)
+    assert user_counts[MAPREDUCE] == user_counts[AGGREGATE]
+    assert key_counts[MAPREDUCE] == key_counts[AGGREGATE]
+    start = time.time()
+    total_users, top_users = aggregate_top_users(docs,10,dog_specific)
+    timings[AGGREGATE].append(time.time() - start)
+    assert total_users == len(user_counts[MAPREDUCE])
+    # Users with the same count can be in either order
+    assert [user['value'] for user in top_users] == \
+           sorted(user_counts[MAPREDUCE].values(), reverse=True)[:10]
+    for user in top_users:
+        assert user_counts[MAPREDUCE][user['_id']] == user['value']
+    print "%d users, %d keys created by %s match"%(len(user_counts[AGGREGATE]),len(key_counts[AGGREGATE]),username)
+    for engine in (MAPREDUCE, AGGREGATE):
+        print "%s: user counts %.2f sec, key counts %.2f sec"%(engine,timings[engine][0],timings[engine][1])
+    print "%s: top users %.2f sec"%(AGGREGATE,timings[AGGREGATE][2])
+    return timings
+
 def test():
     docs = get_collection()
     total_size = size_of_collection(docs)
@@ -428,6 +639,8 @@ def test():
 
         print_user_stats(docs,1)
         print_user_stats(docs)
+        compare_engines(docs)
+        compare_engines(docs,dog_specific=1)
 
 if __name__ == '__main__':
     test()
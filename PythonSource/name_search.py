@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""
+Name search for mongo_audit.find_name, without scanning every name with an
+unanchored regex.
+
+Names are folded (lowercase, accents removed, so 'Café' matches 'cafe'), and the
+search keeps the same semantics as the original find_name regex: the words of the
+search string must all appear in the name, in order, with anything in between
+('dog park' matches 'Alamo Square Off-Leash Dog Park' and 'Hot Dogs & Parking').
+
+Each word of a name is broken into n-grams (up to GRAM_SIZE characters), and any
+name containing a search word must contain all of that word's n-grams, so the
+n-grams narrow down the candidates before the folded regex is checked:
+- At ingest, shape_element adds 'name_folded' and 'name_grams' (the distinct
+  trigrams) to named documents, and mongo_audit.create_indexes adds a multikey
+  index on name_grams (see mongo_query)
+- NameIndex is an in-process inverted index of the 1/2/3-grams, fast enough for
+  autocomplete lookups as the user types
+
+Results are ranked: exact match, then names starting with the search, then those
+with more search words at the start of a word, then shorter names.
+
+>>> import name_search
+>>> index = name_search.NameIndex.from_json("../san-francisco.osm.json")
+>>> index.search("dog par", limit=5)
+"""
+import bisect
+import heapq
+import json
+import re
+import unicodedata
+
+#OSMFILE = "../example.osm"
+OSMFILE = "../example_sf.osm"
+#OSMFILE = "../san-francisco.osm"
+
+GRAM_SIZE = 3
+
+NAME_FOLDED_FIELD = 'name_folded'
+NAME_GRAMS_FIELD = 'name_grams'
+
+word_re = re.compile(r'\w+', re.UNICODE)
+split_re = re.compile(r'\W+', re.UNICODE)
+
+
+def fold(text):
+    """Lowercase unicode text without accents (combining marks)"""
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    text = unicodedata.normalize('NFKD', text)
+    return u''.join(c for c in text if not unicodedata.combining(c)).lower()
+
+
+def search_words(srch_str):
+    """Folded words of the search string (split apart on any non-word
+    characters, same as the original find_name regex)"""
+    return [w for w in split_re.split(fold(srch_str)) if w]
+
+
+def search_regex(words):
+    """Words in order, with anything between them (matched against folded names)"""
+    return re.compile('.*'.join(re.escape(w) for w in words), re.UNICODE)
+
+
+def grams(word, n):
+    if len(word) <= n:
+        return [word]
+    return [word[i:i + n] for i in range(len(word) - n + 1)]
+
+
+def name_grams(folded):
+    """Distinct trigrams of each word in the folded name"""
+    found = set()
+    for word in word_re.findall(folded):
+        found.update(grams(word, GRAM_SIZE))
+    return sorted(found)
+
+
+def word_prefixes(folded):
+    """Distinct prefixes (up to GRAM_SIZE characters) of each word in the folded name"""
+    found = set()
+    for word in word_re.findall(folded):
+        for n in range(1, min(len(word), GRAM_SIZE) + 1):
+            found.add(word[:n])
+    return found
+
+
+def index_grams(folded):
+    """Distinct 1, 2 and 3-grams of each word in the folded name (so search words
+    shorter than GRAM_SIZE can be looked up as well)"""
+    found = set()
+    for word in word_re.findall(folded):
+        for n in range(1, GRAM_SIZE + 1):
+            if len(word) >= n:
+                found.update(grams(word, n))
+    return found
+
+
+def query_grams(words):
+    """n-grams every matching name must contain (words shorter than
+    GRAM_SIZE are looked up whole)"""
+    found = set()
+    for word in words:
+        found.update(grams(word, GRAM_SIZE))
+    return found
+
+
+def word_start_regex(word):
+    """Matches the word at the start of a word within the name"""
+    return re.compile(r'(?:^|\W)' + re.escape(word), re.UNICODE)
+
+
+def ranker(words):
+    """Sort key function for matching (folded) names, best matches first"""
+    exact = u' '.join(words)
+    first = words[0]
+    starts = [word_start_regex(w) for w in words]
+    def rank_key(folded):
+        word_starts = sum(1 for start in starts if start.search(folded))
+        return (folded != exact, not folded.startswith(first), -word_starts, len(folded), folded)
+    return rank_key
+
+
+def add_name_search(doc):
+    """Adds the folded name and its trigrams to a shaped document that has a name"""
+    name = doc.get('name')
+    if isinstance(name, basestring):
+        folded = fold(name)
+        doc[NAME_FOLDED_FIELD] = folded
+        doc[NAME_GRAMS_FIELD] = name_grams(folded)
+    return doc
+
+
+def mongo_query(srch_str):
+    """MongoDB query for names matching the search string, using the name_grams
+    index when a search word is at least GRAM_SIZE long (otherwise only the
+    name_folded index can be scanned).  Returns None if there are no words."""
+    words = search_words(srch_str)
+    if not words:
+        return None
+    qry = { NAME_FOLDED_FIELD : search_regex(words) }
+    trigrams = sorted(g for g in query_grams(words) if len(g) == GRAM_SIZE)
+    if trigrams:
+        qry = { "$and" : [ { NAME_GRAMS_FIELD : { "$all" : trigrams } }, qry ] }
+    return qry
+
+
+def rank_docs(result_docs, srch_str, limit=None):
+    """Sorts the matching documents (with name_folded) best match first.
+    With a limit, result_docs can be any iterable (i.e. a cursor), only the
+    best limit documents are kept while going through it."""
+    rank_key = ranker(search_words(srch_str))
+    key = lambda d: rank_key(d.get(NAME_FOLDED_FIELD) or fold(d['name']))
+    if limit is not None:
+        return heapq.nsmallest(limit, result_docs, key=key)
+    return sorted(result_docs, key=key)
+
+
+class NameIndex(object):
+    """In-process inverted index from name n-grams (and word prefixes) to documents.
+    from_docs adds the names in rank order (shortest first), so the posting lists
+    are already in rank order and single word (autocomplete) searches can stop
+    as soon as they have found enough of the best matches."""
+
+    def __init__(self):
+        self.docs = []
+        self.folded = []
+        self.postings = {}
+        self.prefixes = {}
+        self.rank_ordered = True
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, doc):
+        """Adds the document if it has a name. Returns whether it was added."""
+        name = doc.get('name')
+        if not isinstance(name, basestring):
+            return False
+        folded = doc.get(NAME_FOLDED_FIELD) or fold(name)
+        if self.folded and (len(folded), folded) < (len(self.folded[-1]), self.folded[-1]):
+            self.rank_ordered = False
+        i = len(self.docs)
+        self.docs.append(doc)
+        self.folded.append(folded)
+        for gram in index_grams(folded):
+            self.postings.setdefault(gram, []).append(i)
+        for prefix in word_prefixes(folded):
+            self.prefixes.setdefault(prefix, []).append(i)
+        return True
+
+    @classmethod
+    def from_docs(cls, docs):
+        named = []
+        for doc in docs:
+            name = doc.get('name')
+            if isinstance(name, basestring):
+                named.append((doc.get(NAME_FOLDED_FIELD) or fold(name), doc))
+        named.sort(key=lambda n: (len(n[0]), n[0]))
+        index = cls()
+        for folded, doc in named:
+            index.add(doc)
+        return index
+
+    @classmethod
+    def from_json(cls, file_in):
+        """Builds the index from the json output of data.process_map"""
+        with open(file_in) as fi:
+            return cls.from_docs(json.loads(line) for line in fi if line.strip())
+
+    def candidates(self, words):
+        """Positions of the documents containing all the n-grams of the words
+        (sorted), intersecting the shortest posting lists first"""
+        lists = []
+        for gram in query_grams(words):
+            posting = self.postings.get(gram)
+            if not posting:
+                return []
+            lists.append(posting)
+        lists.sort(key=len)
+        found = lists[0]
+        for posting in lists[1:]:
+            if len(posting) > 8 * len(found):
+                # Much longer list, look up each remaining position instead
+                found = [i for i in found if contains(posting, i)]
+            else:
+                in_found = set(found)
+                found = [i for i in posting if i in in_found]
+            if not found:
+                break
+        return found
+
+    def search(self, srch_str, limit=10):
+        """Documents whose name matches the search string, best match first"""
+        words = search_words(srch_str)
+        if not words:
+            return []
+        if limit is not None and self.rank_ordered:
+            if len(words) == 1:
+                matches = self.search_word(words[0], limit)
+            else:
+                matches = self.search_ranked(words, limit)
+        else:
+            regex = search_regex(words)
+            matches = [i for i in self.candidates(words) if regex.search(self.folded[i])]
+            rank_key = ranker(words)
+            if limit is None:
+                matches.sort(key=lambda i: rank_key(self.folded[i]))
+            else:
+                matches = heapq.nsmallest(limit, matches, key=lambda i: rank_key(self.folded[i]))
+        return [self.docs[i] for i in matches[:limit]]
+
+    def search_ranked(self, words, limit):
+        """Positions of the best limit names matching the words.  Goes through the
+        shortest posting list in rank order, and stops once limit names that start
+        with the search (and have every word at the start of a word) have been found,
+        since no later name can rank higher."""
+        lists = []
+        for gram in query_grams(words):
+            posting = self.postings.get(gram)
+            if not posting:
+                return []
+            lists.append(posting)
+        lists.sort(key=len)
+        regex = search_regex(words)
+        rank_key = ranker(words)
+        exact_len = len(u' '.join(words))
+        best_rank = (True, False, -len(words))
+        top = []
+        num_best = 0
+        for i in lists[0]:
+            folded = self.folded[i]
+            if num_best >= limit and len(folded) > exact_len:
+                break
+            if not all(contains(posting, i) for posting in lists[1:]) or not regex.search(folded):
+                continue
+            key = rank_key(folded)
+            if key[:3] <= best_rank:
+                num_best += 1
+            if len(top) < limit or (key, i) < top[-1]:
+                bisect.insort(top, (key, i))
+                del top[limit:]
+        return [i for _, i in top]
+
+    def search_word(self, word, limit):
+        """Positions of the best limit names containing the word.  Ranked names
+        starting with the word, then with a word starting with it, then any others
+        (each in index order), so the search can stop early for common prefixes."""
+        starting = []
+        word_start = []
+        seen = set()
+        start_re = word_start_regex(word)
+        for i in self.prefixes.get(word[:GRAM_SIZE], ()):
+            folded = self.folded[i]
+            if folded.startswith(word):
+                starting.append(i)
+                if len(starting) >= limit:
+                    return starting
+            elif len(word) <= GRAM_SIZE or start_re.search(folded):
+                if len(word_start) < limit:
+                    word_start.append(i)
+            else:
+                continue
+            seen.add(i)
+        matches = starting + word_start
+        if len(matches) < limit:
+            for i in self.candidates([word]):
+                if i not in seen and word in self.folded[i]:
+                    matches.append(i)
+                    if len(matches) >= limit:
+                        break
+        return matches
+
+
+def contains(posting, i):
+    """Whether the sorted posting list contains i"""
+    j = bisect.bisect_left(posting, i)
+    return j < len(posting) and posting[j] == i
+
+
+def test():
+    import data
+    import time
+    docs = list(data.iter_shaped(OSMFILE))
+    index = NameIndex.from_docs(docs)
+    print "Indexed %d names, %d n-grams"%(len(index), len(index.postings))
+    assert fold(u'Caf\xe9 Ren\xe9') == u'cafe rene'
+    assert search_words("St. Mary's") == [u'st', u'mary', u's']
+
+    # Same matches as the original find_name regex (on the folded names)
+    named = [d for d in docs if isinstance(d.get('name'), basestring)]
+    queries = set()
+    for d in named:
+        words = search_words(d['name'])
+        queries.update([words[0], words[0][:2], words[-1][1:4], ' '.join(words[:2])])
+    queries.update(['dog park', 'st', 'a', 'zzz'])
+    for srch_str in queries:
+        old_re = re.compile('.*'+re.sub(r'\W','.*',srch_str)+'.*', re.IGNORECASE)
+        expected = [d for d in named if old_re.search(d['name'])]
+        found = index.search(srch_str, limit=None)
+        assert sorted(id(d) for d in found) == sorted(id(d) for d in expected)
+        assert [id(d) for d in rank_docs(expected, srch_str)] == [id(d) for d in found]
+        assert index.search(srch_str, limit=3) == found[:3]
+        assert [id(d) for d in rank_docs(iter(expected), srch_str, 3)] == [id(d) for d in found[:3]]
+    print "%d searches match the regex search"%(len(queries))
+
+    start = time.time()
+    for srch_str in queries:
+        index.search(srch_str)
+    print "%.3f ms per search"%((time.time() - start) / len(queries) * 1000)
+
+
+if __name__ == '__main__':
+    test()
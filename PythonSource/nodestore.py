@@ -0,0 +1,212 @@
+"""
+Compact node id -> [lon, lat] store, built while parsing the .osm file.
+
+Most of the elements in san-francisco.osm are nodes whose only useful payload is
+their position, so instead of keeping them as python dictionaries (or looking them
+up in MongoDB) the ids and coordinates are kept in numpy arrays sorted by id:
+    ids     int64 array of node ids (sorted)
+    coords  float64 array of [lon, lat] pairs (same order as 'pos' in data.py)
+Single lookups are a binary search (O(log n)), lookup_many does a vectorized
+search for a whole list/array of ids at once (i.e. all the node_refs of a way).
+
+The arrays can be saved to disk (.npy files) and loaded back memory-mapped,
+so only the pages needed for lookups are read in.  The size and modification time
+of the .osm file the store was built from are saved with them (.source.json), so
+is_current can tell when the file has changed and the store needs rebuilding.
+
+>>> import nodestore
+>>> store = nodestore.build_node_store(OSMFILE)
+>>> store.save("../san-francisco.nodes", OSMFILE)
+>>> store = nodestore.NodeStore.load("../san-francisco.nodes")
+>>> store.lookup("281266")
+[-122.3025783, 37.5601845]
+"""
+from array import array
+import json
+import numpy as np
+import os
+import re
+from parsers import iter_elements, DEFAULT_PARSER
+
+#OSMFILE = "../example.osm"
+OSMFILE = "../example_sf.osm"
+#OSMFILE = "../san-francisco.osm"
+
+whitespace_re = re.compile(r'\s')
+# Node ids are collected in a list, then moved to an int64 array every ID_CHUNK
+# ids (array('l') is only 32 bits on some platforms, node ids are past 2^31)
+ID_CHUNK = 65536
+
+
+def parse_coord(val):
+    """Same conversion as data.node_way_shape (removes spaces from invalid data)"""
+    return float(whitespace_re.sub('', val.strip()))
+
+
+class NodeStoreBuilder(object):
+    """Collects node ids and positions (in any order), finish() returns the NodeStore"""
+
+    def __init__(self):
+        self.id_chunks = []
+        self.ids = []
+        self.lons = array('d')
+        self.lats = array('d')
+
+    def __len__(self):
+        return len(self.lons)
+
+    def add(self, node_id, lon, lat):
+        self.ids.append(int(node_id))
+        if len(self.ids) >= ID_CHUNK:
+            self.id_chunks.append(np.array(self.ids, dtype=np.int64))
+            self.ids = []
+        self.lons.append(lon)
+        self.lats.append(lat)
+
+    def add_element(self, elem):
+        """Adds a node element (from parsers.iter_elements) that has a position"""
+        if elem.tag == 'node':
+            lat = elem.attrib.get('lat')
+            lon = elem.attrib.get('lon')
+            if lat is not None and lon is not None:
+                self.add(elem.attrib['id'], parse_coord(lon), parse_coord(lat))
+
+    def add_doc(self, doc):
+        """Adds a shaped node document (from data.shape_element) that has a position"""
+        if doc.get('type') == 'node' and len(doc.get('pos', [])) == 2:
+            self.add(doc['id'], doc['pos'][0], doc['pos'][1])
+
+    def finish(self):
+        ids = np.concatenate(self.id_chunks + [np.array(self.ids, dtype=np.int64)])
+        coords = np.empty((len(ids), 2), dtype=np.float64)
+        if len(ids):
+            coords[:, 0] = np.frombuffer(self.lons, dtype=np.float64)
+            coords[:, 1] = np.frombuffer(self.lats, dtype=np.float64)
+        order = np.argsort(ids, kind='mergesort')
+        return NodeStore(ids[order], coords[order])
+
+
+class NodeStore(object):
+    """Sorted node ids with their [lon, lat] coordinates"""
+
+    def __init__(self, ids, coords):
+        self.ids = ids
+        self.coords = coords
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, node_id):
+        return self.index(node_id) is not None
+
+    def index(self, node_id):
+        """Position of the node id within the arrays, or None if not found"""
+        node_id = int(node_id)
+        i = int(np.searchsorted(self.ids, node_id))
+        if i < len(self.ids) and self.ids[i] == node_id:
+            return i
+        return None
+
+    def lookup(self, node_id):
+        """[lon, lat] of the node, or None if it isn't in the store"""
+        i = self.index(node_id)
+        if i is None:
+            return None
+        return self.coords[i].tolist()
+
+    def lookup_many(self, node_ids):
+        """Vectorized lookup of a sequence of node ids (strings or ints).
+        Returns an (n, 2) array of [lon, lat] (nan for ids that weren't found)
+        and a boolean array of which ids were found."""
+        node_ids = np.asarray([int(i) for i in node_ids] if not isinstance(node_ids, np.ndarray)
+                              else node_ids, dtype=np.int64)
+        coords = np.empty((len(node_ids), 2), dtype=np.float64)
+        coords.fill(np.nan)
+        if not len(self.ids) or not len(node_ids):
+            return coords, np.zeros(len(node_ids), dtype=bool)
+        idx = np.searchsorted(self.ids, node_ids)
+        idx[idx >= len(self.ids)] = len(self.ids) - 1
+        found = self.ids[idx] == node_ids
+        coords[found] = self.coords[idx[found]]
+        return coords, found
+
+    def save(self, path, file_in=None):
+        """Writes the arrays to path.ids.npy and path.coords.npy, and the
+        source_signature of file_in (the file it was built from) to path.source.json"""
+        np.save(path + ".ids.npy", self.ids)
+        np.save(path + ".coords.npy", self.coords)
+        if file_in is not None:
+            with open(path + ".source.json", "w") as fo:
+                json.dump(source_signature(file_in), fo)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Loads a saved store, memory-mapped (read only) unless mmap is False"""
+        mode = 'r' if mmap else None
+        return cls(np.load(path + ".ids.npy", mmap_mode=mode),
+                   np.load(path + ".coords.npy", mmap_mode=mode))
+
+
+def source_signature(file_in):
+    stat = os.stat(file_in)
+    return { "file_size" : stat.st_size, "mtime" : stat.st_mtime }
+
+
+def is_current(path, file_in):
+    """Whether a store was saved at path from file_in as it is now
+    (same size and modification time)"""
+    if not os.path.exists(path + ".ids.npy") or not os.path.exists(path + ".coords.npy"):
+        return False
+    try:
+        with open(path + ".source.json") as fi:
+            return json.load(fi) == source_signature(file_in)
+    except (IOError, ValueError):
+        return False
+
+
+def build_node_store(file_in, parser=DEFAULT_PARSER):
+    """Parses the file and returns a NodeStore of every node's position"""
+    builder = NodeStoreBuilder()
+    for elem in iter_elements(file_in, parser):
+        builder.add_element(elem)
+    return builder.finish()
+
+
+def test():
+    import shutil
+    import tempfile
+    store = build_node_store(OSMFILE)
+    print "%d nodes in store"%(len(store))
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, "nodes")
+        assert not is_current(path, OSMFILE)
+        store.save(path, OSMFILE)
+        assert is_current(path, OSMFILE)
+        loaded = NodeStore.load(path)
+
+        ids = []
+        for elem in iter_elements(OSMFILE):
+            if elem.tag == 'node':
+                ids.append(elem.attrib['id'])
+                pos = [parse_coord(elem.attrib['lon']), parse_coord(elem.attrib['lat'])]
+                assert loaded.lookup(elem.attrib['id']) == pos
+        assert loaded.lookup("-1") is None
+        # Ids past 2^31 (and across id chunks)
+        builder = NodeStoreBuilder()
+        big_ids = [2 ** 33 + i * 7 for i in range(ID_CHUNK + 10)]
+        for i, node_id in enumerate(reversed(big_ids)):
+            builder.add(str(node_id), float(i), 0.0)
+        big = builder.finish()
+        assert big.ids.dtype == np.int64 and big.ids.tolist() == big_ids
+        assert big.lookup(str(big_ids[-1])) == [0.0, 0.0]
+        coords, found = loaded.lookup_many(ids + ["-1"])
+        assert found[:-1].all() and not found[-1]
+        assert coords[:-1].tolist() == [loaded.lookup(i) for i in ids]
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    print "Lookups match the parsed node positions"
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,201 @@
+"""
+Parser backends that stream the top level elements (node/way/relation, plus
+bounds) of an .osm file to data.shape_element.
+
+'etree'  ElementTree iterparse (the original approach, default), using the
+         C implementation (cElementTree, same as audit.py) when available
+'expat'  SAX style expat handler that skips building ElementTree objects and
+         only keeps what shape_element reads (tag names and attributes) in
+         lightweight OsmElement objects
+'lxml'   lxml.etree iterparse, requires lxml to be installed
+
+All three yield objects with the same interface used by shape_element
+(elem.tag, elem.attrib and elem.iter(tag)), and each element is freed once
+the next one is requested.
+
+>>> import parsers
+>>> for elem in parsers.iter_elements(OSMFILE, 'expat'):
+...     el = data.shape_element(elem)
+"""
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+import xml.parsers.expat
+import re
+from compressed import is_compressed, osm_open
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+#OSMFILE = "../example.osm"
+OSMFILE = "../example_sf.osm"
+#OSMFILE = "../san-francisco.osm"
+
+DEFAULT_PARSER = 'etree'
+EXPAT_READ_SIZE = 64 * 1024
+
+
+class OsmElement(object):
+    """Minimal stand-in for an ElementTree element"""
+    __slots__ = ('tag', 'attrib', 'children')
+
+    def __init__(self, tag, attrib):
+        self.tag = tag
+        self.attrib = attrib
+        self.children = []
+
+    def iter(self, tag=None):
+        """Same as ElementTree's iter, this element then all descendants
+        (optionally only those with a matching tag)"""
+        if tag is None or self.tag == tag:
+            yield self
+        for child in self.children:
+            if child.children:
+                for elem in child.iter(tag):
+                    yield elem
+            elif tag is None or child.tag == tag:
+                yield child
+
+
+non_ascii_re = re.compile(r'[\x80-\xff]')
+
+def fix_text(text):
+    """Decodes utf-8 text, but leaves ascii as plain strings (same as ElementTree)"""
+    try:
+        text.decode('ascii')
+        return text
+    except UnicodeError:
+        return text.decode('utf-8')
+
+
+def iter_etree(file_in):
+    context = iter(ET.iterparse(file_in, events=("start", "end")))
+    event, root = context.next() # get the root element
+    depth = 0
+    for event, elem in context:
+        if event == "start":
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                yield elem
+                elem.clear()
+                root.clear() # delete root's children (already processed siblings)
+
+
+def iter_expat(file_in):
+    """Builds OsmElements from the expat start/end callbacks, yielding each
+    top level element as soon as it is complete"""
+    parser = xml.parsers.expat.ParserCreate()
+    parser.returns_unicode = False # utf-8 encoded strings
+    stack = []
+    done = []
+    # Text only needs decoding if the data parsed recently contained non-ascii bytes
+    # (checking the raw data is much faster than checking each attribute)
+    ascii_data = [True, True]
+
+    def start_element(name, attrs):
+        if not (ascii_data[0] and ascii_data[1]):
+            name = fix_text(name)
+            attrs = dict((fix_text(k), fix_text(v)) for k, v in attrs.iteritems())
+        elem = OsmElement(name, attrs)
+        if len(stack) > 1:
+            stack[-1].children.append(elem)
+        stack.append(elem)
+
+    def end_element(name):
+        elem = stack.pop()
+        if len(stack) == 1:
+            done.append(elem)
+
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.buffer_text = True
+
+    fo = open(file_in, 'rb') if isinstance(file_in, basestring) else file_in
+    try:
+        while True:
+            data = fo.read(EXPAT_READ_SIZE)
+            ascii_data[:] = [ascii_data[1], non_ascii_re.search(data) is None]
+            parser.Parse(data, not data)
+            for elem in done:
+                yield elem
+            del done[:]
+            if not data:
+                break
+    finally:
+        if fo is not file_in:
+            fo.close()
+
+
+def iter_lxml(file_in):
+    if lxml_etree is None:
+        raise ImportError("lxml parser backend requires lxml to be installed")
+    context = lxml_etree.iterparse(file_in, events=("start", "end"))
+    depth = 0
+    for event, elem in context:
+        if event == "start":
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 1:
+                yield elem
+                # free the element, and all the siblings processed before it
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
+
+BACKENDS = { 'etree' : iter_etree,
+             'expat' : iter_expat,
+             'lxml'  : iter_lxml }
+
+
+def available_backends():
+    return [name for name in sorted(BACKENDS) if name != 'lxml' or lxml_etree is not None]
+
+
+def iter_elements(file_in, parser=DEFAULT_PARSER):
+    """Generator of the top level elements (children of <osm>) in the file,
+    a filename or file object, using the chosen parser backend.
+    Compressed (.gz/.bz2) files are decompressed as they are read, see compressed.py,
+    and .osm.pbf files are read with pbf.py (whatever the parser)"""
+    if parser not in BACKENDS:
+        raise ValueError("Unknown parser %s, expected one of %s"%(parser, sorted(BACKENDS)))
+    if is_compressed(file_in):
+        return iter_closing(BACKENDS[parser], osm_open(file_in))
+    # .osm.pbf files have their own reader (imported here, as pbf.py uses OsmElement)
+    import pbf
+    if pbf.is_pbf(file_in):
+        return pbf.iter_pbf(file_in)
+    return BACKENDS[parser](file_in)
+
+
+def iter_closing(backend, fo):
+    """Elements from the backend parsing fo, closing fo when done"""
+    try:
+        for elem in backend(fo):
+            yield elem
+    finally:
+        fo.close()
+
+
+def test():
+    """Parity test, every backend should produce the same shaped documents"""
+    import data
+    from timeit import default_timer
+    expected = None
+    for parser in available_backends():
+        start = default_timer()
+        shaped = list(data.iter_shaped(OSMFILE, parser=parser))
+        print "%s: %d documents in %.3f sec"%(parser, len(shaped), default_timer() - start)
+        if expected is None:
+            expected = shaped
+        assert shaped == expected
+    print "All parser backends produced identical documents"
+
+
+if __name__ == '__main__':
+    test()
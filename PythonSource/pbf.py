@@ -0,0 +1,708 @@
+"""
+Reader for OSM PBF files (.osm.pbf, the standard binary extract format),
+without needing the protobuf library.
+
+A .osm.pbf file is a sequence of fileblocks, each a 4 byte (big-endian) length,
+a BlobHeader and a Blob (usually zlib compressed).  The OSMData blobs are
+PrimitiveBlocks: a string table, then groups of nodes (usually DenseNodes,
+with delta coded ids, positions and metadata), ways (delta coded node refs)
+and relations.  Each block only depends on its own string table, so blocks
+can be decoded independently, in parallel.
+See http://wiki.openstreetmap.org/wiki/PBF_Format
+
+iter_pbf yields the same OsmElements as the expat backend in parsers.py
+(with the same attributes and tag/nd/member children as the xml), so
+shape_element works on them unchanged.  parsers.iter_elements (and so
+data.iter_shaped) reads .pbf files automatically, detected by their first
+BlobHeader.  With workers, data.iter_shaped decodes and shapes the blocks
+across a pool of processes.
+
+osm_to_pbf writes an .osm (xml) file as .osm.pbf, i.e. for testing:
+>>> import pbf
+>>> pbf.osm_to_pbf("../example_sf.osm", "../example_sf.osm.pbf")
+>>> elements = list(pbf.iter_pbf("../example_sf.osm.pbf"))
+"""
+import calendar
+import multiprocessing
+import struct
+import time
+import zlib
+from collections import deque
+import numpy as np
+from parsers import OsmElement, fix_text, iter_elements
+
+#OSMFILE = "../example.osm"
+OSMFILE = "../example_sf.osm"
+#OSMFILE = "../san-francisco.osm"
+
+# First BlobHeader of every .osm.pbf file: field 1 (type) = 'OSMHeader'
+PBF_MAGIC = '\x0a\x09OSMHeader'
+MAX_HEADER_SIZE = 64 * 1024
+MAX_BLOB_SIZE = 32 * 1024 * 1024
+# Elements per block written by osm_to_pbf (the spec recommends 8000)
+BLOCK_ELEMENTS = 8000
+
+# Packed fields longer than this are decoded with numpy (faster for the large
+# arrays in DenseNodes, slower for short ones like most way refs)
+NUMPY_PACKED_SIZE = 256
+
+MEMBER_TYPES = ['node', 'way', 'relation']
+WIRE_VARINT, WIRE_FIXED64, WIRE_BYTES, WIRE_FIXED32 = 0, 1, 2, 5
+
+
+def is_pbf(file_in):
+    """Whether the file (a filename) is an .osm.pbf file"""
+    if not isinstance(file_in, basestring):
+        return False
+    with open(file_in, 'rb') as fi:
+        return fi.read(4 + len(PBF_MAGIC))[4:] == PBF_MAGIC
+
+
+# Protocol buffer wire format decoding
+
+def iter_fields(buf, pos=0, end=None):
+    """(field number, wire type, value) of each field of the message in buf (a
+    bytearray).  Varints are ints, length delimited fields bytearray slices."""
+    if end is None:
+        end = len(buf)
+    while pos < end:
+        key = 0
+        shift = 0
+        while True:
+            b = buf[pos]
+            pos += 1
+            key |= (b & 0x7f) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        wire = key & 7
+        if wire == WIRE_VARINT:
+            value = 0
+            shift = 0
+            while True:
+                b = buf[pos]
+                pos += 1
+                value |= (b & 0x7f) << shift
+                if b < 0x80:
+                    break
+                shift += 7
+        elif wire == WIRE_BYTES:
+            size = 0
+            shift = 0
+            while True:
+                b = buf[pos]
+                pos += 1
+                size |= (b & 0x7f) << shift
+                if b < 0x80:
+                    break
+                shift += 7
+            value = buf[pos:pos + size]
+            pos += size
+        elif wire == WIRE_FIXED64:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire == WIRE_FIXED32:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type %d"%(wire))
+        yield key >> 3, wire, value
+
+
+def unpack_varints(buf):
+    """Values of a packed repeated varint field"""
+    if len(buf) > NUMPY_PACKED_SIZE:
+        values = np_unpack_varints(buf)
+        if values.max() < np.uint64(1 << 63):
+            # ints rather than longs (which are much slower to use)
+            values = values.astype(np.int64)
+        return values.tolist()
+    values = []
+    append = values.append
+    value = 0
+    shift = 0
+    for b in buf:
+        if b < 0x80:
+            append(value | (b << shift))
+            value = 0
+            shift = 0
+        else:
+            value |= (b & 0x7f) << shift
+            shift += 7
+    return values
+
+
+def unpack_int32s(buf):
+    """Values of a packed int32 field (negative values are 10 byte varints)"""
+    return [v - (1 << 64) if v >= (1 << 63) else v for v in unpack_varints(buf)]
+
+
+def unpack_sints(buf):
+    """Values of a packed sint32/sint64 (zigzag encoded) field"""
+    return [(v >> 1) ^ -(v & 1) for v in unpack_varints(buf)]
+
+
+def np_unpack_varints(buf):
+    """Values of a packed repeated varint field as a numpy uint64 array,
+    combining the 7 bit groups of every varint at once"""
+    data = np.frombuffer(buffer(buf), dtype=np.uint8)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.empty_like(ends)
+    starts[0:1] = 0
+    starts[1:] = ends[:-1] + 1
+    lengths = ends - starts + 1
+    values = (data[starts] & 0x7f).astype(np.uint64)
+    for j in range(1, int(lengths.max()) if len(lengths) else 0):
+        more = np.flatnonzero(lengths > j)
+        values[more] |= (data[starts[more] + j] & 0x7f).astype(np.uint64) << np.uint64(7 * j)
+    return values
+
+
+def unpack_deltas(buf):
+    """Values of a packed, delta coded sint64 field"""
+    if len(buf) > NUMPY_PACKED_SIZE:
+        values = np_unpack_varints(buf)
+        signed_values = (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+        return np.cumsum(signed_values).tolist()
+    values = []
+    append = values.append
+    total = 0
+    for v in unpack_varints(buf):
+        total += (v >> 1) ^ -(v & 1)
+        append(total)
+    return values
+
+
+def zigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def signed(value):
+    """int32/int64 field value (negative values are encoded as 64 bit)"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+# Blocks
+
+def read_fileblock(fo):
+    """(type, blob message) of the next fileblock, or None at the end of the file"""
+    size_data = fo.read(4)
+    if not size_data:
+        return None
+    if len(size_data) < 4:
+        raise ValueError("Truncated .pbf file")
+    header_size = struct.unpack('>I', size_data)[0]
+    if header_size > MAX_HEADER_SIZE:
+        raise ValueError("BlobHeader too large (%d bytes), not a .pbf file?"%(header_size))
+    blob_type = None
+    blob_size = 0
+    for field, wire, value in iter_fields(bytearray(fo.read(header_size))):
+        if field == 1:
+            blob_type = str(value)
+        elif field == 3:
+            blob_size = value
+    if blob_size > MAX_BLOB_SIZE:
+        raise ValueError("Blob too large (%d bytes)"%(blob_size))
+    blob = fo.read(blob_size)
+    if len(blob) < blob_size:
+        raise ValueError("Truncated .pbf file")
+    return blob_type, blob
+
+
+def blob_data(blob):
+    """Uncompressed contents of a Blob message"""
+    for field, wire, value in iter_fields(bytearray(blob)):
+        if field == 1:
+            return value
+        if field == 3:
+            return bytearray(zlib.decompress(str(value)))
+        if field in (4, 5, 6, 7):
+            raise ValueError("Unsupported .pbf blob compression (field %d), only zlib is supported"%(field))
+    return bytearray()
+
+
+def check_header(data):
+    """Raises ValueError if the HeaderBlock requires features this reader doesn't have"""
+    for field, wire, value in iter_fields(data):
+        if field == 4: # required_features
+            feature = str(value)
+            if feature not in ('OsmSchema-V0.6', 'DenseNodes'):
+                raise ValueError("Unsupported .pbf required feature %s"%(feature))
+
+
+def format_coord(nanodegrees):
+    """Coordinate in nanodegrees as a decimal string (same as the xml)"""
+    sign = '-' if nanodegrees < 0 else ''
+    whole, frac = divmod(abs(nanodegrees), 1000000000)
+    return '%s%d.%s'%(sign, whole, ('%09d'%(frac)).rstrip('0').ljust(7, '0'))
+
+
+def format_timestamp(milliseconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(milliseconds // 1000))
+
+
+def format_coords(values, offset, granularity):
+    """format_coord of each (granularity, offset coded) value.  With the default
+    granularity every coordinate has exactly 7 decimals, so they can be formatted
+    from floats (much faster than the exact integer formatting)."""
+    if granularity % 100 == 0 and offset % 100 == 0:
+        return ['%.7f'%((offset + granularity * v) * 1e-9) for v in values]
+    return [format_coord(offset + granularity * v) for v in values]
+
+
+class BlockDecoder(object):
+    """Decodes one PrimitiveBlock into OsmElements"""
+
+    def __init__(self, data):
+        self.data = data
+        self.strings = []
+        self.granularity = 100
+        self.lat_offset = 0
+        self.lon_offset = 0
+        self.date_granularity = 1000
+        self.timestamps = {}
+        self.groups = []
+        for field, wire, value in iter_fields(data):
+            if field == 1:
+                self.strings = [fix_text(str(s)) for f, w, s in iter_fields(value) if f == 1]
+            elif field == 2:
+                self.groups.append(value)
+            elif field == 17:
+                self.granularity = value
+            elif field == 18:
+                self.date_granularity = value
+            elif field == 19:
+                self.lat_offset = signed(value)
+            elif field == 20:
+                self.lon_offset = signed(value)
+
+    def elements(self):
+        elements = []
+        for group in self.groups:
+            for field, wire, value in iter_fields(group):
+                if field == 1:
+                    elements.append(self.node(value))
+                elif field == 2:
+                    elements.extend(self.dense_nodes(value))
+                elif field == 3:
+                    elements.append(self.way(value))
+                elif field == 4:
+                    elements.append(self.relation(value))
+        return elements
+
+    def position(self, attrib, lat, lon):
+        attrib['lat'] = format_coords([lat], self.lat_offset, self.granularity)[0]
+        attrib['lon'] = format_coords([lon], self.lon_offset, self.granularity)[0]
+
+    def timestamp(self, timestamp):
+        """Formatted timestamp (the date part is cached, as many elements in
+        a block were edited on the same day)"""
+        seconds = timestamp * self.date_granularity // 1000
+        day, seconds = divmod(seconds, 86400)
+        date = self.timestamps.get(day)
+        if date is None:
+            date = self.timestamps[day] = time.strftime('%Y-%m-%dT', time.gmtime(day * 86400))
+        minutes, seconds = divmod(seconds, 60)
+        return '%s%02d:%02d:%02dZ'%(date, minutes // 60, minutes % 60, seconds)
+
+    def info(self, attrib, version, timestamp, changeset, uid, user_sid, visible=None):
+        attrib['version'] = str(version)
+        attrib['timestamp'] = self.timestamp(timestamp)
+        attrib['changeset'] = str(changeset)
+        if uid or user_sid:
+            attrib['uid'] = str(uid)
+            attrib['user'] = self.strings[user_sid]
+        if visible is not None:
+            attrib['visible'] = 'true' if visible else 'false'
+
+    def decode_info(self, attrib, buf):
+        values = { 1 : 0, 2 : 0, 3 : 0, 4 : 0, 5 : 0 }
+        visible = None
+        for field, wire, value in iter_fields(buf):
+            if field == 6:
+                visible = bool(value)
+            elif field in values:
+                values[field] = value
+        self.info(attrib, signed(values[1]), signed(values[2]), signed(values[3]), signed(values[4]),
+                  values[5], visible)
+
+    def add_tags(self, elem, keys, vals):
+        strings = self.strings
+        for k, v in zip(keys, vals):
+            elem.children.append(OsmElement('tag', { 'k' : strings[k], 'v' : strings[v] }))
+
+    def node(self, buf):
+        attrib = {}
+        keys = vals = ()
+        lat = lon = 0
+        for field, wire, value in iter_fields(buf):
+            if field == 1:
+                attrib['id'] = str(zigzag(value))
+            elif field == 2:
+                keys = unpack_varints(value)
+            elif field == 3:
+                vals = unpack_varints(value)
+            elif field == 4:
+                self.decode_info(attrib, value)
+            elif field == 8:
+                lat = zigzag(value)
+            elif field == 9:
+                lon = zigzag(value)
+        self.position(attrib, lat, lon)
+        elem = OsmElement('node', attrib)
+        self.add_tags(elem, keys, vals)
+        return elem
+
+    def dense_nodes(self, buf):
+        ids = lats = lons = keys_vals = ()
+        info = None
+        for field, wire, value in iter_fields(buf):
+            if field == 1:
+                ids = unpack_deltas(value)
+            elif field == 5:
+                info = value
+            elif field == 8:
+                lats = unpack_deltas(value)
+            elif field == 9:
+                lons = unpack_deltas(value)
+            elif field == 10:
+                keys_vals = unpack_varints(value)
+        if info is not None:
+            info_fields = {}
+            for field, wire, value in iter_fields(info):
+                if field == 1:
+                    info_fields[field] = unpack_int32s(value)
+                elif field in (2, 3, 4, 5):
+                    info_fields[field] = unpack_deltas(value)
+                elif field == 6:
+                    info_fields[field] = unpack_varints(value)
+            versions = info_fields.get(1)
+            timestamps = info_fields.get(2)
+            changesets = info_fields.get(3)
+            uids = info_fields.get(4)
+            user_sids = info_fields.get(5)
+            visibles = info_fields.get(6)
+        strings = self.strings
+        lats = format_coords(lats, self.lat_offset, self.granularity)
+        lons = format_coords(lons, self.lon_offset, self.granularity)
+        has_info = info is not None and versions
+        elements = []
+        append = elements.append
+        kv = 0
+        for i in range(len(ids)):
+            attrib = { 'id' : str(ids[i]), 'lat' : lats[i], 'lon' : lons[i] }
+            if has_info:
+                attrib['version'] = str(versions[i])
+                attrib['timestamp'] = self.timestamp(timestamps[i])
+                attrib['changeset'] = str(changesets[i])
+                if uids[i] or user_sids[i]:
+                    attrib['uid'] = str(uids[i])
+                    attrib['user'] = strings[user_sids[i]]
+                if visibles:
+                    attrib['visible'] = 'true' if visibles[i] else 'false'
+            elem = OsmElement('node', attrib)
+            # keys_vals is (key, val) string indexes, each node's ended by a 0
+            if keys_vals:
+                while keys_vals[kv] != 0:
+                    elem.children.append(OsmElement('tag', { 'k' : strings[keys_vals[kv]],
+                                                             'v' : strings[keys_vals[kv + 1]] }))
+                    kv += 2
+                kv += 1
+            append(elem)
+        return elements
+
+    def way(self, buf):
+        attrib = {}
+        keys = vals = refs = ()
+        for field, wire, value in iter_fields(buf):
+            if field == 1:
+                attrib['id'] = str(value)
+            elif field == 2:
+                keys = unpack_varints(value)
+            elif field == 3:
+                vals = unpack_varints(value)
+            elif field == 4:
+                self.decode_info(attrib, value)
+            elif field == 8:
+                refs = unpack_deltas(value)
+        elem = OsmElement('way', attrib)
+        elem.children = [OsmElement('nd', { 'ref' : ref }) for ref in map(str, refs)]
+        self.add_tags(elem, keys, vals)
+        return elem
+
+    def relation(self, buf):
+        attrib = {}
+        keys = vals = roles = memids = types = ()
+        for field, wire, value in iter_fields(buf):
+            if field == 1:
+                attrib['id'] = str(value)
+            elif field == 2:
+                keys = unpack_varints(value)
+            elif field == 3:
+                vals = unpack_varints(value)
+            elif field == 4:
+                self.decode_info(attrib, value)
+            elif field == 8:
+                roles = unpack_int32s(value)
+            elif field == 9:
+                memids = unpack_deltas(value)
+            elif field == 10:
+                types = unpack_varints(value)
+        elem = OsmElement('relation', attrib)
+        for role, memid, member_type in zip(roles, memids, types):
+            elem.children.append(OsmElement('member', { 'type' : MEMBER_TYPES[member_type],
+                                                        'ref' : str(memid),
+                                                        'role' : self.strings[role] }))
+        self.add_tags(elem, keys, vals)
+        return elem
+
+
+def decode_blob(blob):
+    """OsmElements of an OSMData blob"""
+    return BlockDecoder(blob_data(blob)).elements()
+
+
+def iter_blobs(file_in):
+    """OSMData blobs of the file (a filename or file object), checking the header"""
+    fo = open(file_in, 'rb') if isinstance(file_in, basestring) else file_in
+    try:
+        while True:
+            block = read_fileblock(fo)
+            if block is None:
+                break
+            blob_type, blob = block
+            if blob_type == 'OSMHeader':
+                check_header(blob_data(blob))
+            elif blob_type == 'OSMData':
+                yield blob
+    finally:
+        if fo is not file_in:
+            fo.close()
+
+
+def iter_pbf(file_in, workers=None):
+    """Generator of the elements (OsmElements, see parsers.py) in the .pbf file
+    (a filename or file object).  If workers is specified, the blocks are decoded
+    across a pool of that many processes (a few blocks per worker ahead)."""
+    if not workers:
+        for blob in iter_blobs(file_in):
+            for elem in decode_blob(blob):
+                yield elem
+        return
+    for elements in iter_pool(decode_blob, iter_blobs(file_in), workers):
+        for elem in elements:
+            yield elem
+
+
+def iter_pool(func, blobs, workers):
+    """func(blob) of each blob, in order, computed across a pool of processes
+    (with only a couple of blobs per worker in flight)"""
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = deque()
+        for blob in blobs:
+            pending.append(pool.apply_async(func, (blob,)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# Writing (.osm to .osm.pbf)
+
+def encode_varint(value):
+    if value < 0:
+        value += 1 << 64
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return out
+
+
+def encode_zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def varint_field(field, value):
+    return encode_varint(field << 3 | WIRE_VARINT) + encode_varint(value)
+
+
+def bytes_field(field, data):
+    return encode_varint(field << 3 | WIRE_BYTES) + encode_varint(len(data)) + data
+
+
+def packed_field(field, values):
+    data = bytearray()
+    for value in values:
+        data += encode_varint(value)
+    return bytes_field(field, data)
+
+
+def deltas(values):
+    previous = 0
+    for value in values:
+        yield encode_zigzag(value - previous)
+        previous = value
+
+
+def parse_int(text):
+    """Integer attribute (ignoring any whitespace, i.e. from a line break in the xml)"""
+    return int(''.join(text.split()))
+
+
+def parse_coord(text):
+    """Coordinate string in units of the default granularity (100 nanodegrees)"""
+    return int(round(float(''.join(text.split())) * 10000000))
+
+
+def parse_timestamp(text):
+    """Seconds since the epoch of an xml timestamp (in units of the default date_granularity)"""
+    return calendar.timegm(time.strptime(text, '%Y-%m-%dT%H:%M:%SZ'))
+
+
+class BlockEncoder(object):
+    """Builds a PrimitiveBlock of elements (all of one type, as the spec requires per group)"""
+
+    def __init__(self):
+        self.strings = ['']
+        self.string_ids = { '' : 0 }
+
+    def sid(self, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        if text not in self.string_ids:
+            self.string_ids[text] = len(self.strings)
+            self.strings.append(text)
+        return self.string_ids[text]
+
+    def tags(self, elem):
+        return [(self.sid(t.attrib['k']), self.sid(t.attrib['v'])) for t in elem.iter('tag')]
+
+    def info(self, attrib):
+        return (parse_int(attrib.get('version', '0')),
+                parse_timestamp(attrib['timestamp']) if 'timestamp' in attrib else 0,
+                parse_int(attrib.get('changeset', '0')), parse_int(attrib.get('uid', '0')),
+                self.sid(attrib.get('user', '')))
+
+    def dense(self, nodes):
+        ids, lats, lons, keys_vals = [], [], [], []
+        infos = []
+        for elem in nodes:
+            ids.append(int(elem.attrib['id']))
+            lats.append(parse_coord(elem.attrib['lat']))
+            lons.append(parse_coord(elem.attrib['lon']))
+            infos.append(self.info(elem.attrib))
+            for k, v in self.tags(elem):
+                keys_vals.extend([k, v])
+            keys_vals.append(0)
+        versions, timestamps, changesets, uids, user_sids = zip(*infos)
+        dense_info = (packed_field(1, versions) + packed_field(2, deltas(timestamps)) +
+                      packed_field(3, deltas(changesets)) + packed_field(4, deltas(uids)) +
+                      packed_field(5, deltas(user_sids)))
+        return bytes_field(2, packed_field(1, deltas(ids)) + bytes_field(5, dense_info) +
+                           packed_field(8, deltas(lats)) + packed_field(9, deltas(lons)) +
+                           packed_field(10, keys_vals))
+
+    def element_info(self, attrib):
+        version, timestamp, changeset, uid, user_sid = self.info(attrib)
+        return bytes_field(4, varint_field(1, version) + varint_field(2, timestamp) +
+                           varint_field(3, changeset) + varint_field(4, uid) + varint_field(5, user_sid))
+
+    def way(self, elem):
+        tags = self.tags(elem)
+        refs = [int(nd.attrib['ref']) for nd in elem.iter('nd')]
+        return bytes_field(3, varint_field(1, int(elem.attrib['id'])) +
+                           packed_field(2, [k for k, v in tags]) + packed_field(3, [v for k, v in tags]) +
+                           self.element_info(elem.attrib) + packed_field(8, deltas(refs)))
+
+    def relation(self, elem):
+        tags = self.tags(elem)
+        members = list(elem.iter('member'))
+        return bytes_field(4, varint_field(1, int(elem.attrib['id'])) +
+                           packed_field(2, [k for k, v in tags]) + packed_field(3, [v for k, v in tags]) +
+                           self.element_info(elem.attrib) +
+                           packed_field(8, [self.sid(m.attrib.get('role', '')) for m in members]) +
+                           packed_field(9, deltas([int(m.attrib['ref']) for m in members])) +
+                           packed_field(10, [MEMBER_TYPES.index(m.attrib['type']) for m in members]))
+
+    def block(self, tag, elements):
+        if tag == 'node':
+            group = self.dense(elements)
+        else:
+            encode = self.way if tag == 'way' else self.relation
+            group = bytearray()
+            for elem in elements:
+                group += encode(elem)
+        string_table = bytearray()
+        for text in self.strings:
+            string_table += bytes_field(1, bytearray(text))
+        return bytes_field(1, string_table) + bytes_field(2, group)
+
+
+def fileblock(blob_type, data):
+    blob = varint_field(2, len(data)) + bytes_field(3, bytearray(zlib.compress(str(data))))
+    header = bytes_field(1, bytearray(blob_type)) + varint_field(3, len(blob))
+    return struct.pack('>I', len(header)) + str(header) + str(blob)
+
+
+def osm_to_pbf(file_in, file_out, block_elements=BLOCK_ELEMENTS):
+    """Writes the nodes, ways and relations of an .osm (xml) file as an .osm.pbf file
+    (dense nodes, zlib compressed blocks).  Returns the number of elements written."""
+    count = 0
+    with open(file_out, 'wb') as fo:
+        header = bytes_field(4, bytearray('OsmSchema-V0.6')) + bytes_field(4, bytearray('DenseNodes')) + \
+                 bytes_field(16, bytearray('OpenStreetMaps pbf.py'))
+        fo.write(fileblock('OSMHeader', header))
+        batch = []
+        for elem in iter_elements(file_in, 'expat'):
+            if elem.tag not in MEMBER_TYPES:
+                continue
+            if batch and (elem.tag != batch[-1].tag or len(batch) >= block_elements):
+                fo.write(fileblock('OSMData', BlockEncoder().block(batch[-1].tag, batch)))
+                batch = []
+            batch.append(elem)
+            count += 1
+        if batch:
+            fo.write(fileblock('OSMData', BlockEncoder().block(batch[-1].tag, batch)))
+    return count
+
+
+def test():
+    import os
+    import tempfile
+    import data
+    assert format_coord(375601845 * 100) == '37.5601845'
+    assert format_coord(-1223025783 * 100) == '-122.3025783'
+    assert format_coord(-5 * 100) == '-0.0000005'
+    assert BlockDecoder(bytearray()).timestamp(1402858515) == format_timestamp(1402858515000) == '2014-06-15T18:55:15Z'
+    assert unpack_sints(bytearray(encode_varint(encode_zigzag(-3)) + encode_varint(encode_zigzag(150)))) == [-3, 150]
+    fd, path = tempfile.mkstemp(suffix=".osm.pbf")
+    os.close(fd)
+    try:
+        count = osm_to_pbf(OSMFILE, path, block_elements=50)
+        assert is_pbf(path) and not is_pbf(OSMFILE)
+        expected = [e for e in iter_elements(OSMFILE, 'expat') if e.tag in MEMBER_TYPES]
+        for e in expected:
+            # .pbf stores the metadata as integers
+            e.attrib['changeset'] = ''.join(e.attrib['changeset'].split())
+        for workers in (None, 2):
+            found = list(iter_pbf(path, workers))
+            assert len(found) == len(expected) == count
+            for a, b in zip(found, expected):
+                assert a.tag == b.tag and set(a.attrib) == set(b.attrib)
+                assert [(c.tag, c.attrib) for c in a.children] == [(c.tag, c.attrib) for c in b.children]
+                assert data.shape_element(a) == data.shape_element(b)
+        print "Read %d elements from %s (%d bytes, %d as xml)"%(count, path, os.path.getsize(path),\
+            os.path.getsize(OSMFILE))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,231 @@
+"""
+Compact records for holding many shaped elements in memory (i.e. data.process_map
+with keep_data), converted back to the shaped dictionaries only when needed.
+
+A shaped node is a dictionary with a nested 'created' dictionary and a 'pos'
+list of two floats, and a way a list of node_refs strings, so each element takes
+well over a kilobyte as python objects.  ShapedRecord keeps the fixed parts in
+__slots__ instead:
+    type        'node' or 'way'
+    id          int
+    created     tuple of the CREATED values, version/changeset/uid as ints,
+                user names shared between records
+    pos         array of 2 doubles
+    node_refs   array of ints (if a C long is 64 bits, otherwise left in fields)
+    fields      dictionary of everything else (the shaped tags), or None
+    keys        keys of the shaped dictionary, in their original order (shared
+                between records with the same keys)
+Anything that doesn't have the usual form (i.e. an id that isn't a plain
+integer, or a 'created' dictionary with a tag added to it) stays in fields
+unchanged, so to_doc always returns a dictionary equal to the shaped one (though
+its keys may iterate in a different order, i.e. in the json output).
+
+>>> records = RecordList.from_docs(data.iter_shaped(OSMFILE))
+>>> records[0]['pos']
+[-122.3025783, 37.5601845]
+"""
+from array import array
+
+#OSMFILE = "../example.osm"
+OSMFILE = "../example_sf.osm"
+#OSMFILE = "../san-francisco.osm"
+
+CREATED = ("version", "changeset", "timestamp", "user", "uid")
+INT_CREATED = ("version", "changeset", "uid")
+FIXED_KEYS = ("type", "id", "created", "pos", "node_refs")
+MISSING = object()
+# Node ids are past 2^31, so node_refs are only packed into an array of longs if
+# they're 64 bits (not on Windows or 32 bit builds)
+NODE_REF_TYPECODE = 'l' if array('l').itemsize >= 8 else None
+
+# Values shared between records: user names, and the key orders
+shared = {}
+
+
+def share(value):
+    return shared.setdefault(value, value)
+
+
+def plain_int(val):
+    """val as an int if it's the plain decimal string of that int, else None"""
+    if type(val) is str and val.isdigit() and (val == '0' or val[0] != '0'):
+        return int(val)
+    return None
+
+
+def compact_created(created):
+    """The 'created' dictionary as a tuple of its values (MISSING for any of
+    CREATED that it doesn't have), or None if it has any other keys"""
+    if type(created) is not dict or not set(created).issubset(CREATED):
+        return None
+    values = []
+    for key in CREATED:
+        val = created.get(key, MISSING)
+        if key in INT_CREATED and val is not MISSING:
+            num = plain_int(val)
+            if num is not None:
+                val = num
+        elif key == 'user' and val is not MISSING:
+            val = share(val)
+        values.append(val)
+    return tuple(values)
+
+
+def expand_created(values):
+    created = {}
+    for key, val in zip(CREATED, values):
+        if val is not MISSING:
+            created[key] = str(val) if type(val) is int else val
+    return created
+
+
+class ShapedRecord(object):
+    """Compact form of a shaped element (see the module docstring)"""
+    __slots__ = ('type', 'id', 'created', 'pos', 'node_refs', 'fields', 'keys')
+
+    def __init__(self):
+        self.type = None
+        self.id = None
+        self.created = None
+        self.pos = None
+        self.node_refs = None
+        self.fields = None
+        self.keys = None
+
+    @classmethod
+    def from_doc(cls, doc):
+        record = cls()
+        fields = {}
+        for key, val in doc.iteritems():
+            if key == 'type' and val in ('node', 'way'):
+                record.type = share(val)
+            elif key == 'id' and plain_int(val) is not None:
+                record.id = int(val)
+            elif key == 'created' and record.created is None:
+                record.created = compact_created(val)
+                if record.created is None:
+                    fields[key] = val
+            elif key == 'pos' and type(val) is list and len(val) == 2 and \
+                 all(type(v) is float for v in val):
+                record.pos = array('d', val)
+            elif key == 'node_refs' and NODE_REF_TYPECODE and type(val) is list and \
+                 all(plain_int(v) is not None for v in val):
+                try:
+                    record.node_refs = array(NODE_REF_TYPECODE, [int(v) for v in val])
+                except OverflowError:
+                    fields[key] = val
+            else:
+                fields[key] = val
+        if fields:
+            record.fields = fields
+        record.keys = share(tuple(doc))
+        return record
+
+    def get(self, key):
+        """Value of the key in the shaped dictionary (MISSING if it isn't there)"""
+        if key == 'type':
+            return self.type if self.type is not None else self.fields.get(key, MISSING)
+        if key == 'id':
+            return str(self.id) if self.id is not None else self.fields.get(key, MISSING)
+        if key == 'created':
+            return expand_created(self.created) if self.created is not None else self.fields.get(key, MISSING)
+        if key == 'pos':
+            return self.pos.tolist() if self.pos is not None else self.fields.get(key, MISSING)
+        if key == 'node_refs':
+            return map(str, self.node_refs) if self.node_refs is not None else self.fields.get(key, MISSING)
+        return self.fields.get(key, MISSING) if self.fields is not None else MISSING
+
+    def to_doc(self):
+        """The shaped dictionary (a new copy each time)"""
+        doc = {}
+        for key in self.keys:
+            doc[key] = self.get(key)
+        return doc
+
+
+class RecordList(object):
+    """List of shaped dictionaries, stored as ShapedRecords
+    (each dictionary is built as it's accessed)"""
+
+    def __init__(self, records=()):
+        self.records = list(records)
+
+    @classmethod
+    def from_docs(cls, docs):
+        return cls(ShapedRecord.from_doc(doc) for doc in docs)
+
+    def append_doc(self, doc):
+        self.records.append(ShapedRecord.from_doc(doc))
+
+    def keeping(self, docs):
+        """Yields the docs unchanged, adding each one to the list as it goes
+        (i.e. to write them out while keeping them)"""
+        for doc in docs:
+            self.append_doc(doc)
+            yield doc
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [record.to_doc() for record in self.records[index]]
+        return self.records[index].to_doc()
+
+    def __iter__(self):
+        for record in self.records:
+            yield record.to_doc()
+
+    def __eq__(self, other):
+        try:
+            if len(self) != len(other):
+                return False
+        except TypeError:
+            return NotImplemented
+        return all(a == b for a, b in zip(self, other))
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+
+def deep_size(obj, seen=None):
+    """Approximate memory used by obj and everything it references (not shared
+    with anything already counted)"""
+    import sys
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_size(v, seen) for v in obj)
+    elif isinstance(obj, ShapedRecord):
+        size += sum(deep_size(getattr(obj, name), seen) for name in ShapedRecord.__slots__)
+    elif isinstance(obj, RecordList):
+        size += deep_size(obj.records, seen)
+    return size
+
+
+def test():
+    import data
+    docs = list(data.iter_shaped(OSMFILE))
+    records = RecordList.from_docs(docs)
+    assert records == docs and len(records) == len(docs)
+    assert records[0] == docs[0] and records[-3:] == docs[-3:]
+    odd = { 'type' : 'way', 'id' : '0012', 'created' : { 'user' : 'x', 'created_key' : 'y' },
+            'pos' : [1.0], 'node_refs' : ['1', ' 2'], 'name' : 'Odd' }
+    assert ShapedRecord.from_doc(odd).to_doc() == odd
+    big = { 'type' : 'way', 'id' : '1', 'node_refs' : [str(2 ** 33), str(2 ** 64)] }
+    assert ShapedRecord.from_doc(big).to_doc() == big
+    plain_size = deep_size(docs)
+    record_size = deep_size(records)
+    print "%d documents: %d bytes as dictionaries, %d bytes as records (%.0f%%)"%(len(docs), plain_size,\
+        record_size, 100.0 * record_size / plain_size)
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Runs all of the file based audits (mapparser.py, users.py, tags.py and audit.py)
+from a single iterative parse of the map file.
+
+Each of those modules runs its own ET.iterparse over the whole file, so auditing
+the large san-francisco.osm file meant parsing it four times.  Here every element
+is handed to a list of analyzer objects, one parse drives all of them, and elements
+are cleared as soon as they are done (same approach as data.mongo_process_map).
+
+Each analyzer keeps its own results, which can be merged with the results of
+another analyzer of the same type (i.e. when separate files or separate pieces
+of a file were scanned), and returns them in the same format as the original
+module function:
+    UserCounter     -> users.process_map
+    KeyTypeCounter  -> tags.process_map
+    TagCounter      -> mapparser.count_tags
+    AuditAnalyzer   -> audit.audit
+
+>>> import scan
+>>> results = scan.scan_map(scan.OSMFILE)
+>>> results['users']['oldtopos']
+"""
+import xml.etree.cElementTree as ET
+from collections import defaultdict
+import pprint
+from tags import key_type
+from audit import audit_element
+from compressed import opened_osm
+
+#OSMFILE = "../example.osm"
+OSMFILE = "../example_sf.osm"
+#OSMFILE = "../san-francisco.osm"
+
+# Top level elements that can be cleared once every analyzer has seen them
+TOP_LEVEL = ("node", "way", "relation")
+
+
+def merge_counts(counts, other):
+    """Adds the counts from the other dictionary into counts"""
+    for key, cnt in other.iteritems():
+        counts[key] = counts.get(key, 0) + cnt
+    return counts
+
+
+class Analyzer(object):
+    """Base analyzer, process is called with every element once it has been
+    completely parsed (the 'end' event, so all child tags are available)"""
+    name = None
+
+    def process(self, elem):
+        pass
+
+    def merge(self, other):
+        """Folds the results of another analyzer of the same type into this one"""
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+
+class UserCounter(Analyzer):
+    """Number of elements each user has contributed (users.process_map)"""
+    name = 'users'
+
+    def __init__(self):
+        self.users = {}
+
+    def process(self, elem):
+        username = elem.attrib.get('user')
+        if username is not None:
+            self.users[username] = self.users.get(username, 0) + 1
+
+    def merge(self, other):
+        merge_counts(self.users, other.users)
+        return self
+
+    def result(self):
+        return self.users
+
+
+class TagCounter(Analyzer):
+    """Number of times each xml tag was seen (mapparser.count_tags)"""
+    name = 'tags'
+
+    def __init__(self):
+        self.xml_dict = {}
+
+    def process(self, elem):
+        self.xml_dict[elem.tag] = self.xml_dict.get(elem.tag, 0) + 1
+
+    def merge(self, other):
+        merge_counts(self.xml_dict, other.xml_dict)
+        return self
+
+    def result(self):
+        return self.xml_dict
+
+
+class KeyTypeCounter(Analyzer):
+    """Categorizes the 'k' value of each <tag> (tags.process_map)"""
+    name = 'key_types'
+
+    def __init__(self):
+        self.keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
+
+    def process(self, elem):
+        if elem.tag == "tag":
+            # key_type standardizes the key in place, put the original back
+            # so the analyzers that run afterwards see the unmodified element
+            orig_key = elem.attrib['k']
+            key_type(elem, self.keys)
+            elem.attrib['k'] = orig_key
+
+    def merge(self, other):
+        merge_counts(self.keys, other.keys)
+        return self
+
+    def result(self):
+        return self.keys
+
+
+class AuditAnalyzer(Analyzer):
+    """Street types, city names and dog related tags (audit.audit)"""
+    name = 'audit'
+
+    def __init__(self):
+        self.street_types = defaultdict(set)
+        self.city_names = defaultdict(set)
+        self.dog_dict = defaultdict(dict)
+
+    def process(self, elem):
+        audit_element(elem, self.street_types, self.city_names, self.dog_dict)
+
+    def merge(self, other):
+        for street_type, names in other.street_types.iteritems():
+            self.street_types[street_type].update(names)
+        merge_counts(self.city_names, other.city_names)
+        for key, vals in other.dog_dict.iteritems():
+            merge_counts(self.dog_dict[key], vals)
+        return self
+
+    def result(self):
+        return self.street_types, self.city_names, self.dog_dict
+
+
+def default_analyzers():
+    return [UserCounter(), KeyTypeCounter(), TagCounter(), AuditAnalyzer()]
+
+
+def run_analyzers(filename, analyzers):
+    """Iteratively parses the file once, passing each element to every analyzer.
+    Top level elements are cleared after all analyzers have processed them."""
+    with opened_osm(filename) as osm_file:
+        context = iter(ET.iterparse(osm_file, events=("start", "end")))
+        event, root = context.next() # get the root element
+        for event, elem in context:
+            if event == "end":
+                for analyzer in analyzers:
+                    analyzer.process(elem)
+                if elem.tag in TOP_LEVEL:
+                    elem.clear()
+                    root.clear()
+    return analyzers
+
+
+def scan_map(filename, analyzers=None):
+    """Runs the analyzers (all of them by default) over the file in a single pass,
+    and returns a dictionary of analyzer name to that analyzer's results"""
+    if analyzers is None:
+        analyzers = default_analyzers()
+    run_analyzers(filename, analyzers)
+    return dict((analyzer.name, analyzer.result()) for analyzer in analyzers)
+
+
+def test():
+    results = scan_map(OSMFILE)
+    pprint.pprint(results['tags'])
+    pprint.pprint(results['key_types'])
+    print 'Total # of Users: %d'%(len(results['users']))
+    st_types, cty_names, dog_tags = results['audit']
+    pprint.pprint(dict(st_types))
+    pprint.pprint(dict(cty_names))
+    pprint.pprint(dict(dog_tags))
+
+    # Same results as parsing the file separately for each module
+    import users, tags, mapparser, audit
+    assert results['users'] == users.process_map(OSMFILE)
+    assert results['key_types'] == tags.process_map(OSMFILE)
+    assert results['tags'] == mapparser.count_tags(OSMFILE)
+    assert results['audit'] == audit.audit(OSMFILE)
+
+    # Merging two scans of the file doubles every count
+    merged = run_analyzers(OSMFILE, [UserCounter()])[0]
+    merged.merge(run_analyzers(OSMFILE, [UserCounter()])[0])
+    for username, cnt in merged.result().iteritems():
+        assert cnt == 2 * results['users'][username]
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,284 @@
+"""
+Output sinks for the shaped documents, i.e. from data.iter_shaped.
+Each sink consumes an iterable of shaped documents one at a time,
+so documents are never all held in memory (unless a list is passed in).
+
+The file sinks encode the documents in batches of encode_batch, writing each
+batch's output with one write to a large buffered file.  With workers, the
+batches are encoded in that many processes (in order, only a few batches ahead
+of the writer); this only pays off when shaping isn't the bottleneck, since the
+documents have to be pickled to the workers (which can also change the order of
+the keys within each document, the documents are the same).
+    write_json  json lines, for mongoimport
+    write_bson  concatenated BSON documents (a .bson dump), for mongorestore, i.e.
+                mongorestore -d OpenStreetMaps -c SanFrancisco san-francisco.osm.bson
+                which skips encoding and re-parsing json altogether
+write_sharded splits either format into several files, <file>.<shard>.json/.bson,
+by a hash of the element id (shards files) or by element type (one file each),
+so they can be loaded over several connections at once (see loader.py).
+
+>>> import data, sinks
+>>> sinks.write_json(data.iter_shaped(data.OSMFILE), data.OSMFILE + ".json")
+>>> sinks.write_bson(data.iter_shaped(data.OSMFILE), data.OSMFILE + ".bson", workers=2)
+>>> sinks.write_sharded(data.iter_shaped(data.OSMFILE), data.OSMFILE, 4, sinks.BSON_DUMP)
+>>> sinks.insert_mongo(data.iter_shaped(data.OSMFILE), data.get_collection())
+"""
+import json
+import multiprocessing
+import time
+import zlib
+from collections import deque, defaultdict
+from bson import BSON
+from bulk_writer import BulkWriter, DEFAULT_BATCH_SIZE, DEFAULT_BATCH_BYTES, DEFAULT_WRITERS
+
+JSON = 'json'
+BSON_DUMP = 'bson'
+SHARD_BY_ID = 'id'
+SHARD_BY_TYPE = 'type'
+DEFAULT_ENCODE_BATCH = 1000
+WRITE_BUFFER = 4 * 1024 * 1024
+
+
+def encode_json(batch, pretty=False):
+    if pretty:
+        return "".join(json.dumps(el, indent=2) + "\n" for el in batch)
+    return "".join(json.dumps(el) + "\n" for el in batch)
+
+
+def encode_json_pretty(batch):
+    return encode_json(batch, True)
+
+
+def encode_bson(batch):
+    return "".join(BSON.encode(el) for el in batch)
+
+
+def iter_batches(shaped, batch_size):
+    batch = []
+    for el in shaped:
+        batch.append(el)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_shard_batches(shaped, shard_of, batch_size):
+    """(shard, batch) of up to batch_size documents of the same shard"""
+    batches = defaultdict(list)
+    for el in shaped:
+        shard = shard_of(el)
+        batch = batches[shard]
+        batch.append(el)
+        if len(batch) >= batch_size:
+            yield shard, batch
+            del batches[shard]
+    for shard in sorted(batches):
+        yield shard, batches[shard]
+
+
+def iter_encoded_batches(batches, encode, workers=None):
+    """(tag, number of documents, encoded string) for each (tag, batch) of documents,
+    in order, encoded in workers processes if workers > 1"""
+    if not workers or workers <= 1:
+        for tag, batch in batches:
+            yield tag, len(batch), encode(batch)
+        return
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = deque()
+        for tag, batch in batches:
+            pending.append((tag, len(batch), pool.apply_async(encode, (batch,))))
+            if len(pending) >= 2 * workers:
+                tag, n, result = pending.popleft()
+                yield tag, n, result.get()
+        while pending:
+            tag, n, result = pending.popleft()
+            yield tag, n, result.get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def iter_encoded(shaped, encode, workers=None, batch_size=DEFAULT_ENCODE_BATCH):
+    """(number of documents, encoded string) for each batch of documents, in order,
+    encoded in workers processes if workers > 1"""
+    batches = ((None, batch) for batch in iter_batches(shaped, batch_size))
+    for _, n, data in iter_encoded_batches(batches, encode, workers):
+        yield n, data
+
+
+def write_encoded(shaped, file_out, encode, workers=None, batch_size=DEFAULT_ENCODE_BATCH):
+    """Writes the encoded batches to file_out, returns the number of documents written"""
+    count = 0
+    with open(file_out, "wb", WRITE_BUFFER) as fo:
+        for n, data in iter_encoded(shaped, encode, workers, batch_size):
+            fo.write(data)
+            count += n
+    return count
+
+
+def write_json(shaped, file_out, pretty=False, workers=None, batch_size=DEFAULT_ENCODE_BATCH):
+    """Writes each document as json to file_out (one document per line
+    unless pretty), which can be loaded using mongoimport.
+    Returns the number of documents written"""
+    return write_encoded(shaped, file_out, get_encoder(JSON, pretty), workers, batch_size)
+
+
+def write_bson(shaped, file_out, workers=None, batch_size=DEFAULT_ENCODE_BATCH):
+    """Writes each document as BSON to file_out, which can be loaded using
+    mongorestore.  Returns the number of documents written"""
+    return write_encoded(shaped, file_out, encode_bson, workers, batch_size)
+
+
+def get_encoder(output, pretty=False):
+    if output == JSON:
+        return encode_json_pretty if pretty else encode_json
+    if output == BSON_DUMP:
+        return encode_bson
+    raise ValueError("Unknown output %s, expected '%s' or '%s'"%(output, JSON, BSON_DUMP))
+
+
+def shard_by_id(shards):
+    """Shard number (0 to shards - 1) of an element from the crc32 of its id,
+    the same on every run and platform (unlike hash)"""
+    return lambda el: (zlib.crc32(str(el['id'])) & 0xffffffff) % shards
+
+
+def shard_by_type(el):
+    return el['type']
+
+
+def write_sharded(shaped, file_in, shards, output=JSON, shard_by=SHARD_BY_ID, pretty=False,
+                  workers=None, batch_size=DEFAULT_ENCODE_BATCH):
+    """Writes the documents to <file_in>.<shard>.json or .bson files, with shard_by
+    SHARD_BY_ID the shards files 0 to shards - 1 by a hash of the id, or with
+    SHARD_BY_TYPE one file per element type (i.e. <file_in>.node.json).
+    Returns a dictionary of each file written and its number of documents"""
+    encode = get_encoder(output, pretty)
+    if shard_by == SHARD_BY_ID:
+        shard_of = shard_by_id(shards)
+        names = range(shards)
+    elif shard_by == SHARD_BY_TYPE:
+        shard_of = shard_by_type
+        names = []
+    else:
+        raise ValueError("Unknown shard_by %s, expected '%s' or '%s'"%(shard_by, SHARD_BY_ID,
+                                                                     SHARD_BY_TYPE))
+    files = {}
+    counts = {}
+
+    def shard_file(shard):
+        if shard not in files:
+            path = shard_path(file_in, shard, output)
+            files[shard] = open(path, "wb", WRITE_BUFFER)
+            counts[path] = 0
+        return files[shard]
+
+    try:
+        # Every id shard gets a file, even if it ends up empty
+        for shard in names:
+            shard_file(shard)
+        batches = iter_shard_batches(shaped, shard_of, batch_size)
+        for shard, n, data in iter_encoded_batches(batches, encode, workers):
+            shard_file(shard).write(data)
+            counts[shard_path(file_in, shard, output)] += n
+    finally:
+        for fo in files.values():
+            fo.close()
+    return counts
+
+
+def write_file(shaped, file_in, output=JSON, pretty=False, workers=None, shards=None,
+               shard_by=SHARD_BY_ID):
+    """Writes the documents to <file_in>.json or <file_in>.bson (output JSON or
+    BSON_DUMP), or split into shard files if shards or shard_by SHARD_BY_TYPE
+    (see write_sharded), returns the number of documents written"""
+    if shards or shard_by == SHARD_BY_TYPE:
+        return sum(write_sharded(shaped, file_in, shards, output, shard_by, pretty, workers).values())
+    return write_encoded(shaped, output_path(file_in, output), get_encoder(output, pretty), workers)
+
+
+def output_path(file_in, output=JSON):
+    return "{0}.{1}".format(file_in, output)
+
+
+def shard_path(file_in, shard, output=JSON):
+    return "{0}.{1}.{2}".format(file_in, shard, output)
+
+
+def insert_mongo(shaped, docs, batch_size=DEFAULT_BATCH_SIZE, batch_bytes=DEFAULT_BATCH_BYTES,
+                 verbose=False, stats=None, writers=DEFAULT_WRITERS):
+    """Inserts each document into the docs collection using batched bulk inserts,
+    with up to writers batches being written at once (see bulk_writer.py).  stats (a PipelineStats, see stats.py) records the time
+    handing documents to the writer ('insert') and the time spent writing the
+    batches ('write', on the writer threads).  Returns the writer, for its stats/report."""
+    writer = BulkWriter(docs, batch_size, batch_bytes, verbose=verbose, writers=writers)
+    try:
+        if stats is None:
+            for el in shaped:
+                writer.insert(el)
+        else:
+            for el in shaped:
+                start = time.time()
+                writer.insert(el)
+                stats.add_time('insert', time.time() - start)
+    finally:
+        writer.close()
+        if stats is not None:
+            stats.add_time('write', sum(t for _, _, t in writer.batch_stats))
+            stats.count('docs_written', writer.num_written())
+    return writer
+
+
+def test():
+    import os
+    import tempfile
+    from bson import decode_all
+    import data
+    docs = list(data.iter_shaped("../example_sf.osm"))
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        json_path = os.path.join(tmp_dir, "test.json")
+        assert write_json(iter(docs), json_path, batch_size=7) == len(docs)
+        with open(json_path) as fi:
+            assert fi.read() == "".join(json.dumps(el) + "\n" for el in docs)
+        assert write_json(docs, json_path, pretty=True, batch_size=7) == len(docs)
+        with open(json_path) as fi:
+            assert fi.read() == "".join(json.dumps(el, indent=2) + "\n" for el in docs)
+        expected = json.loads(json.dumps(docs))
+        for workers in [None, 2]:
+            assert write_json(iter(docs), json_path, workers=workers, batch_size=7) == len(docs)
+            with open(json_path) as fi:
+                assert [json.loads(line) for line in fi] == expected
+            bson_path = os.path.join(tmp_dir, "test.bson")
+            assert write_bson(iter(docs), bson_path, workers=workers, batch_size=7) == len(docs)
+            with open(bson_path, "rb") as fi:
+                assert decode_all(fi.read()) == expected
+        sharded = os.path.join(tmp_dir, "test")
+        for workers in [None, 2]:
+            counts = write_sharded(iter(docs), sharded, 3, BSON_DUMP, workers=workers, batch_size=7)
+            assert len(counts) == 3 and sum(counts.values()) == len(docs)
+            loaded = []
+            for path in sorted(counts):
+                with open(path, "rb") as fi:
+                    shard_docs = decode_all(fi.read())
+                assert len(shard_docs) == counts[path]
+                assert len(set(shard_by_id(3)(el) for el in shard_docs)) <= 1
+                loaded.extend(shard_docs)
+            key = lambda el: (el['type'], el['id'])
+            assert sorted(loaded, key=key) == sorted(expected, key=key)
+        counts = write_sharded(docs, sharded, None, JSON, SHARD_BY_TYPE)
+        assert counts[shard_path(sharded, 'node')] == sum(1 for el in docs if el['type'] == 'node')
+        assert sum(counts.values()) == len(docs)
+        print "Wrote %d documents as json and bson, and in shards"%(len(docs))
+    finally:
+        for name in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, name))
+        os.rmdir(tmp_dir)
+
+
+if __name__ == '__main__':
+    test()
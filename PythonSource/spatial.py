@@ -0,0 +1,239 @@
+"""
+In-process spatial index over shaped documents, for nearest neighbor and radius
+queries without a MongoDB server (mongo_audit.get_near_loc and dog_related with
+near_loc use the $near/$geoNear operators of a legacy 2d index).
+
+Documents are bucketed by their 'pos' [lon, lat] into a uniform grid of cells
+(cell_size degrees on a side).  Distances are flat (euclidean) distances in
+degrees, the same as MongoDB's 2d index, so results match $near/$geoNear.
+The index can be built from any iterable of shaped documents (i.e.
+data.iter_shaped), the json output of data.process_map, or a NodeStore.
+
+Queries can be filtered using the same queries as MongoDB (see dog_query.py),
+or the index can be narrowed down once with subset() (i.e. to only the dog
+related documents) when running lots of queries with the same filter.
+
+>>> import spatial
+>>> index = spatial.GridIndex.from_json("../san-francisco.osm.json")
+>>> spatial.dog_related(index, [-122.39044189454,37.776148988564], near_limit=5)
+"""
+import heapq
+import json
+import math
+from dog_query import dog_qry, matches_query
+
+#OSMFILE = "../example.osm"
+OSMFILE = "../example_sf.osm"
+#OSMFILE = "../san-francisco.osm"
+
+DEFAULT_CELL_SIZE = 0.01
+# Same maxDistance used by mongo_audit.get_nearby_dog_pipeline
+DOG_MAX_DISTANCE = 0.05
+
+
+class GridIndex(object):
+    """Uniform grid of documents, keyed by (x, y) cell of their pos"""
+
+    def __init__(self, cell_size=DEFAULT_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.count = 0
+        self.min_cell = None
+        self.max_cell = None
+
+    def __len__(self):
+        return self.count
+
+    def cell(self, lon, lat):
+        return (int(math.floor(lon / self.cell_size)), int(math.floor(lat / self.cell_size)))
+
+    def add(self, doc):
+        """Adds the document, if it has a [lon, lat] pos. Returns whether it was added."""
+        pos = doc.get('pos')
+        if not isinstance(pos, list) or len(pos) != 2:
+            return False
+        lon, lat = float(pos[0]), float(pos[1])
+        cell = self.cell(lon, lat)
+        self.cells.setdefault(cell, []).append((lon, lat, doc))
+        self.count += 1
+        if self.min_cell is None:
+            self.min_cell = self.max_cell = cell
+        else:
+            self.min_cell = (min(self.min_cell[0], cell[0]), min(self.min_cell[1], cell[1]))
+            self.max_cell = (max(self.max_cell[0], cell[0]), max(self.max_cell[1], cell[1]))
+        return True
+
+    @classmethod
+    def from_docs(cls, docs, query=None, cell_size=DEFAULT_CELL_SIZE):
+        """Builds the index from an iterable of shaped documents,
+        only keeping those that match the query (if any)"""
+        index = cls(cell_size)
+        for doc in docs:
+            if query is None or matches_query(doc, query):
+                index.add(doc)
+        return index
+
+    @classmethod
+    def from_json(cls, file_in, query=None, cell_size=DEFAULT_CELL_SIZE):
+        """Builds the index from the json output of data.process_map
+        (one document per line)"""
+        with open(file_in) as fi:
+            return cls.from_docs((json.loads(line) for line in fi if line.strip()), query, cell_size)
+
+    @classmethod
+    def from_node_store(cls, node_store, cell_size=DEFAULT_CELL_SIZE):
+        """Builds the index of node positions from a NodeStore (nodestore.py),
+        the documents only contain the node 'id' and 'pos'"""
+        index = cls(cell_size)
+        for node_id, pos in zip(node_store.ids.tolist(), node_store.coords.tolist()):
+            index.add({ "id" : str(node_id), "pos" : pos })
+        return index
+
+    def subset(self, query=None, predicate=None):
+        """New index of only the documents matching the query and/or predicate
+        function (evaluated once per document, rather than on every search)"""
+        index = GridIndex(self.cell_size)
+        for entries in self.cells.itervalues():
+            for lon, lat, doc in entries:
+                if (query is None or matches_query(doc, query)) and \
+                   (predicate is None or predicate(doc)):
+                    index.add(doc)
+        return index
+
+    def _ring(self, center, r):
+        """Cells that are exactly r cells away (chebyshev distance) from center"""
+        cx, cy = center
+        if r == 0:
+            yield center
+            return
+        for x in xrange(cx - r, cx + r + 1):
+            yield (x, cy - r)
+            yield (x, cy + r)
+        for y in xrange(cy - r + 1, cy + r):
+            yield (cx - r, y)
+            yield (cx + r, y)
+
+    def _max_ring(self, center):
+        if self.min_cell is None:
+            return -1
+        return max(abs(center[0] - self.min_cell[0]), abs(center[0] - self.max_cell[0]),
+                   abs(center[1] - self.min_cell[1]), abs(center[1] - self.max_cell[1]))
+
+    def nearest(self, lon, lat, k=5, max_distance=None, query=None, predicate=None):
+        """k closest documents to [lon, lat] (within max_distance, if given) that
+        match the query/predicate.  Returns a list of (distance, doc), closest first."""
+        if k <= 0:
+            return []
+        center = self.cell(lon, lat)
+        max_ring = self._max_ring(center)
+        if max_distance is not None:
+            max_ring = min(max_ring, int(math.ceil(max_distance / self.cell_size)) + 1)
+        best = [] # heap of (-distance, n, doc), so the furthest of the k best is first
+        n = 0
+        r = 0
+        while r <= max_ring:
+            for cell in self._ring(center, r):
+                for plon, plat, doc in self.cells.get(cell, ()):
+                    dist = math.hypot(plon - lon, plat - lat)
+                    if max_distance is not None and dist > max_distance:
+                        continue
+                    if len(best) == k and dist >= -best[0][0]:
+                        continue
+                    if (query is not None and not matches_query(doc, query)) or \
+                       (predicate is not None and not predicate(doc)):
+                        continue
+                    n += 1
+                    if len(best) < k:
+                        heapq.heappush(best, (-dist, n, doc))
+                    else:
+                        heapq.heapreplace(best, (-dist, n, doc))
+            # Anything in the next ring is at least r cells away
+            if len(best) == k and -best[0][0] <= r * self.cell_size:
+                break
+            r += 1
+        return [(-d, doc) for d, _, doc in sorted(best, key=lambda b: (-b[0], b[1]))]
+
+    def within(self, lon, lat, radius, query=None, predicate=None):
+        """All documents within radius of [lon, lat] that match the query/predicate.
+        Returns a list of (distance, doc), closest first."""
+        cx0, cy0 = self.cell(lon - radius, lat - radius)
+        cx1, cy1 = self.cell(lon + radius, lat + radius)
+        found = []
+        for x in xrange(cx0, cx1 + 1):
+            for y in xrange(cy0, cy1 + 1):
+                for plon, plat, doc in self.cells.get((x, y), ()):
+                    dist = math.hypot(plon - lon, plat - lat)
+                    if dist <= radius and \
+                       (query is None or matches_query(doc, query)) and \
+                       (predicate is None or predicate(doc)):
+                        found.append((dist, doc))
+        found.sort(key=lambda f: f[0])
+        return found
+
+    def nearest_many(self, points, k=5, max_distance=None, query=None, predicate=None):
+        """Batch of nearest queries, points is a list of [lon, lat].
+        The query/predicate is applied to the index once (see subset)."""
+        index = self
+        if query is not None or predicate is not None:
+            index = self.subset(query, predicate)
+        return [index.nearest(lon, lat, k, max_distance) for lon, lat in points]
+
+    def within_many(self, points, radius, query=None, predicate=None):
+        """Batch of radius queries, points is a list of [lon, lat]"""
+        index = self
+        if query is not None or predicate is not None:
+            index = self.subset(query, predicate)
+        return [index.within(lon, lat, radius) for lon, lat in points]
+
+
+def with_distance(results):
+    """Formats (distance, doc) results like $geoNear (copy of doc with a 'distance' field)"""
+    formatted = []
+    for dist, doc in results:
+        doc = dict(doc)
+        doc['distance'] = dist
+        formatted.append(doc)
+    return formatted
+
+
+def dog_related(index, near_loc, near_limit=10, max_distance=DOG_MAX_DISTANCE):
+    """Same as mongo_audit.dog_related with near_loc ([longitude, latitude]),
+    the closest near_limit dog-related documents"""
+    return with_distance(index.nearest(near_loc[0], near_loc[1], near_limit, max_distance, dog_qry))
+
+
+def dog_related_many(index, near_locs, near_limit=10, max_distance=DOG_MAX_DISTANCE):
+    """dog_related for a batch of [longitude, latitude] locations"""
+    return [with_distance(results) for results in
+            index.nearest_many(near_locs, near_limit, max_distance, dog_qry)]
+
+
+def test():
+    import data
+    import random
+    docs = list(data.iter_shaped(OSMFILE))
+    index = GridIndex.from_docs(docs, cell_size=0.005)
+    located = [d for d in docs if len(d.get('pos', [])) == 2]
+    print "Indexed %d documents"%(len(index))
+
+    # Compare against a brute force search
+    random.seed(1)
+    points = [[random.uniform(-122.5, -122.0), random.uniform(37.4, 37.9)] for _ in range(50)]
+    points += [d['pos'] for d in located[:10]]
+    for lon, lat in points:
+        brute = sorted(math.hypot(d['pos'][0] - lon, d['pos'][1] - lat) for d in located)
+        assert [dist for dist, _ in index.nearest(lon, lat, 5)] == brute[:5]
+        assert [dist for dist, _ in index.within(lon, lat, 0.02)] == [b for b in brute if b <= 0.02]
+        dogs = sorted(math.hypot(d['pos'][0] - lon, d['pos'][1] - lat) for d in located
+                      if matches_query(d, dog_qry))
+        dogs = [dist for dist in dogs if dist <= DOG_MAX_DISTANCE]
+        assert [d['distance'] for d in dog_related(index, [lon, lat], 3)] == dogs[:3]
+    batch = dog_related_many(index, points, 3)
+    assert batch == [dog_related(index, pt, 3) for pt in points]
+    assert index.nearest(points[0][0], points[0][1], 0) == []
+    assert index.nearest_many(points[:3], 0, query=dog_qry) == [[], [], []]
+    print "Nearest/radius queries match brute force search"
+
+
+if __name__ == '__main__':
+    test()
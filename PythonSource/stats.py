@@ -0,0 +1,225 @@
+"""
+Instrumentation for the shaping pipeline (data.mongo_process_map with stats=True).
+
+PipelineStats keeps counters (elements by type, tags, cleaning fixes, skipped
+keys, documents written) and the total time spent in each stage:
+    parse    getting the next element from the parser
+    shape    data.shape_element
+    insert   handing documents to the BulkWriter (blocks while writes are behind)
+    write    bulk writes to MongoDB (on the writer thread, overlaps the other stages)
+Progress (elements/sec, MB read, % done and ETA from the byte offset of the input
+file) is printed every report_every seconds, and to_dict/save_json give the
+final stats as json.
+
+Profiling hooks, toggled by mongo_process_map's profile option:
+    'cprofile'  runs the import under cProfile, saving the stats to a .prof file
+    'sample'    Sampler, a low overhead sampling profiler (SIGPROF timer, unix only)
+                counting which functions are on the stack
+
+>>> stats = PipelineStats(total_bytes=os.path.getsize(OSMFILE))
+>>> with stats.timer('shape'):
+...     el = shape_element(elem)
+"""
+import json
+import signal
+import time
+from collections import defaultdict
+
+DEFAULT_REPORT_EVERY = 10.0
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+
+class ProgressFile(object):
+    """Wraps a file object, counting the bytes read from it (so the
+    parsers' progress through the file is known)"""
+
+    def __init__(self, fo):
+        self.fo = fo
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.fo.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        self.fo.close()
+
+
+class StageTimer(object):
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.stage_times[self.stage] += time.time() - self.start
+
+
+class PipelineStats(object):
+    """Counters and per stage timers for one run of the pipeline"""
+
+    def __init__(self, total_bytes=None, report_every=DEFAULT_REPORT_EVERY):
+        self.total_bytes = total_bytes
+        self.report_every = report_every
+        self.start_time = time.time()
+        self.end_time = None
+        self.last_report = self.start_time
+        self.bytes_done = 0
+        self.stage_times = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    def timer(self, stage):
+        """Context manager adding the time spent in the block to the stage"""
+        return StageTimer(self, stage)
+
+    def add_time(self, stage, seconds):
+        self.stage_times[stage] += seconds
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def update_counts(self, counts):
+        for name, n in counts.iteritems():
+            self.counts[name] += n
+
+    def elements(self):
+        return sum(self.counts[t] for t in ("node", "way", "relation", "other_element"))
+
+    def progress(self, bytes_done):
+        """Records the byte offset reached, printing a progress report
+        if report_every seconds have passed since the last one"""
+        self.bytes_done = bytes_done
+        now = time.time()
+        if self.report_every is not None and now - self.last_report >= self.report_every:
+            self.last_report = now
+            print self.progress_line(now)
+
+    def progress_line(self, now=None):
+        if now is None:
+            now = time.time()
+        elapsed = max(now - self.start_time, 1e-9)
+        line = "%d elements (%.0f/sec), %.1f MB"%(self.elements(), self.elements() / elapsed,
+                                                   self.bytes_done / 1048576.0)
+        if self.total_bytes:
+            fraction = min(float(self.bytes_done) / self.total_bytes, 1.0)
+            line += " of %.1f MB (%.1f%%)"%(self.total_bytes / 1048576.0, fraction * 100)
+            if fraction > 0:
+                line += ", ETA %s"%(format_seconds(elapsed / fraction - elapsed))
+        return line
+
+    def finish(self):
+        self.end_time = time.time()
+        if self.total_bytes:
+            self.bytes_done = self.total_bytes
+
+    def to_dict(self):
+        end = self.end_time or time.time()
+        elapsed = max(end - self.start_time, 1e-9)
+        return { "elapsed_seconds" : elapsed,
+                 "bytes" : self.bytes_done,
+                 "total_bytes" : self.total_bytes,
+                 "elements" : self.elements(),
+                 "elements_per_sec" : self.elements() / elapsed,
+                 "tags_per_sec" : self.counts.get("tags", 0) / elapsed,
+                 "mb_per_sec" : self.bytes_done / 1048576.0 / elapsed,
+                 "stage_seconds" : dict(self.stage_times),
+                 "counts" : dict(self.counts) }
+
+    def save_json(self, file_out):
+        with open(file_out, "w") as fo:
+            json.dump(self.to_dict(), fo, indent=2, sort_keys=True)
+
+    def report(self):
+        stats = self.to_dict()
+        print "%d elements in %.1f sec: %.0f elements/sec, %.0f tags/sec, %.1f MB/sec"%(stats['elements'],\
+            stats['elapsed_seconds'], stats['elements_per_sec'], stats['tags_per_sec'], stats['mb_per_sec'])
+        for stage, secs in sorted(stats['stage_seconds'].items(), key=lambda s: -s[1]):
+            print "  %-8s %8.2f sec (%.0f%%)"%(stage, secs, 100 * secs / stats['elapsed_seconds'])
+        for name, n in sorted(stats['counts'].items()):
+            print "  %-22s %d"%(name, n)
+
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "%dh%02dm"%(seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return "%dm%02ds"%(seconds // 60, seconds % 60)
+    return "%ds"%(seconds)
+
+
+class Sampler(object):
+    """Sampling profiler, every interval seconds of cpu time records the
+    functions on the (main thread's) stack"""
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self.inclusive = defaultdict(int)
+        self.exclusive = defaultdict(int)
+
+    def _sample(self, signum, frame):
+        self.samples += 1
+        seen = set()
+        top = True
+        while frame is not None:
+            code = frame.f_code
+            func = "%s:%d(%s)"%(code.co_filename, code.co_firstlineno, code.co_name)
+            if top:
+                self.exclusive[func] += 1
+                top = False
+            if func not in seen:
+                seen.add(func)
+                self.inclusive[func] += 1
+            frame = frame.f_back
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def to_dict(self, limit=30):
+        top = lambda counts: [(func, n) for func, n in
+                              sorted(counts.items(), key=lambda c: -c[1])[:limit]]
+        return { "samples" : self.samples,
+                 "interval" : self.interval,
+                 "exclusive" : top(self.exclusive),
+                 "inclusive" : top(self.inclusive) }
+
+    def report(self, limit=15):
+        print "%d samples, functions using the most time (exclusive, inclusive %%):"%(self.samples)
+        total = float(max(self.samples, 1))
+        for func, n in sorted(self.exclusive.items(), key=lambda c: -c[1])[:limit]:
+            print "  %5.1f%% %5.1f%%  %s"%(100 * n / total, 100 * self.inclusive[func] / total, func)
+
+
+def test():
+    stats = PipelineStats(total_bytes=2 * 1048576, report_every=0)
+    with stats.timer('parse'):
+        time.sleep(0.01)
+    stats.count('node', 10)
+    stats.update_counts({ 'tags' : 5 })
+    stats.progress(1048576)
+    assert stats.stage_times['parse'] >= 0.01
+    assert "50.0%" in stats.progress_line()
+    stats.finish()
+    assert stats.to_dict()['elements'] == 10
+    json.dumps(stats.to_dict())
+    sampler = Sampler(0.001)
+    sampler.start()
+    end = time.time() + 0.2
+    while time.time() < end:
+        sum(range(1000))
+    sampler.stop()
+    assert sampler.samples > 0
+    sampler.report(3)
+
+
+if __name__ == '__main__':
+    test()
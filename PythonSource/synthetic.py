@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Generates synthetic (but realistic looking) .osm files of any size, for
+benchmarking without downloading the full San Francisco extract.
+
+The output is deterministic for a given size and seed.  The proportions are
+modeled on san-francisco.osm (see README.md):
+- about 9 nodes for every way, and a relation for every ~1000 nodes
+- most nodes have no tags, the rest are POIs (amenities with names/addresses,
+  including dog-related ones like vets, pet shops and dog parks), traffic signals,
+  or places with name:* translations
+- ways average ~11 nodes (buildings/parks are closed, and a few long ways
+  like coastlines have hundreds to thousands of nodes), with building,
+  addr:*, highway and tiger:* tags
+- street names use the abbreviations and city names the misspellings that
+  audit.py/data.py clean up, and some keys have problem characters
+- a few users make most of the edits (zipf distribution), some with non-ascii names
+
+>>> import synthetic
+>>> synthetic.generate_osm("../synthetic_100k.osm", num_nodes=100000)
+"""
+import random
+from xml.sax.saxutils import quoteattr
+from audit import mapping, city_mapping, expected
+
+#OSMFILE = "../example.osm"
+OSMFILE = "../example_sf.osm"
+#OSMFILE = "../san-francisco.osm"
+
+NODES_PER_WAY = 9.3
+NODES_PER_RELATION = 950
+NUM_USERS = 1500
+BOUNDS = (-122.737, 37.449, -122.011, 37.955)
+
+street_bases = ["Market", "Mission", "Valencia", "Geary", "Clement", "Irving", "Judah", "Taraval",
+                "Noriega", "Lincoln", "Fulton", "Haight", "Divisadero", "Fillmore", "Castro",
+                "Folsom", "Howard", "Bryant", "Harrison", "Townsend", "Brannan", "Potrero",
+                "San Bruno", "El Camino Real", "Junipero Serra", "Alemany", "Ocean", "Sloat"]
+street_suffixes = expected + sorted(mapping.keys())
+cities = ["San Francisco"] * 20 + ["Oakland", "Berkeley", "Daly City", "San Mateo",
+                                   "Palo Alto", "Alameda"] * 2 + sorted(city_mapping.keys())
+amenities = ["restaurant", "cafe", "fast_food", "bar", "pub", "bank", "school", "place_of_worship",
+             "parking", "post_office", "pharmacy", "library", "bicycle_parking", "toilets"]
+dog_amenities = ["veterinary", "animal_shelter", "animal_boarding"]
+cuisines = ["mexican", "chinese", "italian", "japanese", "thai", "burger", "pizza", "vietnamese"]
+name_words = ["Golden", "Gate", "Bay", "Mission", "Sunset", "Twin", "Peaks", "Noe", "Valley",
+              "Bernal", "Heights", "Presidio", "Marina", "Nob", "Hill", "Dolores", "Alamo",
+              "Square", "Hayes", "Glen", "Park", "Ocean", "View", "Excelsior", "Potrero"]
+dog_names = ["Dog Park", "Pet Hospital", "Veterinary Clinic", "Animal Care", "Pup Grooming",
+             "K9 Training", "Pets Unlimited", "Canine Club"]
+not_dog_names = ["Hot Dog Stand", "Dogpatch Cafe", "Recreation Center", "Dogwood Grove"]
+translations = [("name:en", "{0}"), ("name:es", "Parque {0}"), ("name:zh", u"{0} 公园"),
+                ("name:ru", u"{0} парк"), ("alt_name", "{0} Commons"), ("old_name", "Old {0}")]
+problem_keys = ["addr:street:name", "fixme ", "note.", "source;date", "name=old", "url#1"]
+special_users = [u"Wilfredo S\xe1nchez", u"Милан Јелисавчић"]
+
+
+def attr(key, val):
+    if isinstance(val, unicode):
+        val = val.encode('utf-8')
+    return ' %s=%s'%(key, quoteattr(str(val)))
+
+
+class OsmGenerator(object):
+    """Writes the elements of a synthetic .osm file, using its own
+    random number generator (so the output only depends on the seed)"""
+
+    def __init__(self, fo, seed=0):
+        self.fo = fo
+        self.rand = random.Random(seed)
+        self.users = ["user%d"%(i) for i in range(NUM_USERS - len(special_users))] + \
+                     [u.encode('utf-8') for u in special_users]
+        # Zipf-like weights, a few users make most of the edits
+        weights = [1.0 / (rank + 1) ** 1.3 for rank in range(len(self.users))]
+        total = sum(weights)
+        self.user_cdf = []
+        acc = 0.0
+        for w in weights:
+            acc += w / total
+            self.user_cdf.append(acc)
+        self.node_ids = []
+        self.way_ids = []
+        self.next_id = 26000000
+        self.counts = { "node" : 0, "way" : 0, "relation" : 0, "nd" : 0, "tag" : 0, "member" : 0 }
+
+    def new_id(self):
+        self.next_id += self.rand.randint(1, 40)
+        return self.next_id
+
+    def user(self):
+        x = self.rand.random()
+        lo, hi = 0, len(self.user_cdf) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.user_cdf[mid] < x:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def common_attrs(self, el_id):
+        uid = self.user()
+        return attr("id", el_id) + attr("version", self.rand.randint(1, 20)) + \
+               attr("timestamp", "20%02d-%02d-%02dT%02d:%02d:%02dZ"%(self.rand.randint(7, 14),
+                    self.rand.randint(1, 12), self.rand.randint(1, 28), self.rand.randint(0, 23),
+                    self.rand.randint(0, 59), self.rand.randint(0, 59))) + \
+               attr("uid", 10000 + uid) + attr("user", self.users[uid]) + \
+               attr("changeset", self.rand.randint(1000000, 25000000))
+
+    def write_tags(self, tags):
+        for key, val in tags:
+            self.fo.write('    <tag%s%s/>\n'%(attr("k", key), attr("v", val)))
+        self.counts['tag'] += len(tags)
+
+    def street(self):
+        return "%s %s"%(self.rand.choice(street_bases), self.rand.choice(street_suffixes))
+
+    def name(self):
+        return " ".join(self.rand.choice(name_words) for _ in range(self.rand.randint(1, 3)))
+
+    def address(self):
+        tags = [("addr:housenumber", str(self.rand.randint(1, 4999))),
+                ("addr:street", self.street())]
+        if self.rand.random() < 0.5:
+            tags.append(("addr:city", self.rand.choice(cities)))
+        if self.rand.random() < 0.3:
+            tags.append(("addr:postcode", "941%02d"%(self.rand.randint(2, 34))))
+        return tags
+
+    def node_tags(self):
+        r = self.rand.random()
+        if r < 0.95:
+            return []
+        if r < 0.965:
+            return [("highway", self.rand.choice(["traffic_signals", "crossing", "stop", "bus_stop"]))]
+        if r < 0.98:
+            tags = [("name", self.name()), ("amenity", self.rand.choice(amenities))] + self.address()
+            if tags[1][1] in ("restaurant", "fast_food"):
+                tags.append(("cuisine", self.rand.choice(cuisines)))
+            if self.rand.random() < 0.3:
+                tags.append(("phone", "+1 415 %03d %04d"%(self.rand.randint(200, 999), self.rand.randint(0, 9999))))
+            return tags
+        if r < 0.987:
+            # Dog related (or looks dog related but isn't)
+            if self.rand.random() < 0.25:
+                return [("name", self.rand.choice(not_dog_names)), ("amenity", self.rand.choice(amenities))]
+            tags = [("name", "%s %s"%(self.rand.choice(name_words), self.rand.choice(dog_names)))]
+            kind = self.rand.random()
+            if kind < 0.4:
+                tags.append(("amenity", self.rand.choice(dog_amenities)))
+            elif kind < 0.7:
+                tags += [("leisure", "dog_park"), ("dog", "yes")]
+            else:
+                tags += [("shop", "pet"), ("grooming", "yes")]
+            return tags + self.address()
+        if r < 0.995:
+            base = self.name()
+            tags = [("name", base), ("place", self.rand.choice(["neighbourhood", "locality", "hamlet"]))]
+            for key, val in self.rand.sample(translations, self.rand.randint(1, len(translations))):
+                tags.append((key, val.format(base)))
+            return tags
+        return [(self.rand.choice(problem_keys), "x"), ("source", "survey")]
+
+    def write_node(self):
+        node_id = self.new_id()
+        self.node_ids.append(node_id)
+        lon = self.rand.uniform(BOUNDS[0], BOUNDS[2])
+        lat = self.rand.uniform(BOUNDS[1], BOUNDS[3])
+        tags = self.node_tags()
+        self.fo.write('  <node%s%s%s'%(self.common_attrs(node_id), attr("lat", "%.7f"%(lat)), attr("lon", "%.7f"%(lon))))
+        if tags:
+            self.fo.write('>\n')
+            self.write_tags(tags)
+            self.fo.write('  </node>\n')
+        else:
+            self.fo.write('/>\n')
+        self.counts['node'] += 1
+
+    def way_tags(self):
+        r = self.rand.random()
+        if r < 0.55:
+            tags = [("building", "yes")]
+            if self.rand.random() < 0.3:
+                tags += self.address()
+            return tags, True
+        if r < 0.85:
+            street = self.street()
+            tags = [("highway", self.rand.choice(["residential", "service", "primary", "secondary", "footway"])),
+                    ("name", street)]
+            if self.rand.random() < 0.6:
+                tags += [("tiger:cfcc", "A41"), ("tiger:county", "San Francisco, CA"),
+                         ("tiger:name_base", street.rsplit(" ", 1)[0]), ("tiger:name_type", street.rsplit(" ", 1)[1]),
+                         ("tiger:zip_left", "941%02d"%(self.rand.randint(2, 34))), ("tiger:reviewed", "no")]
+            if self.rand.random() < 0.2:
+                tags.append(("oneway", "yes"))
+            return tags, False
+        if r < 0.92:
+            tags = [("leisure", "park"), ("name", "%s Park"%(self.name()))]
+            if self.rand.random() < 0.2:
+                tags += [("park:type", "city_park"), ("dog", "leashed")]
+            return tags, True
+        if r < 0.996:
+            return [("landuse", self.rand.choice(["residential", "commercial", "grass"]))], True
+        return [("natural", "coastline")], False
+
+    def write_way(self):
+        way_id = self.new_id()
+        self.way_ids.append(way_id)
+        tags, closed = self.way_tags()
+        if tags[0] == ("natural", "coastline"):
+            length = self.rand.randint(200, 2000)
+        else:
+            length = max(2, int(self.rand.expovariate(1.0 / 7)))
+        length = min(length, len(self.node_ids))
+        start = self.rand.randint(0, len(self.node_ids) - length)
+        refs = self.node_ids[start:start + length]
+        if closed and len(refs) > 2:
+            refs = refs + refs[:1]
+        self.fo.write('  <way%s>\n'%(self.common_attrs(way_id)))
+        for ref in refs:
+            self.fo.write('    <nd%s/>\n'%(attr("ref", ref)))
+        self.counts['nd'] += len(refs)
+        self.write_tags(tags)
+        self.fo.write('  </way>\n')
+        self.counts['way'] += 1
+
+    def write_relation(self):
+        rel_type = self.rand.choice(["multipolygon", "route", "restriction"])
+        self.fo.write('  <relation%s>\n'%(self.common_attrs(self.new_id())))
+        members = [("way", self.rand.choice(self.way_ids), "outer")
+                   for _ in range(self.rand.randint(1, 12)) if self.way_ids]
+        if rel_type != "multipolygon":
+            members.append(("node", self.rand.choice(self.node_ids), "stop"))
+        for member_type, ref, role in members:
+            self.fo.write('    <member%s%s%s/>\n'%(attr("type", member_type), attr("ref", ref), attr("role", role)))
+        self.counts['member'] += len(members)
+        self.write_tags([("type", rel_type), ("name", self.name())])
+        self.fo.write('  </relation>\n')
+        self.counts['relation'] += 1
+
+    def write(self, num_nodes):
+        """Writes the whole file: nodes, then ways, then relations (same order as
+        an extract), returns the count of each element type written"""
+        num_ways = int(num_nodes / NODES_PER_WAY)
+        num_relations = num_nodes // NODES_PER_RELATION
+        self.fo.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+        self.fo.write('<osm version="0.6" generator="synthetic.py">\n')
+        self.fo.write('  <bounds%s%s%s%s/>\n'%(attr("minlon", BOUNDS[0]), attr("minlat", BOUNDS[1]),
+                                                attr("maxlon", BOUNDS[2]), attr("maxlat", BOUNDS[3])))
+        for _ in xrange(num_nodes):
+            self.write_node()
+        for _ in xrange(num_ways):
+            self.write_way()
+        for _ in xrange(num_relations):
+            self.write_relation()
+        self.fo.write('</osm>\n')
+        return self.counts
+
+
+def generate_osm(file_out, num_nodes=100000, seed=0):
+    """Writes a synthetic .osm file with num_nodes nodes (and the matching number of
+    ways/relations), returns the count of each element type written"""
+    with open(file_out, "wb") as fo:
+        return OsmGenerator(fo, seed).write(num_nodes)
+
+
+def test():
+    import hashlib
+    import os
+    import tempfile
+    import mapparser
+    path = os.path.join(tempfile.mkdtemp(), "synthetic.osm")
+    counts = generate_osm(path, 5000, seed=1)
+    digest = hashlib.md5(open(path, "rb").read()).hexdigest()
+    assert generate_osm(path, 5000, seed=1) == counts
+    assert hashlib.md5(open(path, "rb").read()).hexdigest() == digest
+    tags = mapparser.count_tags(path)
+    for key, count in counts.iteritems():
+        assert tags.get(key, 0) == count
+    print "Generated %s (%d bytes): %s"%(path, os.path.getsize(path), counts)
+
+
+if __name__ == "__main__":
+    test()
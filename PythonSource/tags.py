@@ -3,6 +3,7 @@
 import xml.etree.ElementTree as ET
 import pprint
 import re
+from compressed import opened_osm
 """
 Explores the data a bit more.
 Before processing the data and adding it into MongoDB,
@@ -97,8 +98,9 @@ def key_type(element, keys):
 
 def process_map(filename):
     keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
-    for _, element in ET.iterparse(filename):
-        keys = key_type(element, keys)
+    with opened_osm(filename) as osm_file:
+        for _, element in ET.iterparse(osm_file):
+            keys = key_type(element, keys)
 
     return keys
 
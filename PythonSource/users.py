@@ -3,6 +3,7 @@
 import xml.etree.ElementTree as ET
 import pprint
 import re
+from compressed import opened_osm
 """
 Explores the data a bit more.
 First finds out how many unique users
@@ -49,10 +50,11 @@ OSMFILE = "../san-francisco.osm"
 
 def process_map(filename):
     users = {}
-    for _, element in ET.iterparse(filename):
-        if 'user' in element.attrib.keys():
-            username = element.attrib['user']
-            users.update({username : users.get(username,0)+1})
+    with opened_osm(filename) as osm_file:
+        for _, element in ET.iterparse(osm_file):
+            if 'user' in element.attrib.keys():
+                username = element.attrib['user']
+                users.update({username : users.get(username,0)+1})
 
     return users
 